@@ -0,0 +1,5 @@
+# ampread - helper modules for the ampread Raspberry Pi current monitor.
+#
+# The ampread_python3e.py script is still the thing you run. The modules in
+# this package hold the pieces of it that are worth reusing or measuring on
+# their own.
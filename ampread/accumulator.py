@@ -0,0 +1,139 @@
+# Per-channel accumulators for sampling loops that don't keep a buffer.
+#
+# The old loops converted every channel to amps (and rounded it twice) on
+# every one of the 200 passes, even though only the last answer was used.
+# An accumulator just folds each reading into a couple of running numbers
+# and is turned into amps once, at the end of the cycle.
+#
+# The reducer decides how readings become amps:
+#   Peak   - highest absolute reading, amps = peak / sqrt(2) (the old way)
+#   Rms    - true RMS with the DC offset removed
+#   Mean   - average absolute reading, amps = mean * pi / (2 * sqrt(2))
+#   MinMax - half the peak to peak swing / sqrt(2), ignores any DC offset
+#
+# If you have NumPy and keep all the samples, ampread.waveform does the same
+# job for a whole buffer at once.
+
+import math
+
+SQRT2 = math.sqrt(2)
+
+
+class Peak(object):
+    __slots__ = ('peak',)
+
+    def __init__(self):
+        self.peak = 0
+
+    def add(self, x):
+        if x < 0:
+            x = -x
+        if x > self.peak:
+            self.peak = x
+
+    def value(self):
+        return self.peak
+
+    def amps(self, scale):
+        return self.peak * scale / SQRT2
+
+
+class Rms(object):
+    __slots__ = ('total', 'squares', 'count')
+
+    def __init__(self):
+        self.total = 0
+        self.squares = 0
+        self.count = 0
+
+    def add(self, x):
+        self.total += x
+        self.squares += x * x
+        self.count += 1
+
+    def value(self):
+        if not self.count:
+            return 0.0
+        # variance = mean of squares - square of mean, which takes the DC offset out
+        mean = float(self.total) / self.count
+        return math.sqrt(max(float(self.squares) / self.count - mean * mean, 0.0))
+
+    def amps(self, scale):
+        return self.value() * scale
+
+
+class Mean(object):
+    __slots__ = ('total', 'count')
+
+    def __init__(self):
+        self.total = 0
+        self.count = 0
+
+    def add(self, x):
+        self.total += abs(x)
+        self.count += 1
+
+    def value(self):
+        if not self.count:
+            return 0.0
+        return float(self.total) / self.count
+
+    def amps(self, scale):
+        # the average of a rectified sine wave is 2/pi of its peak
+        return self.value() * scale * math.pi / 2 / SQRT2
+
+
+class MinMax(object):
+    __slots__ = ('low', 'high')
+
+    def __init__(self):
+        self.low = None
+        self.high = None
+
+    def add(self, x):
+        if self.low is None:
+            self.low = self.high = x
+        elif x < self.low:
+            self.low = x
+        elif x > self.high:
+            self.high = x
+
+    def value(self):
+        if self.low is None:
+            return 0
+        return self.high - self.low
+
+    def amps(self, scale):
+        return self.value() / 2.0 * scale / SQRT2
+
+
+class ChannelAccumulator(object):
+    """Fold one channel's readings together and finalize them to amps.
+
+    ``full_scale`` is the ADC reading that equals ``ct_amps`` on the current
+    transformer (2047 for the ads1015 with a 30A/1V SCT-013). ``reducer`` is
+    one of the classes above, or anything with add(), value() and amps().
+    """
+
+    __slots__ = ('scale', 'reducer', 'state', 'add')
+
+    def __init__(self, full_scale, ct_amps=30.0, reducer=Peak):
+        self.scale = float(ct_amps) / float(full_scale)
+        self.reducer = reducer
+        self.reset()
+
+    def reset(self):
+        self.state = self.reducer()
+        # bind add() once so the sampling loop skips an attribute lookup per reading
+        self.add = self.state.add
+
+    def value(self):
+        return self.state.value()
+
+    def finalize(self, places=None):
+        # Turn what we've collected into amps and start over for the next cycle.
+        amps = self.state.amps(self.scale)
+        if places is not None:
+            amps = round(amps, places)
+        self.reset()
+        return amps
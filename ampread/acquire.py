@@ -0,0 +1,120 @@
+# Sample every ADC at the same time instead of one after the other.
+#
+# Sampling adc1 completely and only then starting on adc2 means the eight
+# circuits are never measured over the same stretch of time, and every extra
+# ADC adds its whole sampling time to the cycle. Here each ADC gets its own
+# reader thread. All readers are released together off one shared clock, so a
+# cycle takes about as long as the slowest ADC rather than the sum of them.
+#
+# Sharing the I2C bus between threads is fine: each register read or write is
+# a single transfer that the kernel's i2c driver serializes, and most of a
+# reader's time is spent waiting for its own ADC to finish a conversion.
+
+import threading
+import time
+
+
+class Frame(object):
+    """One time-aligned set of readings from every ADC.
+
+    ``buffers`` and ``rates`` are in the same order as the readers given to
+    Acquisition. ``start`` and ``end`` are time.perf_counter() values, and
+    ``time`` is the wall clock (time.time()) when the frame started.
+    """
+
+    __slots__ = ('time', 'start', 'end', 'count', 'buffers', 'rates', 'started')
+
+    def __init__(self, buffers):
+        self.time = 0.0
+        self.start = 0.0
+        self.end = 0.0
+        self.count = 0
+        self.buffers = buffers
+        self.rates = [None] * len(buffers)
+        self.started = [None] * len(buffers)
+
+    def duration(self):
+        return self.end - self.start
+
+
+class _Reader(threading.Thread):
+    # One thread per ADC. It sleeps on the start barrier, fills its buffer and
+    # then meets everybody else at the done barrier.
+
+    def __init__(self, owner, index, sampler, buffer):
+        threading.Thread.__init__(self, name='ampread-adc-%d' % index)
+        self.daemon = True
+        self.owner = owner
+        self.index = index
+        self.sampler = sampler
+        self.buffer = buffer
+        self.rows = buffer.rows()
+        self.times = buffer.time_rows()
+        self.error = None
+
+    def run(self):
+        owner = self.owner
+        while True:
+            owner._start.wait()
+            if owner._closed:
+                return
+            self.error = None
+            try:
+                self.sampler.sample(owner._count, self.rows, self.times)
+            except Exception as e:
+                # hand the error back to acquire() instead of killing the thread
+                self.error = e
+            owner._done.wait()
+
+
+class Acquisition(object):
+    """Sample several ADCs concurrently into one time-aligned Frame.
+
+    ``readers`` is a list of (ContinuousSampler, WaveformBuffer) pairs, one
+    per ADC.
+    """
+
+    def __init__(self, readers):
+        readers = list(readers)
+        self._count = 0
+        self._closed = False
+        # the main thread takes part in both barriers to start and collect a frame
+        self._start = threading.Barrier(len(readers) + 1)
+        self._done = threading.Barrier(len(readers) + 1)
+        self._readers = [_Reader(self, i, sampler, buffer)
+                         for i, (sampler, buffer) in enumerate(readers)]
+        self.frame = Frame([r.buffer for r in self._readers])
+        self.samplers = [r.sampler for r in self._readers]
+        for r in self._readers:
+            r.start()
+
+    def acquire(self, count):
+        # Take "count" samples per channel on every ADC at once and return the
+        # frame. The frame (and its buffers) are reused on the next call. A
+        # count of None fills each buffer, whatever length it is.
+        if self._closed:
+            raise RuntimeError('acquisition is closed')
+        frame = self.frame
+        self._count = count
+        frame.count = count
+        frame.time = time.time()
+        frame.start = time.perf_counter()
+        self._start.wait()
+        self._done.wait()
+        frame.end = time.perf_counter()
+
+        for i, r in enumerate(self._readers):
+            if r.error is not None:
+                raise r.error
+            frame.rates[i] = dict(r.sampler.rates)
+            frame.started[i] = dict(r.sampler.started)
+        return frame
+
+    def close(self):
+        # Release the reader threads and let them exit.
+        if self._closed:
+            return
+        self._closed = True
+        self._start.wait()
+        for r in self._readers:
+            r.join()
@@ -0,0 +1,204 @@
+# The ADC interface the sampling code talks to, plus a real and a fake one.
+#
+# AdafruitADC drives a real ADS1015 / ADS1115 through the Adafruit_ADS1x15
+# library. SimulatedADC pretends to be one: it makes up 60Hz current
+# waveforms (with harmonics and noise) and takes about as long as the real
+# chip and I2C bus would to answer, so the acquisition code can be run,
+# profiled and tuned on any Linux box without a Pi.
+
+import math
+import random
+import time
+
+# Data rates (samples per second) supported by each chip.
+ADS1015_DATA_RATES = (128, 250, 490, 920, 1600, 2400, 3300)
+ADS1115_DATA_RATES = (8, 16, 32, 64, 128, 250, 475, 860)
+
+# Full scale input voltage for each PGA gain setting.
+GAIN_VOLTS = {2/3: 6.144, 1: 4.096, 2: 2.048, 4: 1.024, 8: 0.512, 16: 0.256}
+
+# model name -> (highest positive reading, supported data rates, default data rate)
+MODELS = {
+    'ADS1015': (2047, ADS1015_DATA_RATES, 1600),
+    'ADS1115': (32767, ADS1115_DATA_RATES, 128),
+}
+
+
+class ADC(object):
+    """What the samplers need from an ADS1x15.
+
+    The methods match the Adafruit_ADS1x15 ones so either can be used.
+    ``max_count`` is the highest positive reading the chip returns.
+    """
+
+    model = None
+    max_count = 0
+    data_rates = ()
+    default_data_rate = None
+
+    def read_adc(self, channel, gain=1, data_rate=None):
+        # single-shot conversion of one channel
+        raise NotImplementedError
+
+    def start_adc(self, channel, gain=1, data_rate=None):
+        # start continuous conversions on a channel and return the first result
+        raise NotImplementedError
+
+    def get_last_result(self):
+        # latest result while in continuous mode
+        raise NotImplementedError
+
+    def stop_adc(self):
+        raise NotImplementedError
+
+    def check_data_rate(self, data_rate):
+        if data_rate is None:
+            return self.default_data_rate
+        if data_rate not in self.data_rates:
+            raise ValueError('%s data rate must be one of: %s'
+                             % (self.model, ', '.join(str(r) for r in self.data_rates)))
+        return data_rate
+
+
+def _model(model):
+    model = model.upper()
+    if model not in MODELS:
+        raise ValueError('unknown ADC model %r, expected one of: %s'
+                         % (model, ', '.join(sorted(MODELS))))
+    return model
+
+
+class AdafruitADC(ADC):
+    """A real ADS1015 or ADS1115 on the Pi's I2C bus."""
+
+    def __init__(self, model='ADS1015', address=0x48, busnum=1):
+        # Imported here so the rest of ampread works on machines without the
+        # Adafruit library (or an I2C bus).
+        import Adafruit_ADS1x15
+
+        self.model = _model(model)
+        self.max_count, self.data_rates, self.default_data_rate = MODELS[self.model]
+        self.address = address
+        self.busnum = busnum
+        self.device = getattr(Adafruit_ADS1x15, self.model)(address=address, busnum=busnum)
+        # bind the hot methods straight through so there's no extra call per read
+        self.get_last_result = self.device.get_last_result
+        self.stop_adc = self.device.stop_adc
+
+    def read_adc(self, channel, gain=1, data_rate=None):
+        return self.device.read_adc(channel, gain=gain, data_rate=data_rate)
+
+    def start_adc(self, channel, gain=1, data_rate=None):
+        return self.device.start_adc(channel, gain=gain, data_rate=data_rate)
+
+
+class SimulatedLoad(object):
+    """A synthetic current waveform on one channel.
+
+    ``amps`` is the RMS current of the fundamental. ``harmonics`` maps a
+    harmonic number to its size relative to the fundamental, e.g. {3: 0.3,
+    5: 0.1} for a switch-mode power supply. ``noise`` is RMS noise in amps.
+    """
+
+    def __init__(self, amps=0.0, harmonics=None, phase=0.0, noise=0.02, frequency=60.0):
+        self.amps = float(amps)
+        self.harmonics = dict(harmonics or {})
+        self.phase = float(phase)
+        self.noise = float(noise)
+        self.frequency = float(frequency)
+
+    def current(self, t):
+        # instantaneous current in amps at time t (seconds)
+        w = 2 * math.pi * self.frequency * t + self.phase
+        peak = self.amps * math.sqrt(2)
+        value = math.sin(w)
+        for n, size in self.harmonics.items():
+            value += size * math.sin(n * w)
+        value *= peak
+        if self.noise:
+            value += random.gauss(0.0, self.noise)
+        return value
+
+
+class SimulatedADC(ADC):
+    """A made-up ADS1015 / ADS1115 that behaves like the real thing.
+
+    ``loads`` is a list of up to four SimulatedLoad objects (None or missing
+    means nothing on that input). Readings come from the load's current
+    through a ``ct_amps`` per ``ct_volts`` current transformer, scaled by the
+    PGA gain and clipped like the chip would. ``i2c_latency`` is how long one
+    register read or write takes on the bus (about 0.25ms at 100kHz).
+    """
+
+    def __init__(self, model='ADS1015', loads=None, ct_amps=30.0, ct_volts=1.0,
+                 i2c_latency=0.00025, offset=0, clock=time.perf_counter):
+        self.model = _model(model)
+        self.max_count, self.data_rates, self.default_data_rate = MODELS[self.model]
+        loads = list(loads or [])
+        self.loads = (loads + [None] * 4)[:4]
+        self.ct_amps = float(ct_amps)
+        self.ct_volts = float(ct_volts)
+        self.i2c_latency = i2c_latency
+        self.offset = offset
+        self.clock = clock
+        self._channel = None
+        self._gain = 1
+        self._period = 0.0
+        self._started = 0.0
+        self.reads = 0
+
+    def _bus(self):
+        # one I2C transaction
+        self.reads += 1
+        if self.i2c_latency:
+            time.sleep(self.i2c_latency)
+
+    def _convert(self, channel, gain, t):
+        load = self.loads[channel]
+        amps = load.current(t) if load is not None else 0.0
+        volts = amps / self.ct_amps * self.ct_volts
+        value = int(round(volts / GAIN_VOLTS[gain] * self.max_count)) + self.offset
+        # the chip clips at its full scale reading
+        return max(-self.max_count - 1, min(self.max_count, value))
+
+    def read_adc(self, channel, gain=1, data_rate=None):
+        data_rate = self.check_data_rate(data_rate)
+        self._bus()
+        # same wait as the Adafruit library: one conversion plus a little extra
+        time.sleep(1.0 / data_rate + 0.0001)
+        self._bus()
+        return self._convert(channel, gain, self.clock())
+
+    def start_adc(self, channel, gain=1, data_rate=None):
+        data_rate = self.check_data_rate(data_rate)
+        self._bus()
+        self._channel = channel
+        self._gain = gain
+        self._period = 1.0 / data_rate
+        self._started = self.clock()
+        time.sleep(self._period + 0.0001)
+        return self.get_last_result()
+
+    def get_last_result(self):
+        if self._channel is None:
+            raise RuntimeError('get_last_result() called before start_adc()')
+        self._bus()
+        # the result register holds the last finished conversion, so snap the
+        # time back to the end of that conversion
+        now = self.clock()
+        done = int((now - self._started) / self._period)
+        return self._convert(self._channel, self._gain, self._started + done * self._period)
+
+    def stop_adc(self):
+        self._bus()
+        self._channel = None
+
+
+def open_adc(model='ADS1015', address=0x48, busnum=1, simulate=False, **kwargs):
+    """Open a real ADC, or a SimulatedADC when ``simulate`` is true.
+
+    Extra keyword arguments are passed to SimulatedADC.
+    """
+    if simulate:
+        return SimulatedADC(model, **kwargs)
+    return AdafruitADC(model, address=address, busnum=busnum)
@@ -0,0 +1,159 @@
+# Reading UPS status from apcupsd's Network Information Server (NIS).
+#
+# The NIS protocol frames everything with a 2 byte big-endian length: we send
+# a length-prefixed "status" command and get back one length-prefixed record
+# per line ("LINEV    : 121.0 Volts"), finished off by a zero length record.
+# ApcupsdClient reads records until that terminator, so it never cuts a reply
+# short or has to sleep and hope it all arrived, and it keeps the connection
+# open between polls. Fields come back keyed by name, so it doesn't matter
+# which order apcupsd lists them in.
+
+import socket
+import struct
+import time
+
+NIS_PORT = 3551
+
+# Fields that are numbers (with the units after them dropped). Everything
+# else stays a string.
+NUMERIC = frozenset([
+    'LINEV', 'LOADPCT', 'BCHARGE', 'TIMELEFT', 'MBATTCHG', 'MINTIMEL', 'MAXTIME',
+    'MAXLINEV', 'MINLINEV', 'OUTPUTV', 'SENSE', 'DWAKE', 'DSHUTD', 'LOTRANS',
+    'HITRANS', 'RETPCT', 'ITEMP', 'ALARMDEL', 'BATTV', 'LINEFREQ', 'NUMXFERS',
+    'TONBATT', 'CUMONBATT', 'NOMOUTV', 'NOMINV', 'NOMBATTV', 'NOMPOWER',
+    'NOMAPNT', 'HUMIDITY', 'AMBTEMP', 'EXTBATTS', 'BADBATTS', 'STESTI',
+])
+
+
+class ApcupsdError(Exception):
+    """apcupsd couldn't be reached or sent something we don't understand."""
+
+
+def parse_status(records):
+    """Turn status records ("NAME : value") into a dict of name -> value.
+
+    Fields in NUMERIC become floats, e.g. 'LINEV': 121.0 from
+    "LINEV    : 121.0 Volts".
+    """
+    values = {}
+    for record in records:
+        name, sep, value = record.partition(':')
+        if not sep:
+            continue
+        name = name.strip()
+        value = value.strip()
+        if name in NUMERIC:
+            try:
+                value = float(value.split(None, 1)[0])
+            except (IndexError, ValueError):
+                pass
+        values[name] = value
+    return values
+
+
+def ups_status(values):
+    """Pick the fields ampread uploads out of a parse_status() dict.
+
+    A number apcupsd didn't report is None, never a made up value, so a
+    UPS without TIMELEFT doesn't look like it has no runtime left.
+    """
+
+    def number(name, default):
+        value = values.get(name, default)
+        return value if isinstance(value, float) else default
+
+    return {
+        'LINEV': number('LINEV', None),
+        'LOAD': number('LOADPCT', None),
+        'BCHG': number('BCHARGE', None),
+        'TIMELEFT': number('TIMELEFT', None),
+        'BATTV': number('BATTV', None),
+        'SERVER': values.get('HOSTNAME', 'Unknown'),
+        'UPSNAME': values.get('UPSNAME', 'Unknown'),
+        'STATUS': values.get('STATUS', 'Unknown'),
+    }
+
+
+class ApcupsdClient(object):
+    """A persistent connection to an apcupsd NIS server.
+
+    A dropped connection is reopened on the next call. While the server is
+    unreachable, reconnects are spaced out (doubling up to ``max_backoff``
+    seconds) and calls in between raise ApcupsdError straight away.
+    """
+
+    def __init__(self, host, port=NIS_PORT, timeout=5.0, max_backoff=60.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.reconnects = 0
+        self._sock = None
+        self._reader = None
+        self._backoff = 0.0
+        self._retry_at = 0.0
+
+    def _connect(self):
+        now = time.monotonic()
+        if now < self._retry_at:
+            raise ApcupsdError('waiting %.0fs before reconnecting to %s:%d'
+                               % (self._retry_at - now, self.host, self.port))
+        try:
+            sock = socket.create_connection((self.host, self.port), self.timeout)
+        except OSError as e:
+            self._backoff = min(max(self._backoff * 2, 1.0), self.max_backoff)
+            self._retry_at = now + self._backoff
+            raise ApcupsdError('cannot connect to %s:%d: %s' % (self.host, self.port, e))
+        self._sock = sock
+        self._reader = sock.makefile('rb')
+        self._backoff = 0.0
+        self._retry_at = 0.0
+        self.reconnects += 1
+
+    def _read_exactly(self, size):
+        data = self._reader.read(size)
+        if len(data) != size:
+            raise ApcupsdError('connection closed by %s:%d' % (self.host, self.port))
+        return data
+
+    def _exchange(self, command):
+        command = command.encode('ascii')
+        self._sock.sendall(struct.pack('>H', len(command)) + command)
+        records = []
+        while True:
+            size, = struct.unpack('>H', self._read_exactly(2))
+            if size == 0:
+                return records
+            records.append(self._read_exactly(size).decode('utf-8', 'replace').rstrip('\n'))
+
+    def command(self, command):
+        """Send a NIS command ('status' or 'events') and return its records."""
+        for attempt in (1, 2):
+            if self._sock is None:
+                self._connect()
+            try:
+                return self._exchange(command)
+            except (OSError, ApcupsdError) as e:
+                self.close()
+                # a kept-alive connection the server has dropped gets one
+                # retry on a fresh connection
+                if attempt == 2:
+                    raise ApcupsdError('%s failed: %s' % (command, e))
+
+    def status_values(self):
+        # every status field as a dict, see parse_status()
+        return parse_status(self.command('status'))
+
+    def status(self):
+        # the fields ampread uploads, see ups_status()
+        return ups_status(self.status_values())
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._reader.close()
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = None
+        self._reader = None
@@ -0,0 +1,137 @@
+# Per-channel PGA gain and sample counts that follow the load.
+#
+# Every channel used to get the same 200 reads at the gain written in
+# ampread.json. That gain has to be low enough for the biggest load the
+# circuit ever sees, so a 0.3A standby load uses a few counts of the ADC's
+# range, and a circuit that's off (or not even wired up) takes as much bus
+# time as the busy ones.
+#
+# AutoRanger looks at each channel's last readings and, for the next cycle:
+#   - steps the gain down straight away when the readings got near the top
+#     of the range (or clipped)
+#   - steps it up only after ``hold`` cycles in a row that would still fit
+#     comfortably at the next gain. Stepping up at ``low`` and down at
+#     ``high`` of full scale leaves a gap between the two, so a load sitting
+#     near a boundary doesn't flip back and forth.
+#   - gives a channel that has been under ``idle_amps`` for ``hold`` cycles
+#     only ``min_seconds`` worth of reads (two mains cycles by default), not
+#     none, so a load switching on is still seen on the next cycle
+#   - spends ``reinvest`` of the time that saves on the channels that are
+#     busy, more reads for them, up to ``max_samples``
+#
+# A cycle takes as long as the slowest ADC (see acquire.py), so as soon as
+# one circuit on each ADC is idle the cycle gets shorter.
+#
+# Gains and counts only change between cycles. The process stage needs the
+# gain and count each reading was taken with to turn it into amps, so the
+# acquire stage sends plan() along with the readings.
+
+import math
+
+import numpy as np
+
+from ampread.adc import GAIN_VOLTS, MODELS
+
+# PGA gains, lowest (widest range) first
+GAINS = tuple(sorted(GAIN_VOLTS))
+
+
+class _ADCState(object):
+    # one ADC's channels, each array has one entry per channel
+
+    def __init__(self, adc, samples, min_samples):
+        self.adc = adc
+        self.inputs = [c.input for c in adc.channels]
+        self.max_count = MODELS[adc.model][0]
+        self.samples = samples
+        self.min_samples = min_samples
+        channels = len(self.inputs)
+        self.gain = np.full(channels, GAINS.index(adc.gain), dtype=np.intp)
+        self.counts = np.full(channels, samples, dtype=np.intp)
+        self.quiet = np.zeros(channels, dtype=np.intp)   # cycles it would have fit at the next gain up
+        self.idle = np.zeros(channels, dtype=np.intp)    # cycles under idle_amps
+
+    def gains(self):
+        return [GAINS[k] for k in self.gain]
+
+
+class AutoRanger(object):
+    """Pick each channel's gain and sample count, see the top of the file.
+
+    ``registry`` is a built ChannelRegistry and ``acquisition`` the
+    Acquisition it returned. ``samples`` is the usual count per channel
+    (the config's "samples") and ``max_samples`` the most any channel gets,
+    which the buffers have to hold. ``min_gain`` and ``max_gain`` limit
+    the gains tried.
+    """
+
+    def __init__(self, registry, acquisition, samples=None, max_samples=None, min_seconds=0.04,
+                 idle_amps=0.1, hold=3, high=0.9, low=0.4, reinvest=0.5, min_gain=2 / 3, max_gain=16):
+        if low * 2 >= high:
+            # a step up doubles the readings (at most), they mustn't land over high
+            raise ValueError('low must be under half of high')
+        self.registry = registry
+        self.samplers = acquisition.samplers
+        samples = samples or registry.samples
+        self.max_samples = max_samples or registry.max_samples
+        self.idle_amps = idle_amps
+        self.hold = hold
+        self.high = high
+        self.low = low
+        self.reinvest = reinvest
+        self.lowest = GAINS.index(min_gain)
+        self.highest = GAINS.index(max_gain)
+        self.adcs = []
+        for adc in registry.adcs:
+            min_samples = min(max(int(math.ceil(adc.data_rate * min_seconds)), 16), samples)
+            self.adcs.append(_ADCState(adc, samples, min_samples))
+        self.apply()
+
+    def plan(self):
+        # ([gains], [counts]) for each ADC, in channel order, for the next cycle
+        return ([state.gains() for state in self.adcs],
+                [state.counts.tolist() for state in self.adcs])
+
+    def apply(self):
+        # hand the plan to the samplers, they use it from the next acquire()
+        for state, sampler in zip(self.adcs, self.samplers):
+            sampler.gains = dict(zip(state.inputs, state.gains()))
+            sampler.counts = dict(zip(state.inputs, state.counts.tolist()))
+
+    def update(self, frame):
+        """Look at the frame just taken with the current plan and make the next one."""
+        for state, buffer in zip(self.adcs, frame.buffers):
+            gains = np.array(state.gains())
+            counts = state.counts
+            scale = buffer.scale * state.adc.gain / gains
+            stats = buffer.analyze(counts=counts, scale=scale)
+
+            # the biggest reading each channel took, offset and all: that's what clips
+            data = np.abs(buffer.data[:, :counts.max()])
+            data[np.arange(data.shape[1]) >= counts[:, np.newaxis]] = 0
+            top = data.max(axis=1) / state.max_count
+
+            # down one as soon as it gets near the top, up one after hold cycles
+            # that would still be under low at the next gain
+            over = top >= self.high
+            up = np.minimum(state.gain + 1, self.highest)
+            ratio = np.array([GAINS[k] for k in up]) / gains
+            fits = ~over & (up > state.gain) & (top * ratio < self.low)
+            state.quiet = np.where(fits, state.quiet + 1, 0)
+            raise_gain = state.quiet >= self.hold
+            state.gain = np.where(over, np.maximum(state.gain - 1, self.lowest),
+                                  np.where(raise_gain, up, state.gain))
+            state.quiet[raise_gain] = 0
+
+            state.idle = np.where(stats.amps < self.idle_amps, state.idle + 1, 0)
+            self._counts(state)
+        self.apply()
+
+    def _counts(self, state):
+        idle = state.idle >= self.hold
+        busy = ~idle
+        state.counts = np.where(idle, state.min_samples, state.samples)
+        if busy.any() and idle.any():
+            saved = (state.samples - state.min_samples) * int(idle.sum())
+            extra = int(saved * self.reinvest / int(busy.sum()))
+            state.counts[busy] = min(state.samples + extra, self.max_samples)
@@ -0,0 +1,318 @@
+# Recompute kW, kWh, rate and cost for readings already in InfluxDB.
+#
+# When the rates change (or a bug in the kWh math turns up) the "voltage"
+# points already stored are stuck with the old numbers. This tool reads the
+# stored "current" and "voltage" points back a chunk of time at a time, works
+# out kilowatts, kWh, rate, TOU and cost/hour for the whole chunk at once with
+# NumPy, using the same tariff file and formulas as the live loop, and writes
+# the corrected "voltage" points back in bulk. Only the circuits that count
+# towards the total in ampread.json (--config) are added up for kW, the
+# same as the live loop.
+#
+#   python3 -m ampread.backfill --host 192.168.10.13 --start 2019-01-01 --end 2020-01-01
+#
+# The points are encoded straight from the arrays with a LineEncoder (see
+# lineprotocol.py) and posted as line protocol, a chunk at a time.
+#
+# A corrected point with the same tags and time as the old one simply
+# overwrites it. But the tou and tou_schedule tags can change along with the
+# rate, and tags are part of a point's identity in InfluxDB, so those old
+# points would be left behind next to their corrections. Once a chunk has
+# been written, the old copies of just those points are deleted. Nothing is
+# deleted before its replacement is safely in, so an error or Ctrl-C part
+# way leaves the history as it was (or half corrected), never missing.
+#
+# kwh_1h and kwh_1d (see retention.py) were worked out from the old points,
+# so afterwards the continuous queries are run again over the range that
+# was rewritten. Use --into to write to a different measurement and leave
+# the originals alone, or --dry-run to see the totals without writing
+# anything.
+
+import argparse
+import datetime
+import os
+import re
+import sys
+import time
+
+import numpy as np
+from influxdb import InfluxDBClient
+
+from ampread import power
+from ampread.config import load_config
+from ampread.lineprotocol import LineEncoder
+from ampread.retention import RAW_POLICY, energy_queries, materialize
+from ampread.tariff import load_tariff
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_TARIFF = os.path.join(HERE, 'tariffs', 'ontario_tou.json')
+DEFAULT_CONFIG = os.path.join(HERE, 'ampread.json')
+
+
+def fetch(client, measurement, start, end):
+    # (columns, rows) of every point in [start, end), times in Unix seconds
+    query = 'SELECT * FROM "%s" WHERE time >= %ds AND time < %ds' % (measurement, start, end)
+    result = client.query(query, epoch='s')
+    series = result.raw.get('series') or []
+    if not series:
+        return [], []
+    return series[0]['columns'], series[0]['values']
+
+
+def column(columns, rows, name, dtype=float):
+    # one column of a fetch() result as an array (missing values are NaN)
+    if name not in columns:
+        return np.full(len(rows), np.nan) if dtype is float else np.array([None] * len(rows), dtype=object)
+    j = columns.index(name)
+    return np.array([row[j] for row in rows], dtype=dtype)
+
+
+def total_amps(columns, rows, names=None):
+    # times and the total amps of the "current" points: the fields in
+    # ``names`` (the circuits that count towards the kW total), every amps*
+    # field if None
+    if names is None:
+        j = [i for i, c in enumerate(columns) if c.startswith('amps')]
+    else:
+        names = set(names)
+        j = [i for i, c in enumerate(columns) if c in names]
+    if not rows or not j:
+        return np.empty(0), np.empty(0)
+    times = column(columns, rows, 'time')
+    amps = np.array([[row[i] for i in j] for row in rows], dtype=float)
+    return times, np.nansum(amps, axis=1)
+
+
+def intervals(times, previous, max_gap, stored=None):
+    """Seconds covered by each reading: the time since the one before it.
+
+    ``previous`` is the time of the reading before the first one (None if
+    there isn't one). Gaps longer than ``max_gap`` (ampread wasn't running)
+    count as a typical interval instead of hours of energy at one reading.
+    ``stored`` are the "interval" fields the live loop wrote (NaN where a
+    point has none), used instead of the gap wherever there is one.
+    """
+    if not len(times):
+        return np.empty(0)
+    before = times[0] if previous is None else previous
+    gaps = np.diff(times, prepend=before)
+    normal = gaps[(gaps > 0) & (gaps <= max_gap)]
+    typical = float(np.median(normal)) if len(normal) else 0.0
+    gaps[gaps > max_gap] = typical
+    if stored is not None:
+        gaps = np.where(np.isnan(stored), gaps, stored)
+    return gaps
+
+
+def recompute(tariff, vtimes, volts, old_kw, ctimes, amps, previous, max_gap, places=2, interval=None):
+    """Work out kilowatts, kwh, rate, tou, schedule and cph for every voltage point.
+
+    Each voltage point is matched with the current point at the same time;
+    where there isn't one, the stored kilowatts are kept. ``interval`` are
+    the stored "interval" fields, see intervals().
+    """
+    if len(ctimes):
+        i = np.clip(np.searchsorted(ctimes, vtimes), 0, len(ctimes) - 1)
+        matched = ctimes[i] == vtimes
+        kw = np.where(matched, power.kilowatts(amps[i], volts, places), old_kw)
+    else:
+        kw = old_kw
+    kw = np.nan_to_num(kw)
+    kwh = power.kwh(kw, intervals(vtimes, previous, max_gap, interval))
+    rate, tou, schedule = tariff.rates_at(vtimes)
+    cph = power.cost_per_hour(kw, rate, places)
+    return {'kilowatts': kw, 'kwh': kwh, 'rate': rate, 'tou': tou,
+            'schedule': schedule, 'cph': cph}
+
+
+def encode_points(encoder, measurement, vtimes, volts, stale, result, interval=None, lateness=None):
+    # corrected voltage points, with the fields the live loop writes, into a
+    # LineEncoder. The stored interval and lateness go back as they were (NaN
+    # = the point had none, and a NaN or None field is left out).
+    n = len(vtimes)
+    if interval is None:
+        interval = np.full(n, np.nan)
+    if lateness is None:
+        lateness = np.full(n, np.nan)
+    fields = (('voltage', volts), ('rate', result['rate']), ('cph', result['cph']), ('kwh', result['kwh']),
+              ('cost', result['kwh'] * result['rate']), ('schedule', result['schedule']),
+              ('kilowatts', result['kilowatts']), ('voltage_stale', stale),
+              ('interval', interval), ('lateness', lateness))
+    tags = (('tou_schedule', result['schedule']), ('tou', result['tou']))
+    return encoder.add_columns(measurement, tags, fields, vtimes)
+
+
+def _quote(value):
+    return "'%s'" % str(value).replace('\\', '\\\\').replace("'", "\\'")
+
+
+def moved_series(vtimes, old_tou, old_schedule, result):
+    """Where the tags changed: (tou, tou_schedule, first, last) for each run
+    of points in a row that all moved out of the same old series.
+
+    Deleting first..last of that old series only hits points that have a
+    new copy somewhere else, since any point of it in between that kept its
+    tags would have broken the run.
+    """
+    changed = (old_tou != result['tou']) | (old_schedule != result['schedule'])
+    index = np.flatnonzero(changed)
+    runs = []
+    for i in index.tolist():
+        key = (old_tou[i], old_schedule[i])
+        if runs and runs[-1][4] == i - 1 and tuple(runs[-1][:2]) == key:
+            runs[-1][3] = vtimes[i]
+            runs[-1][4] = i
+        else:
+            runs.append([key[0], key[1], vtimes[i], vtimes[i], i])
+    return [(tou, schedule, first, last) for tou, schedule, first, last, _ in runs]
+
+
+def delete_moved(client, runs):
+    # delete the old copies moved_series() found. A point written without
+    # one of the tags has it as None, which InfluxQL matches as ''.
+    for tou, schedule, first, last in runs:
+        client.query('DELETE FROM "voltage" WHERE "tou" = %s AND "tou_schedule" = %s '
+                     'AND time >= %ds AND time <= %ds'
+                     % (_quote(tou or ''), _quote(schedule or ''), first, last))
+
+
+def refresh_rollups(client, queries, start, end, moved=False, log=print):
+    """Work the continuous queries' totals out again for [start, end).
+
+    The range is widened to whole buckets of each query, so none is written
+    from part of its readings. If points moved to other tou tags the old
+    totals are deleted first, or the old bands' totals would stay behind.
+    They are only ever made from the readings, so if this is cut short
+    running it (or ampread.retention --backfill-from) again puts them back.
+    """
+    for cq in queries:
+        if moved:
+            first = start - (start - cq.offset) % cq.period
+            last = end + (cq.offset - end) % cq.period
+            measurement = _INTO.search(cq.select).group(1)
+            client.query('DELETE FROM "%s" WHERE time >= %ds AND time < %ds' % (measurement, first, last))
+        materialize(client, [cq], start, end, log=log)
+
+
+# the measurement a continuous query writes to
+_INTO = re.compile(r'INTO \S*?"([^"]+)" FROM')
+
+
+def backfill(client, tariff, start, end, chunk=86400, max_gap=120.0, into=None,
+             dry_run=False, batch_size=5000, places=2, log=print, registry=None, rollups=None):
+    """Recompute every voltage point between Unix times start and end.
+
+    ``registry`` is the ChannelRegistry (see config.py) saying which
+    circuits count towards kW, like the live loop; without one every amps*
+    field does. ``rollups`` are the continuous queries (see retention.py)
+    to run again over the range afterwards, None to leave their totals
+    alone. Returns a dict of totals: points rewritten, kWh and cost by TOU
+    label.
+    """
+    names = None
+    if registry is not None:
+        names = [c.name for c in registry.channels if c.total]
+    measurement = into or 'voltage'
+    replace = measurement == 'voltage'
+    encoder = LineEncoder('s')
+    totals = {'points': 0, 'kwh': {}, 'cost': {}}
+    moved = False
+    previous = None
+    chunk_start = start
+    while chunk_start < end:
+        chunk_end = min(chunk_start + chunk, end)
+        ccols, crows = fetch(client, 'current', chunk_start, chunk_end)
+        vcols, vrows = fetch(client, 'voltage', chunk_start, chunk_end)
+        if vrows:
+            ctimes, amps = total_amps(ccols, crows, names)
+            vtimes = column(vcols, vrows, 'time')
+            volts = column(vcols, vrows, 'voltage')
+            stale = column(vcols, vrows, 'voltage_stale', dtype=object)
+            interval = column(vcols, vrows, 'interval')
+            lateness = column(vcols, vrows, 'lateness')
+            result = recompute(tariff, vtimes, volts, column(vcols, vrows, 'kilowatts'),
+                               ctimes, amps, previous, max_gap, places, interval)
+            previous = vtimes[-1]
+
+            for label in np.unique(result['tou']):
+                mask = result['tou'] == label
+                kwh = float(result['kwh'][mask].sum())
+                totals['kwh'][label] = totals['kwh'].get(label, 0.0) + kwh
+                cost = float((result['kwh'][mask] * result['rate'][mask]).sum())
+                totals['cost'][label] = totals['cost'].get(label, 0.0) + cost
+            totals['points'] += len(vtimes)
+
+            if not dry_run:
+                encode_points(encoder, measurement, vtimes, volts, stale, result, interval, lateness)
+                lines = encoder.take().decode('utf-8').splitlines()
+                client.write_points(lines, time_precision='s', batch_size=batch_size, protocol='line')
+                if replace:
+                    # only now that the corrections are in, remove the old
+                    # copies of the points whose tags changed
+                    runs = moved_series(vtimes, column(vcols, vrows, 'tou', dtype=object),
+                                        column(vcols, vrows, 'tou_schedule', dtype=object), result)
+                    delete_moved(client, runs)
+                    moved = moved or bool(runs)
+            log('%s  %6d points' % (datetime.datetime.fromtimestamp(chunk_start), len(vrows)))
+        chunk_start = chunk_end
+
+    if replace and not dry_run and totals['points']:
+        if rollups is None:
+            log('kwh_1h and kwh_1d still have the old totals, run python3 -m ampread.retention '
+                '--backfill-from %s to redo them' % datetime.date.fromtimestamp(start))
+        else:
+            refresh_rollups(client, rollups, start, end, moved, log)
+    return totals
+
+
+def _day(text):
+    return time.mktime(datetime.datetime.strptime(text, '%Y-%m-%d').timetuple())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python3 -m ampread.backfill',
+        description='Recompute kW, kWh, rate and cost for stored ampread voltage points')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8086)
+    parser.add_argument('--username', default='')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--database', default='ampread')
+    parser.add_argument('--tariff', default=DEFAULT_TARIFF, help='tariff file (default %(default)s)')
+    parser.add_argument('--config', default=DEFAULT_CONFIG,
+                        help='ADC and circuit config, for which circuits count towards kW (default %(default)s)')
+    parser.add_argument('--start', required=True, help='first day to recompute, YYYY-MM-DD')
+    parser.add_argument('--end', help='day to stop before, YYYY-MM-DD (default now)')
+    parser.add_argument('--chunk-hours', type=float, default=24.0,
+                        help='hours of points to read and write at a time (default 24)')
+    parser.add_argument('--max-gap', type=float, default=120.0,
+                        help='longest gap in seconds between readings that counts as energy (default 120)')
+    parser.add_argument('--raw-policy', default=RAW_POLICY,
+                        help='retention policy the readings are in, for the kWh totals (default %(default)s)')
+    parser.add_argument('--no-rollups', action='store_true',
+                        help="don't work kwh_1h and kwh_1d out again afterwards")
+    parser.add_argument('--into', help='write to this measurement instead of replacing "voltage"')
+    parser.add_argument('--dry-run', action='store_true', help='only print the totals')
+    args = parser.parse_args(argv)
+
+    start = _day(args.start)
+    end = _day(args.end) if args.end else time.time()
+    client = InfluxDBClient(args.host, args.port, args.username, args.password, args.database,
+                            timeout=120, retries=3)
+    tariff = load_tariff(args.tariff)
+    registry = load_config(args.config)
+    rollups = None if args.no_rollups else energy_queries(args.database, args.raw_policy)
+
+    began = time.monotonic()
+    totals = backfill(client, tariff, start, end, chunk=args.chunk_hours * 3600,
+                      max_gap=args.max_gap, into=args.into, dry_run=args.dry_run, registry=registry,
+                      rollups=rollups)
+    print('%d points in %.1fs%s' % (totals['points'], time.monotonic() - began,
+                                    ' (dry run, nothing written)' if args.dry_run else ''))
+    for label in sorted(totals['kwh']):
+        print('%-10s %12.3f kWh  %10.2f' % (label, totals['kwh'][label], totals['cost'][label]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,235 @@
+# Burst waveform capture and harmonic analysis.
+#
+# A normal cycle boils each channel down to one RMS number, which can't tell
+# a clean resistive load from a VFD or a room full of switch-mode power
+# supplies. Every so often (or when asked) BurstCapture grabs a fraction of
+# a second of every channel at the ADC's fastest data rate, keeps the
+# readings in a preallocated ring of the last few bursts, and
+# analyze_burst() works out with one FFT per ADC:
+#   - the mains frequency and the RMS amps of the fundamental
+#   - the RMS amps of each harmonic up to what the data rate can see
+#     (the 27th at 3300 samples/sec, only the 7th at 860)
+#   - THD (harmonic current / fundamental current) and crest factor
+#
+# From Python on a Pi the I2C reads can't always keep up with 3300 samples/sec,
+# and a late read means a gap. An FFT needs evenly spaced samples, so every
+# read is timestamped and the burst is interpolated onto an even grid at the
+# rate actually achieved before it goes in the ring.
+#
+# encode_waveform() packs a channel's readings small enough to store
+# with the results: 16 bit deltas, byte-shuffled and zlib compressed, which
+# is usually well under half the size of the raw int16 readings.
+
+import struct
+import time
+import zlib
+from collections import namedtuple
+
+import numpy as np
+
+from ampread.acquire import Acquisition
+from ampread.sampler import ContinuousSampler
+from ampread.waveform import WaveformBuffer
+
+# Results for one ADC's burst. Every field is an array with one entry per
+# channel, harmonics is (channels x orders) with order 1 the fundamental.
+# Anything the data can't tell us (a harmonic above the Nyquist frequency,
+# THD of an idle circuit) is NaN.
+#   frequency   - mains frequency in Hz
+#   fundamental - RMS amps at the mains frequency
+#   rms         - true RMS amps of the whole waveform
+#   peak        - highest current away from the DC offset
+#   crest       - peak / rms
+#   thd         - RMS of harmonics 2 and up / fundamental
+#   harmonics   - RMS amps of each harmonic
+HarmonicStats = namedtuple('HarmonicStats', ['frequency', 'fundamental', 'rms', 'peak', 'crest',
+                                             'thd', 'harmonics'])
+
+MAGIC = b'AMPW'
+VERSION = 1
+# magic, version, samples, sample rate, amps per count
+_HEADER = struct.Struct('<4sBIff')
+
+# The Hann window's main lobe is 2 bins either side of a tone, so summing
+# 5 bins gets all but a fraction of a percent of its power.
+_LOBE = np.arange(-2, 3)
+
+
+class Burst(object):
+    """One burst capture from one ADC.
+
+    ``data`` holds the readings (channels x samples, int16, evenly spaced),
+    ``rates`` the sample rate of each channel and ``scale`` its amps per
+    count, in the ADC's channel order from the config.
+    """
+
+    __slots__ = ('time', 'adc', 'names', 'data', 'rates', 'scale')
+
+    def __init__(self, time, adc, names, data, rates, scale):
+        self.time = time
+        self.adc = adc
+        self.names = names
+        self.data = data
+        self.rates = rates
+        self.scale = scale
+
+
+class BurstCapture(object):
+    """Burst-capture every ADC of a built ChannelRegistry.
+
+    Each ADC is read at its "burst_rate" for ``seconds`` per channel, all
+    ADCs at once. The last ``slots`` bursts are kept in a preallocated ring.
+    """
+
+    def __init__(self, registry, seconds=0.2, slots=4):
+        if registry.devices is None:
+            raise ValueError('build() the registry before making a BurstCapture')
+        self.registry = registry
+        self.seconds = seconds
+        self.slots = slots
+        self.captures = 0
+        readers = []
+        self.ring = []
+        for adc, device in zip(registry.adcs, registry.devices):
+            inputs = [c.input for c in adc.channels]
+            samples = max(int(seconds * adc.burst_rate), 16)
+            sampler = ContinuousSampler(device, adc.burst_rate, gain=adc.gain, channels=inputs)
+            buffer = WaveformBuffer(len(inputs), samples, adc.full_scale,
+                                    ct_amps=[c.ct_amps for c in adc.channels],
+                                    calibration=[c.calibration for c in adc.channels],
+                                    inputs=inputs, timestamps=True)
+            readers.append((sampler, buffer))
+            self.ring.append(np.zeros((slots, len(inputs), samples), dtype=np.int16))
+        self._samplers = [sampler for sampler, buffer in readers]
+        # the burst buffers are a different length for each ADC, acquire(None)
+        # fills each one to its own length
+        self.acquisition = Acquisition(readers)
+
+    def capture(self, gains=None):
+        """Take a burst on every ADC and return a list of Bursts, one per ADC.
+
+        ``gains`` are each ADC's channel gains (see AutoRanger.plan()), the
+        configured gain if None.
+        """
+        if gains is not None:
+            for sampler, g in zip(self._samplers, gains):
+                sampler.gains = dict(zip(sampler.channels, g))
+        frame = self.acquisition.acquire(None)
+        slot = self.captures % self.slots
+        self.captures += 1
+        bursts = []
+        for i, (adc, buffer) in enumerate(zip(self.registry.adcs, frame.buffers)):
+            ring = self.ring[i][slot]
+            rates = np.empty(len(adc.channels))
+            for row in range(len(adc.channels)):
+                # put each channel's readings on an even grid at its average rate
+                t = buffer.times[row] - buffer.times[row, 0]
+                grid = np.linspace(0.0, t[-1], len(t))
+                ring[row] = np.rint(np.interp(grid, t, buffer.data[row]))
+                rates[row] = (len(t) - 1) / t[-1] if t[-1] > 0 else adc.burst_rate
+            scale = np.broadcast_to(buffer.scale, (len(adc.channels),))
+            if gains is not None:
+                scale = scale * adc.gain / np.asarray(gains[i])
+            bursts.append(Burst(frame.time, adc.name, [c.name for c in adc.channels],
+                                ring.copy(), rates, scale.copy()))
+        return bursts
+
+    def latest(self, n=1):
+        # the readings of the last n bursts, newest first, one array per ADC
+        n = min(n, self.captures, self.slots)
+        slots = [(self.captures - 1 - k) % self.slots for k in range(n)]
+        return [ring[slots] for ring in self.ring]
+
+    def close(self):
+        self.acquisition.close()
+
+
+_windows = {}
+
+
+def _window(n):
+    # Hann window and the scale that turns |FFT|^2 into RMS^2 (one-sided),
+    # cached by length since a burst is the same length every time
+    if n not in _windows:
+        w = np.hanning(n)
+        _windows[n] = (w, 2.0 / (n * np.dot(w, w)))
+    return _windows[n]
+
+
+def analyze_burst(data, rates, scale, orders=31, min_amps=0.1, mains=(45.0, 65.0)):
+    """Harmonic analysis of one ADC's burst, see HarmonicStats.
+
+    ``data`` is (channels x samples) raw readings, ``rates`` the sample rate
+    of each channel and ``scale`` its amps per count. Harmonics 1 to
+    ``orders`` are measured where the data rate allows. THD is only worked
+    out for channels with at least ``min_amps`` of fundamental.
+    """
+    x = np.asarray(data, dtype=np.float64)
+    channels, n = x.shape
+    rates = np.asarray(rates, dtype=np.float64)
+    scale = np.asarray(scale, dtype=np.float64)
+    rows = np.arange(channels)[:, np.newaxis]
+
+    x = x - x.mean(axis=1)[:, np.newaxis]
+    peak = np.abs(x).max(axis=1) * scale
+    rms = np.sqrt(np.square(x).mean(axis=1)) * scale
+
+    window, norm = _window(n)
+    spectrum = np.fft.rfft(x * window, axis=1)
+    power = (spectrum.real ** 2 + spectrum.imag ** 2) * norm
+    bins = power.shape[1]
+    width = rates / n                       # Hz per bin, per channel
+
+    # the fundamental is the biggest bin in the mains band, refined to a
+    # fraction of a bin by fitting a parabola to the log power around it
+    freqs = np.arange(bins)[np.newaxis, :] * width[:, np.newaxis]
+    band = (freqs >= mains[0]) & (freqs <= mains[1])
+    k = np.where(band, power, -1.0).argmax(axis=1)
+    k = np.clip(k, 1, bins - 2)
+    a, b, c = (np.log(power[rows[:, 0], k + d] + 1e-30) for d in (-1, 0, 1))
+    denom = a - 2 * b + c
+    shift = np.divide(0.5 * (a - c), denom, out=np.zeros_like(denom), where=denom != 0)
+    frequency = (k + np.clip(shift, -0.5, 0.5)) * width
+
+    # power of each harmonic: sum the window's main lobe around where it should be
+    order = np.arange(1, orders + 1)
+    centre = np.rint(order[np.newaxis, :] * frequency[:, np.newaxis] / width[:, np.newaxis]).astype(int)
+    index = centre[:, :, np.newaxis] + _LOBE
+    seen = (index[:, :, 0] > 0) & (index[:, :, -1] < bins)
+    lobe = power[rows[:, :, np.newaxis], np.clip(index, 0, bins - 1)].sum(axis=2)
+    harmonics = np.where(seen, np.sqrt(lobe) * scale[:, np.newaxis], np.nan)
+
+    fundamental = harmonics[:, 0]
+    loaded = fundamental >= min_amps
+    distortion = np.sqrt(np.nansum(np.square(harmonics[:, 1:]), axis=1))
+    thd = np.full(channels, np.nan)
+    np.divide(distortion, fundamental, out=thd, where=loaded)
+    crest = np.divide(peak, rms, out=np.zeros_like(peak), where=rms > 0)
+    frequency = np.where(loaded, frequency, np.nan)
+    return HarmonicStats(frequency, fundamental, rms, peak, crest, thd, harmonics)
+
+
+def encode_waveform(samples, rate, scale, level=6):
+    """Pack one channel's int16 readings into bytes.
+
+    Neighbouring readings are close, so the differences between them are
+    small numbers whose high bytes are nearly all 0x00 or 0xff. Storing all
+    the low bytes then all the high bytes lets zlib squeeze those runs.
+    The differences wrap around in 16 bits, so decoding is exact.
+    """
+    samples = np.asarray(samples, dtype=np.int16)
+    deltas = np.empty_like(samples)
+    deltas[0] = samples[0]
+    np.subtract(samples[1:], samples[:-1], out=deltas[1:])
+    shuffled = deltas.astype('<i2').view(np.uint8).reshape(-1, 2).T.tobytes()
+    return _HEADER.pack(MAGIC, VERSION, len(samples), rate, scale) + zlib.compress(shuffled, level)
+
+
+def decode_waveform(blob):
+    """The (samples, rate, scale) encode_waveform() packed."""
+    magic, version, count, rate, scale = _HEADER.unpack_from(blob)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('not an ampread waveform')
+    shuffled = np.frombuffer(zlib.decompress(blob[_HEADER.size:]), dtype=np.uint8)
+    deltas = shuffled.reshape(2, count).T.copy().view('<i2').reshape(count)
+    return np.cumsum(deltas, dtype=np.int16), rate, scale
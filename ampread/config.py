@@ -0,0 +1,204 @@
+# The ADCs and circuits ampread reads, loaded from a config file.
+#
+# The two ADCs, their gains, the ampsA0 ... ampsB3 names and the full scale
+# numbers used to be written into the script, with a copy of the sampling
+# loop for each ADC. Now they're listed in a JSON file (see ampread.json) and
+# a ChannelRegistry builds the samplers, works out the amps and names the
+# InfluxDB fields from it, however many ADCs and buses there are.
+#
+#   {
+#     "samples": 200,
+#     "adcs": [
+#       {"name": "A", "model": "ADS1015", "address": "0x48", "bus": 1,
+#        "data_rate": 3300, "gain": 4, "full_scale": 2047,
+#        "channels": [
+#          {"input": 0, "name": "ampsA0", "ct_amps": 30, "calibration": 1.0},
+#          ...
+#        ]},
+#       ...
+#     ]
+#   }
+#
+# Per ADC: "model" is ADS1015 or ADS1115, "full_scale" is the reading that
+# equals the CT's rated current (2047 for an ads1015 at gain 4 with a 1V
+# SCT-013) and "burst_rate" the data rate for burst captures (the fastest
+# the chip does unless you set it). Per channel: "name" is the InfluxDB
+# field, "ct_amps" the CT's rating, "calibration" a multiplier to trim it
+# against a clamp meter, and "total": false leaves a circuit out of the kW
+# total (say, a sub-panel that's already counted on its feed). "simulate"
+# describes a made up load for --simulate runs:
+# {"amps": 4.5, "harmonics": {"3": 0.3}}.
+#
+# An "autorange" object at the top level lets each channel's gain and
+# sample count follow its load (see autorange.py), "gain" then being just
+# where every channel starts. Its keys are AutoRanger's arguments, e.g.
+# {"idle_amps": 0.1, "hold": 3, "max_samples": 400}; {} takes the defaults.
+
+import json
+
+import numpy as np
+
+from ampread.acquire import Acquisition
+from ampread.adc import MODELS, SimulatedLoad, open_adc
+from ampread.sampler import ContinuousSampler
+from ampread.waveform import WaveformBuffer
+
+
+class ConfigError(ValueError):
+    """The config file doesn't make sense."""
+
+
+class ChannelConfig(object):
+    __slots__ = ('name', 'adc', 'input', 'ct_amps', 'calibration', 'total', 'simulate')
+
+    def __init__(self, adc, spec):
+        self.adc = adc
+        try:
+            self.name = str(spec['name'])
+            self.input = int(spec['input'])
+        except KeyError as e:
+            raise ConfigError('ADC %s: a channel is missing %s' % (adc.name, e))
+        if not 0 <= self.input <= 3:
+            raise ConfigError('%s: input must be 0 to 3' % self.name)
+        self.ct_amps = float(spec.get('ct_amps', 30.0))
+        self.calibration = float(spec.get('calibration', 1.0))
+        self.total = bool(spec.get('total', True))
+        self.simulate = spec.get('simulate')
+
+    def simulated_load(self):
+        if not self.simulate:
+            return None
+        harmonics = dict((int(n), float(size))
+                         for n, size in (self.simulate.get('harmonics') or {}).items())
+        return SimulatedLoad(self.simulate.get('amps', 0.0), harmonics,
+                             noise=self.simulate.get('noise', 0.02))
+
+
+class ADCConfig(object):
+    __slots__ = ('name', 'model', 'address', 'bus', 'data_rate', 'burst_rate', 'gain', 'full_scale',
+                 'channels')
+
+    def __init__(self, spec, index):
+        self.name = str(spec.get('name', index))
+        self.model = str(spec.get('model', 'ADS1015')).upper()
+        if self.model not in MODELS:
+            raise ConfigError('ADC %s: unknown model %s' % (self.name, self.model))
+        max_count, data_rates, default_rate = MODELS[self.model]
+        address = spec.get('address', 0x48)
+        self.address = int(address, 0) if isinstance(address, str) else int(address)
+        self.bus = int(spec.get('bus', 1))
+        self.data_rate = int(spec.get('data_rate', max(data_rates)))
+        if self.data_rate not in data_rates:
+            raise ConfigError('ADC %s: %s data rate must be one of %s'
+                              % (self.name, self.model, ', '.join(str(r) for r in data_rates)))
+        # burst captures (see burst.py) run as fast as the chip goes unless told otherwise
+        self.burst_rate = int(spec.get('burst_rate', max(data_rates)))
+        if self.burst_rate not in data_rates:
+            raise ConfigError('ADC %s: burst_rate must be one of the %s data rates' % (self.name, self.model))
+        gain = spec.get('gain', 1)
+        self.gain = 2 / 3 if gain in ('2/3', 2 / 3) else int(gain)
+        self.full_scale = float(spec.get('full_scale', max_count))
+        self.channels = [ChannelConfig(self, c) for c in spec.get('channels', [])]
+        inputs = [c.input for c in self.channels]
+        if len(set(inputs)) != len(inputs):
+            raise ConfigError('ADC %s: the same input is listed twice' % self.name)
+
+
+class ChannelRegistry(object):
+    """Every ADC and circuit from a config dict (see the top of this file)."""
+
+    def __init__(self, config):
+        self.samples = int(config.get('samples', 200))
+        self.autorange = config.get('autorange')
+        if self.autorange is not None and not isinstance(self.autorange, dict):
+            raise ConfigError('autorange must be an object, {} for the defaults')
+        # what the buffers hold: room for busy channels to take more reads when autoranging
+        self.max_samples = self.samples
+        if self.autorange is not None:
+            self.max_samples = int(self.autorange.get('max_samples', 2 * self.samples))
+            if self.max_samples < self.samples:
+                raise ConfigError('autorange max_samples must be at least samples')
+        self.adcs = [ADCConfig(spec, i) for i, spec in enumerate(config.get('adcs', []))]
+        self.adcs = [adc for adc in self.adcs if adc.channels]
+        if not self.adcs:
+            raise ConfigError('no ADC channels configured')
+        self.channels = [c for adc in self.adcs for c in adc.channels]
+        self.names = [c.name for c in self.channels]
+        if len(set(self.names)) != len(self.names):
+            raise ConfigError('channel names must be unique')
+        seen = set()
+        for adc in self.adcs:
+            if (adc.bus, adc.address) in seen:
+                raise ConfigError('two ADCs at address 0x%02x on bus %d' % (adc.address, adc.bus))
+            seen.add((adc.bus, adc.address))
+        self.buffers = None
+        self.devices = None
+
+    def build(self, simulate=False, samples=None, **simulated):
+        """Open every ADC and return an Acquisition sampling all of them.
+
+        ``simulate`` uses SimulatedADCs with each channel's "simulate" load;
+        extra keyword arguments are passed on to SimulatedADC.
+        """
+        samples = samples or self.max_samples
+        samplers = []
+        self.devices = []
+        for adc in self.adcs:
+            loads = [None] * 4
+            for c in adc.channels:
+                loads[c.input] = c.simulated_load()
+            device = open_adc(adc.model, address=adc.address, busnum=adc.bus,
+                              simulate=simulate, loads=loads, **simulated)
+            sampler = ContinuousSampler(device, adc.data_rate, gain=adc.gain,
+                                        channels=[c.input for c in adc.channels])
+            samplers.append(sampler)
+            self.devices.append(device)
+        return Acquisition(zip(samplers, self.make_buffers(samples)))
+
+    def make_buffers(self, samples=None):
+        """A WaveformBuffer for each ADC, scaled for its channels.
+
+        build() calls this. Call it on its own to analyze readings that were
+        taken somewhere else (e.g. in another process).
+        """
+        samples = samples or self.max_samples
+        self.buffers = [WaveformBuffer(len(adc.channels), samples, adc.full_scale,
+                                       ct_amps=[c.ct_amps for c in adc.channels],
+                                       calibration=[c.calibration for c in adc.channels],
+                                       inputs=[c.input for c in adc.channels])
+                        for adc in self.adcs]
+        return self.buffers
+
+    def analyze(self, frame=None, gains=None, counts=None):
+        """ChannelStats for every ADC, in self.adcs order.
+
+        ``gains`` and ``counts`` are what each channel was read with when
+        they weren't the config's gain and samples, see AutoRanger.plan().
+        """
+        buffers = frame.buffers if frame is not None else self.buffers
+        if gains is None:
+            return [buffer.analyze() for buffer in buffers]
+        return [buffer.analyze(counts=n, scale=buffer.scale * adc.gain / np.asarray(g))
+                for adc, buffer, g, n in zip(self.adcs, buffers, gains, counts)]
+
+    def amps(self, frame=None, places=2, gains=None, counts=None):
+        """Dict of channel name -> true RMS amps, in config order."""
+        amps = {}
+        for adc, stats in zip(self.adcs, self.analyze(frame, gains, counts)):
+            for c, a in zip(adc.channels, stats.amps):
+                amps[c.name] = round(float(a), places)
+        return amps
+
+    def total_amps(self, amps):
+        # sum of the channels that count towards the kW total
+        return sum(amps[c.name] for c in self.channels if c.total)
+
+
+def load_config(path):
+    """Load a ChannelRegistry from a JSON config file."""
+    with open(path) as f:
+        try:
+            config = json.load(f)
+        except ValueError as e:
+            raise ConfigError('%s: %s' % (path, e))
+    return ChannelRegistry(config)
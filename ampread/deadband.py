@@ -0,0 +1,155 @@
+# Report by exception: only write readings that have moved.
+#
+# Most circuits sit flat for hours, but every cycle used to write every
+# circuit's amps and the whole voltage point whether anything changed or
+# not. With ReportByException the process stage writes:
+#
+#   current - only the circuits whose amps moved more than their deadband
+#             since they were last written
+#   voltage - the whole point, when the voltage, kW, rate or voltage_stale
+#             moved past theirs
+#
+# A deadband is either absolute (0.1 = a tenth of an amp, 1.0 = a volt) or
+# relative to the value last written ('5%'). Fields without one are written
+# whenever they change at all. Every field is written at least every
+# ``heartbeat`` seconds regardless, so a quiet circuit still shows up and
+# "no point" never has to mean "no data".
+#
+# The energy isn't sampled, it's integrated: each cycle's kWh is what was
+# used since the last one, and kwh_1h (see retention.py) is the sum of
+# them. So the kWh and cost of the cycles that aren't written add up and
+# go out with the next voltage point, along with the total seconds they
+# cover as "interval". That point is also forced out before the hour or
+# the TOU band changes, stamped with the last cycle before the change, so
+# every kWh is still summed into the right hour and band.
+#
+# The rollups (see rollup.py) still see every cycle. Dashboards reading the
+# raw points should fill(previous) rather than expect one every cycle.
+
+import math
+
+from ampread.points import write_current, write_voltage
+
+# voltage point fields that decide when it is written
+_VOLTAGE_FIELDS = ('voltage', 'kilowatts', 'rate', 'voltage_stale')
+
+
+def parse_deadband(band):
+    # 0.1 -> (0.1, 0.0), '5%' -> (0.0, 0.05), as (absolute, relative)
+    if isinstance(band, str) and band.strip().endswith('%'):
+        return 0.0, float(band.strip()[:-1]) / 100.0
+    return float(band), 0.0
+
+
+class Deadband(object):
+    """Which of a series' fields have moved enough to be written again.
+
+    ``default`` is the deadband for fields not in ``deadbands`` (a dict of
+    field -> deadband), None to write them on any change.
+    """
+
+    def __init__(self, default=None, deadbands=None, heartbeat=300.0):
+        self.default = parse_deadband(default) if default is not None else None
+        self.deadbands = dict((name, parse_deadband(band)) for name, band in (deadbands or {}).items())
+        self.heartbeat = heartbeat
+        self.last = {}      # field -> value last written
+        self._next = None   # when everything is written again
+
+    def _moved(self, name, last, value):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return value != last
+        if math.isnan(value) or math.isnan(last):
+            return not (math.isnan(value) and math.isnan(last))
+        band = self.deadbands.get(name, self.default)
+        if band is None:
+            return value != last
+        absolute, relative = band
+        return abs(value - last) > max(absolute, relative * abs(last))
+
+    def moved(self, seconds, fields):
+        """The (name, value) pairs of ``fields`` (a dict or pairs) to write
+        now, every one of them if the heartbeat is due. They are taken as
+        written."""
+        if isinstance(fields, dict):
+            fields = fields.items()
+        beat = self._next is None or seconds >= self._next
+        if beat:
+            self._next = seconds + self.heartbeat
+        result = []
+        last = self.last
+        for name, value in fields:
+            if beat or name not in last or self._moved(name, last[name], value):
+                last[name] = value
+                result.append((name, value))
+        return result
+
+    def written(self, fields):
+        # take these as written without asking, say when something else forced the write
+        self.last.update(fields)
+
+    def reset(self):
+        # everything goes out next time
+        self.last.clear()
+        self._next = None
+
+
+class ReportByException(object):
+    """Write the current and voltage points by exception, see the top of the file.
+
+    ``amps`` is the deadband for every circuit and ``deadbands`` any
+    per-field ones (circuit names or voltage, kilowatts and rate).
+    ``written`` and ``skipped`` count the amps that were and weren't
+    written, and the voltage points, each of those counting as one.
+    """
+
+    def __init__(self, heartbeat=300.0, amps=None, deadbands=None):
+        self.current = Deadband(amps, deadbands, heartbeat)
+        self.voltage = Deadband(None, deadbands, heartbeat)
+        self.written = 0
+        self.skipped = 0
+        # the voltage point not written yet: (hour, tou, schedule), the
+        # write_voltage() arguments of its last cycle, and its kWh and seconds so far
+        self._key = None
+        self._last = None
+        self._kwh = 0.0
+        self._interval = 0.0
+
+    def write(self, encoder, seconds, schedule, tou, amps, voltage, rate, cph, kwh, kilowatts,
+              voltage_stale=False, interval=None, lateness=None):
+        """One cycle's readings, write_current() and write_voltage()'s arguments."""
+        key = (int(seconds // 3600), tou, schedule)
+        if self._key is not None and key != self._key:
+            # the kWh so far belong to the last hour or TOU band, write them there.
+            # The new band is a new series, so start it off with everything.
+            self.flush(encoder)
+            self.current.reset()
+            self.voltage.reset()
+        self._key = key
+
+        fields = self.current.moved(seconds, amps)
+        if fields:
+            write_current(encoder, seconds, schedule, tou, fields)
+        self.written += len(fields)
+        self.skipped += len(amps) - len(fields)
+
+        self._kwh += kwh
+        self._interval += interval if interval is not None else 0.0
+        self._last = (seconds, schedule, tou, voltage, rate, cph, kilowatts, voltage_stale, lateness)
+        if self.voltage.moved(seconds, (('voltage', voltage), ('kilowatts', kilowatts), ('rate', rate),
+                                        ('voltage_stale', voltage_stale))):
+            self.flush(encoder)
+        else:
+            self.skipped += 1
+
+    def flush(self, encoder):
+        """Write the voltage point (and the kWh) still waiting, if there is one."""
+        if self._last is None:
+            return
+        seconds, schedule, tou, voltage, rate, cph, kilowatts, voltage_stale, lateness = self._last
+        write_voltage(encoder, seconds, schedule, tou, voltage, rate, cph, self._kwh, kilowatts,
+                      voltage_stale, self._interval, lateness)
+        self.voltage.written(zip(_VOLTAGE_FIELDS, (voltage, kilowatts, rate, voltage_stale)))
+        self.written += 1
+        self._last = None
+        self._kwh = 0.0
+        self._interval = 0.0
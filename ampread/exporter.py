@@ -0,0 +1,157 @@
+# Serve the latest readings to Prometheus (or anything that reads OpenMetrics).
+#
+# Seeing what a circuit is drawing right now used to mean a query to
+# influxdb. MetricsExporter runs a small HTTP server in a thread of its own
+# and answers GET /metrics from the last cycle's readings, kept in memory:
+#
+#   ampread_current_amperes{circuit}      true RMS amps of each circuit
+#   ampread_power_kilowatts               total kW
+#   ampread_voltage_volts                 line voltage (ampread_voltage_stale 1
+#                                         when it is the nominal stand-in)
+#   ampread_rate_dollars_per_kwh{tou}     TOU rate right now
+#   ampread_energy_kwh_total{tou}         kWh since ampread started, per TOU band
+#   ampread_cost_dollars_total{tou}       what that cost
+#   ampread_ups_*                         UPS load, charge, runtime and voltage
+#   ampread_last_reading_timestamp_seconds
+#
+# The process stage builds a new Snapshot each cycle and publish() just
+# swaps it in (one reference assignment, like UPSPoller does), so the
+# cycle never waits on a scrape or the other way round. The text is only
+# rendered when something asks for it.
+#
+# Scrapers that ask for application/openmetrics-text get OpenMetrics, the
+# rest the older Prometheus text format.
+#
+#   scrape_configs:
+#     - job_name: ampread
+#       static_configs:
+#         - targets: ['raspberrypi:9712']
+
+import threading
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# One cycle's readings, see publish().
+#   time        - wall clock time of the cycle
+#   amps        - dict of circuit -> amps
+#   kilowatts, voltage, voltage_stale, rate, tou, schedule
+#   kwh, cost   - dicts of TOU band -> running totals
+#   ups         - the UPS values dict, {} if there's no fresh reading
+Snapshot = namedtuple('Snapshot', ['time', 'amps', 'kilowatts', 'voltage', 'voltage_stale', 'rate', 'tou',
+                                   'schedule', 'kwh', 'cost', 'ups'])
+
+OPENMETRICS = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+PROMETHEUS = 'text/plain; version=0.0.4; charset=utf-8'
+
+# UPS values -> (metric, help)
+_UPS_METRICS = (('LOAD', 'ampread_ups_load_percent', 'UPS load.'),
+                ('BCHG', 'ampread_ups_battery_charge_percent', 'UPS battery charge.'),
+                ('TIMELEFT', 'ampread_ups_runtime_minutes', 'UPS runtime left on battery.'),
+                ('LINEV', 'ampread_ups_input_volts', 'Input voltage the UPS sees.'))
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')
+                                          .replace('\n', '\\n'))
+                             for k, v in labels)
+
+
+def _number(value):
+    if value is True or value is False:
+        return '1' if value else '0'
+    return repr(float(value))
+
+
+def families(snapshot):
+    """The metrics in a Snapshot as (name, type, help, [(labels, value)]),
+    labels being (name, value) pairs. Counters are named without _total."""
+    s = snapshot
+    result = [
+        ('ampread_current_amperes', 'gauge', 'True RMS current of each circuit.',
+         [((('circuit', name),), amps) for name, amps in sorted(s.amps.items())]),
+        ('ampread_power_kilowatts', 'gauge', 'Total power of all circuits.', [((), s.kilowatts)]),
+        ('ampread_voltage_volts', 'gauge', 'Line voltage used for the power.', [((), s.voltage)]),
+        ('ampread_voltage_stale', 'gauge', '1 if the UPS reading was too old and the voltage is nominal.',
+         [((), s.voltage_stale)]),
+        ('ampread_rate_dollars_per_kwh', 'gauge', 'Time of use rate right now.',
+         [((('tou', s.tou), ('tou_schedule', s.schedule)), s.rate)]),
+        ('ampread_energy_kwh', 'counter', 'Energy used since ampread started, per TOU band.',
+         [((('tou', tou),), kwh) for tou, kwh in sorted(s.kwh.items())]),
+        ('ampread_cost_dollars', 'counter', 'Cost of that energy, per TOU band.',
+         [((('tou', tou),), cost) for tou, cost in sorted(s.cost.items())]),
+        ('ampread_last_reading_timestamp_seconds', 'gauge', 'When the readings were taken.',
+         [((), s.time)]),
+    ]
+    if s.ups:
+        for key, name, text in _UPS_METRICS:
+            if s.ups.get(key) is not None:
+                result.append((name, 'gauge', text, [((), s.ups[key])]))
+        result.append(('ampread_ups_info', 'gauge', 'UPS model and status.',
+                       [((('model', s.ups.get('UPSMODEL', '')), ('status', s.ups.get('STATUS', ''))), 1)]))
+    return result
+
+
+def render(snapshot, openmetrics=True):
+    # the exposition text for a Snapshot, OpenMetrics or Prometheus 0.0.4
+    lines = []
+    if snapshot is not None:
+        for name, kind, text, samples in families(snapshot):
+            sample_name = name + '_total' if kind == 'counter' else name
+            # the old format puts the counter's sample name on TYPE and HELP
+            family = name if openmetrics else sample_name
+            lines.append('# HELP %s %s' % (family, text))
+            lines.append('# TYPE %s %s' % (family, kind))
+            for labels, value in samples:
+                lines.append('%s%s %s' % (sample_name, _labels(labels), _number(value)))
+    if openmetrics:
+        lines.append('# EOF')
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        openmetrics = 'application/openmetrics-text' in (self.headers.get('Accept') or '')
+        body = render(self.server.exporter.latest, openmetrics)
+        self.send_response(200)
+        self.send_header('Content-Type', OPENMETRICS if openmetrics else PROMETHEUS)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsExporter(object):
+    """Serve the latest published Snapshot on http://host:port/metrics."""
+
+    def __init__(self, port=9712, host=''):
+        self.port = port
+        self.host = host
+        self.latest = None
+        self._httpd = None
+
+    def start(self):
+        self._httpd = ThreadingHTTPServer((self.host, self.port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.exporter = self
+        thread = threading.Thread(target=self._httpd.serve_forever, name='ampread-metrics')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def publish(self, snapshot):
+        # swap in the newest readings, scrapes already running keep the old ones
+        self.latest = snapshot
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
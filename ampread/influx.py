@@ -0,0 +1,328 @@
+# One long-lived InfluxDB connection with a buffered, batched writer.
+#
+# The script used to make a new InfluxDBClient (and call create_database) for
+# every write_points call, three times a cycle, and a slow or dead InfluxDB
+# held up the sampling loop until it timed out. InfluxWriter keeps one client
+# for the life of the program (so HTTP keep-alive reuses the connection),
+# creates the databases once, and hands the points to a background thread
+# that sends them in batches, either when enough have piled up or when the
+# oldest one has waited long enough.
+#
+# Points wait either in memory (MemoryQueue) or, if you give the writer an
+# ampread.spool.Spool, on disk so they survive InfluxDB outages and restarts.
+# Both work the same way: read() the oldest points, send them, then commit()
+# so they're only forgotten once InfluxDB has them.
+#
+# Either way the points wait as line protocol. write() takes point dicts or
+# the bytes a LineEncoder (ampread/lineprotocol.py) made, and with gzip=True
+# the batches go to InfluxDB gzip compressed, which shrinks the repetitive
+# line protocol several times over.
+#
+# Only failures that might go away are retried: no connection, a timeout, a
+# 5xx. A 400 means InfluxDB won't ever take that batch (a line it can't
+# parse, a field that was a float and is now a string...), and retrying it
+# would hold up everything queued behind it for good. A 413 means the batch
+# is too big, which a replay after a long outage can easily be. Either way
+# the batch is split in half and each half sent on its own, down to single
+# points, so one bad line only costs itself and a big backlog still gets
+# through. A single point that is still refused is counted in
+# ``rejected``, handed to the queue's quarantine() (the spool keeps it in a
+# file, memory just forgets it) and skipped. Errors that are about the
+# server's setup rather than the points (401, 403, 404...) are retried like
+# an outage, so a wrong password doesn't lose any data.
+#
+# InfluxDB's continuous queries only look back so far (see retention.py),
+# so readings replayed after a longer outage would never make it into the
+# kWh totals. The writer notes the time span of any points older than
+# ``late_after`` seconds it writes, and once it has caught up hands that
+# span to ``replayed`` to work the totals out again.
+
+import threading
+import time
+
+from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+
+from ampread.lineprotocol import PRECISIONS, LineEncoder
+
+# What a failed write can raise. requests' ConnectionError and Timeout are
+# both IOErrors.
+WRITE_ERRORS = (IOError, InfluxDBClientError, InfluxDBServerError)
+
+# 4xx responses that say nothing about the points themselves, so are retried
+RETRY_CODES = (401, 403, 404, 408, 429)
+
+
+def rejected(error):
+    # True if InfluxDB will never accept the points that got this error
+    if not isinstance(error, InfluxDBClientError) or isinstance(error, InfluxDBServerError):
+        return False
+    code = getattr(error, 'code', None)
+    return code is not None and 400 <= code < 500 and code not in RETRY_CODES
+
+
+class MemoryQueue(object):
+    """Line protocol points waiting in memory, at most ``max_points`` (oldest dropped first)."""
+
+    persistent = False
+
+    def __init__(self, max_points=100000):
+        self.max_points = max_points
+        self.dropped_records = 0
+        self._items = []    # (database, point) in the order they were written
+        self._base = 0      # how many items have ever been removed from the front
+        self._lock = threading.Lock()
+
+    def append(self, database, points):
+        with self._lock:
+            self._items.extend((database, p) for p in points)
+            overflow = len(self._items) - self.max_points
+            if overflow > 0:
+                del self._items[:overflow]
+                self._base += overflow
+                self.dropped_records += overflow
+
+    def read(self, max_records):
+        with self._lock:
+            items = self._items[:max_records]
+            position = self._base + len(items)
+        batches = {}
+        for database, point in items:
+            batches.setdefault(database, []).append(point)
+        return list(batches.items()), position
+
+    def commit(self, position):
+        with self._lock:
+            done = position - self._base
+            if done > 0:
+                del self._items[:done]
+                self._base += done
+
+    def __len__(self):
+        return len(self._items)
+
+    def quarantine(self, database, points):
+        # nowhere to keep them, InfluxWriter has counted them as rejected
+        pass
+
+    def close(self):
+        pass
+
+
+class InfluxWriter(object):
+    """Queue points and write them to InfluxDB in batches from a thread.
+
+    ``batch_size`` points or ``max_age`` seconds, whichever comes first,
+    triggers a flush. If InfluxDB can't be reached the points stay queued
+    and are retried, waiting up to ``max_backoff`` seconds between tries.
+    Once it's back, the backlog is sent ``replay_batch`` points per request,
+    one request at a time, until it's caught up.
+
+    ``queue`` defaults to a MemoryQueue holding ``max_buffer`` points; pass
+    an ampread.spool.Spool to keep them on disk instead.
+
+    Timestamps are sent in ``precision`` ('n', 'u', 'ms' or 's'), which is
+    also what write() expects of line protocol it is given. ``latency`` is
+    an optional ampread.telemetry.Histogram of the write request times.
+
+    Points for ``database`` go into its ``retention_policy`` (None for the
+    database's default). ``replayed(start, end)`` is called from the writer
+    thread, once it's caught up, with the epoch seconds spanned by the
+    points for ``database`` that were more than ``late_after`` seconds old
+    when they were written.
+    """
+
+    def __init__(self, host='localhost', port=8086, username='', password='',
+                 database='ampread', batch_size=500, max_age=30.0, max_buffer=100000,
+                 max_backoff=300.0, replay_batch=5000, timeout=10, retries=3,
+                 precision='n', gzip=False, client=None, queue=None, latency=None,
+                 retention_policy=None, replayed=None, late_after=3600.0):
+        if client is None:
+            client = InfluxDBClient(host, port, username, password, database,
+                                    timeout=timeout, retries=retries, gzip=gzip)
+        if queue is None:
+            queue = MemoryQueue(max_buffer)
+        self.client = client
+        self.queue = queue
+        self.database = database
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.max_backoff = max_backoff
+        self.replay_batch = replay_batch
+        self.precision = precision
+        self.latency = latency
+        self.retention_policy = retention_policy
+        self.replayed = replayed
+        self.late_after = late_after
+        self.encoder = LineEncoder(precision)
+
+        self.written = 0
+        self.failures = 0
+        self.requests = 0
+        self.rejected = 0
+        self.last_error = None
+
+        self._waiting = 0           # points queued since the last flush
+        self._oldest = None         # time.monotonic() of the oldest of those
+        self._created = set()       # databases we've already made sure exist
+        self._late = None           # [first, last] epoch seconds of late points written
+        self._backoff = 0.0
+        self._retry_at = 0.0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._thread = threading.Thread(target=self._run, name='ampread-influx')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def dropped(self):
+        return self.queue.dropped_records
+
+    def write(self, points, database=None):
+        # Queue points (dicts, or line protocol bytes) for writing. Never
+        # blocks on the network. With a spool the points are on disk by the
+        # time this returns. Call from one thread only.
+        database = database or self.database
+        if isinstance(points, bytes):
+            points = points.decode('utf-8').splitlines()
+        else:
+            points = self.encoder.lines(points)
+        self.queue.append(database, points)
+        with self._lock:
+            self._waiting += len(points)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            if self._waiting >= self.batch_size:
+                self._wake.notify()
+
+    def pending(self):
+        # points waiting in memory, or bytes waiting in the spool
+        if hasattr(self.queue, 'pending_bytes'):
+            return self.queue.pending_bytes()
+        return len(self.queue)
+
+    def flush(self):
+        # Send everything queued right now. Returns True if it all went.
+        with self._lock:
+            self._waiting = 0
+            self._oldest = None
+        while True:
+            batches, position = self.queue.read(self.replay_batch)
+            if not batches:
+                self._caught_up()
+                return True
+            for database, points in batches:
+                if not self._send(database, points):
+                    return False
+            self.queue.commit(position)
+            if self._closed and self.queue.persistent:
+                # don't hold up shutdown replaying a big backlog, it's safe on disk
+                self._caught_up()
+                return True
+
+    def _stamp(self, line):
+        # a point's epoch seconds, None if it has no timestamp
+        stamp = line.rpartition(' ')[2]
+        if not stamp.isdigit():
+            return None
+        return int(stamp) / float(PRECISIONS[self.precision])
+
+    def _note_late(self, points):
+        # Points are queued in the order they were taken, so the first and
+        # last of a batch are enough to tell whether it's late and its span.
+        first = self._stamp(points[0])
+        if first is None or first >= time.time() - self.late_after:
+            return
+        last = self._stamp(points[-1])
+        last = first if last is None else max(first, last)
+        if self._late is None:
+            self._late = [first, last]
+        else:
+            self._late = [min(self._late[0], first), max(self._late[1], last)]
+
+    def _caught_up(self):
+        late, self._late = self._late, None
+        if late is not None and self.replayed is not None:
+            self.replayed(late[0], late[1])
+
+    def _send(self, database, points):
+        # Write one database's points in a single request, or in halves if
+        # InfluxDB won't take them all at once. True if they're done with
+        # (written, or rejected for good), False to try again later. Points
+        # a half already wrote are just written again then, which overwrites
+        # them with the same values.
+        try:
+            if database not in self._created:
+                self.requests += 1
+                self.client.create_database(database)
+                self._created.add(database)
+            self.requests += 1
+            started = time.monotonic()
+            self.client.write_points(points, time_precision=None if self.precision == 'n' else self.precision,
+                                     database=database, protocol='line',
+                                     retention_policy=self.retention_policy if database == self.database else None)
+            if self.latency is not None:
+                self.latency.observe(time.monotonic() - started)
+            self.written += len(points)
+            if self.replayed is not None and database == self.database:
+                self._note_late(points)
+        except WRITE_ERRORS as e:
+            self.last_error = e
+            if rejected(e):
+                if len(points) > 1:
+                    half = len(points) // 2
+                    return self._send(database, points[:half]) and self._send(database, points[half:])
+                self.rejected += len(points)
+                self.queue.quarantine(database, points)
+                print('ampread: influxdb rejected a point for %s, skipping it: %s' % (database, e))
+                return True
+            self.failures += 1
+            return False
+        return True
+
+    def _due(self, now):
+        if now < self._retry_at:
+            return False
+        if self._retry_at:
+            # retry time after a failure has come round
+            return True
+        if self._oldest is None:
+            return False
+        return self._waiting >= self.batch_size or now - self._oldest >= self.max_age
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._closed and not self._due(time.monotonic()):
+                    now = time.monotonic()
+                    wait = self.max_age
+                    if self._oldest is not None:
+                        wait = max(self._oldest + self.max_age - now, 0.01)
+                    if self._retry_at > now:
+                        wait = self._retry_at - now
+                    self._wake.wait(wait)
+                if self._closed:
+                    return
+            if self.flush():
+                self._backoff = 0.0
+                self._retry_at = 0.0
+            else:
+                # InfluxDB is down, wait a bit longer each time before retrying
+                self._backoff = min(max(self._backoff * 2, 1.0), self.max_backoff)
+                self._retry_at = time.monotonic() + self._backoff
+
+    def close(self, flush=True):
+        # Stop the writer thread and (by default) make one last attempt to
+        # write whatever is still queued. Anything in a spool that doesn't
+        # make it is sent next time.
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._wake.notify()
+        self._thread.join()
+        if flush:
+            self.flush()
+        self.queue.close()
+        self.client.close()
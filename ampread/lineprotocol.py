@@ -0,0 +1,282 @@
+# InfluxDB line protocol without the dicts.
+#
+# Each point used to be built as a nested dict with an ISO timestamp string,
+# and influxdb-python's make_lines() then took it apart again: sorted and
+# escaped every tag and field name, parsed the timestamp back into a
+# datetime and worked out the nanoseconds. For the handful of series
+# ampread writes that is almost all wasted work, since the measurement and
+# tags are the same from one cycle to the next.
+#
+# LineEncoder writes the lines straight into one bytearray:
+#   - "measurement,tag=value,..." is escaped once per series and cached
+#   - "field=" is escaped once per field name and cached
+#   - timestamps are integers in the writer's precision, worked out from the
+#     epoch seconds we already have ('s' is 10 digits instead of 19)
+#
+# Precision has to match what InfluxWriter sends as the write's precision,
+# so both come from the same setting. The spool stores lines as they were
+# encoded, so let it drain before changing the precision.
+#
+# Each part is escaped the way line protocol wants it and no more:
+#   measurement                     - comma and space
+#   tag keys and values, field keys - comma, equals and space
+#   string field values             - double quote and backslash
+# A point is one line everywhere (the spool, the batches), so a newline
+# anywhere becomes a space rather than ending the line.
+#
+# parse_line() goes the other way, for sinks that aren't InfluxDB.
+
+import calendar
+import math
+import re
+import time
+
+# precision -> units per second
+PRECISIONS = {'n': 10 ** 9, 'u': 10 ** 6, 'ms': 10 ** 3, 's': 1}
+
+
+def _one_line(text):
+    return text.replace('\r\n', ' ').replace('\n', ' ').replace('\r', ' ')
+
+
+def escape_measurement(text):
+    text = str(text)
+    if '\n' in text or '\r' in text:
+        text = _one_line(text)
+    if ' ' in text or ',' in text:
+        text = text.replace(',', '\\,').replace(' ', '\\ ')
+    return text
+
+
+def escape(text):
+    # tag key, tag value or field key
+    text = str(text)
+    if '\n' in text or '\r' in text:
+        text = _one_line(text)
+    if ' ' in text or ',' in text or '=' in text:
+        text = text.replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+    return text
+
+
+def field_value(value):
+    # The text of one field value, or None to leave the field out (None, NaN
+    # and infinity, which InfluxDB would reject along with the whole batch).
+    if value is None:
+        return None
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, int):
+        return '%di' % value
+    if isinstance(value, float):
+        if math.isnan(value) or math.isinf(value):
+            return None
+        return repr(value)
+    if isinstance(value, str):
+        value = value.replace('\\', '\\\\').replace('"', '\\"')
+        if '\n' in value or '\r' in value:
+            value = _one_line(value)
+        return '"%s"' % value
+    # numpy numbers and the like
+    return field_value(float(value))
+
+
+def iso_seconds(iso):
+    # '2019-03-01T12:00:00.123456Z' (what the point builders make) -> epoch seconds
+    if iso.endswith('Z'):
+        iso = iso[:-1]
+    whole, _, fraction = iso.partition('.')
+    seconds = calendar.timegm(time.strptime(whole, '%Y-%m-%dT%H:%M:%S'))
+    if fraction:
+        seconds += float('0.' + fraction)
+    return seconds
+
+
+class LineEncoder(object):
+    """Append points to a buffer as line protocol, see the top of the file.
+
+    ``precision`` is 'n', 'u', 'ms' or 's'. Not thread safe, give each
+    thread its own.
+    """
+
+    def __init__(self, precision='n', max_series=10000):
+        if precision not in PRECISIONS:
+            raise ValueError('precision must be one of: %s' % ', '.join(sorted(PRECISIONS)))
+        self.precision = precision
+        self.max_series = max_series
+        self.buffer = bytearray()
+        self._per_second = PRECISIONS[precision]
+        self._series = {}   # (measurement, tags) -> b'measurement,tag=value'
+        self._keys = {}     # field name -> b'field='
+
+    def timestamp(self, seconds):
+        # epoch seconds (float) -> integer in our precision. The whole seconds
+        # are scaled separately so nanoseconds don't pick up float rounding.
+        whole = int(seconds)
+        return whole * self._per_second + int(round((seconds - whole) * self._per_second))
+
+    def series(self, measurement, tags=()):
+        # ``tags`` is a tuple of (key, value) pairs (or a dict). Sorted like
+        # InfluxDB wants them, empty values left out like make_lines() does.
+        if isinstance(tags, dict):
+            tags = tuple(tags.items())
+        key = (measurement, tags)
+        prefix = self._series.get(key)
+        if prefix is None:
+            parts = [escape_measurement(measurement)]
+            for name, value in sorted(tags):
+                if value is not None and value != '':
+                    parts.append('%s=%s' % (escape(name), escape(value)))
+            prefix = ','.join(parts).encode('utf-8')
+            if len(self._series) >= self.max_series:
+                # something is making up tag values, don't grow forever
+                self._series.clear()
+            self._series[key] = prefix
+        return prefix
+
+    def _key(self, name):
+        key = self._keys.get(name)
+        if key is None:
+            key = self._keys[name] = (escape(name) + '=').encode('utf-8')
+        return key
+
+    def add(self, measurement, tags, fields, seconds=None):
+        """Append one point. ``fields`` is a dict or (name, value) pairs and
+        ``seconds`` the epoch time (None lets InfluxDB stamp it).
+        Returns False if no field had a value, in which case nothing is added.
+        """
+        if isinstance(fields, dict):
+            fields = fields.items()
+        parts = []
+        for name, value in fields:
+            text = field_value(value)
+            if text is not None:
+                parts.append(self._key(name) + text.encode('utf-8'))
+        if not parts:
+            return False
+        buffer = self.buffer
+        buffer += self.series(measurement, tags)
+        buffer += b' '
+        buffer += b','.join(parts)
+        if seconds is not None:
+            buffer += b' %d' % self.timestamp(seconds)
+        buffer += b'\n'
+        return True
+
+    def add_columns(self, measurement, tags, fields, seconds):
+        """Append one point per row of a table of columns (lists or arrays).
+
+        ``tags`` and ``fields`` are (name, column) pairs and ``seconds`` the
+        column of epoch times. Rows whose fields all have no value are left
+        out, like add() does. Returns how many points were added.
+        """
+        tag_names = [name for name, _ in tags]
+        tag_columns = [list(values) for _, values in tags]
+        keys = [self._key(name) for name, _ in fields]
+        columns = [values.tolist() if hasattr(values, 'tolist') else list(values) for _, values in fields]
+        stamps = [self.timestamp(t) for t in (seconds.tolist() if hasattr(seconds, 'tolist') else seconds)]
+        buffer = self.buffer
+        added = 0
+        for row, stamp in enumerate(stamps):
+            parts = []
+            for key, values in zip(keys, columns):
+                text = field_value(values[row])
+                if text is not None:
+                    parts.append(key + text.encode('utf-8'))
+            if not parts:
+                continue
+            buffer += self.series(measurement, tuple(zip(tag_names, [c[row] for c in tag_columns])))
+            buffer += b' '
+            buffer += b','.join(parts)
+            buffer += b' %d\n' % stamp
+            added += 1
+        return added
+
+    def add_point(self, point):
+        # a point dict as write_points() takes it (see ampread/points.py)
+        stamp = point.get('time')
+        if isinstance(stamp, str):
+            stamp = iso_seconds(stamp)
+        return self.add(point['measurement'], point.get('tags') or (), point['fields'], stamp)
+
+    def take(self):
+        # the lines added so far, and start again
+        data = bytes(self.buffer)
+        del self.buffer[:]
+        return data
+
+    def lines(self, points):
+        # point dicts -> a list of line protocol strings
+        for point in points:
+            self.add_point(point)
+        return self.take().decode('utf-8').splitlines()
+
+
+# what a backslash escapes in each part, see the top of the file
+_MEASUREMENT = re.compile(r'\\([, ])')
+_KEY = re.compile(r'\\([,= ])')
+_STRING = re.compile(r'\\(["\\])')
+
+
+def _unescape(text, escaped=_KEY):
+    if '\\' not in text:
+        return text
+    return escaped.sub(r'\1', text)
+
+
+def _split(text, sep, limit=-1):
+    # split on sep, except where it is backslash escaped or inside "quotes"
+    if '\\' not in text and '"' not in text:
+        return text.split(sep, limit)
+    parts = []
+    start = 0
+    quoted = False
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c == '\\':
+            i += 2
+            continue
+        if c == '"':
+            quoted = not quoted
+        elif c == sep and not quoted and len(parts) != limit:
+            parts.append(text[start:i])
+            start = i + 1
+        i += 1
+    parts.append(text[start:])
+    return parts
+
+
+def _parse_value(text):
+    if text.startswith('"'):
+        return _unescape(text[1:-1], _STRING)
+    if text in ('t', 'T', 'true', 'True', 'TRUE'):
+        return True
+    if text in ('f', 'F', 'false', 'False', 'FALSE'):
+        return False
+    if text.endswith('i'):
+        return int(text[:-1])
+    return float(text)
+
+
+def parse_line(line):
+    """(measurement, tags, fields, timestamp) from one line of line protocol.
+
+    ``tags`` and ``fields`` are dicts, ``timestamp`` is the integer as
+    written (in whatever precision that was) or None.
+    """
+    parts = _split(line.rstrip('\n'), ' ')
+    if len(parts) not in (2, 3):
+        raise ValueError('bad line protocol: %r' % line)
+    series = _split(parts[0], ',')
+    tags = {}
+    for tag in series[1:]:
+        key, value = _split(tag, '=', 1)
+        tags[_unescape(key)] = _unescape(value)
+    fields = {}
+    for field in _split(parts[1], ','):
+        key, value = _split(field, '=', 1)
+        fields[_unescape(key)] = _parse_value(value)
+    timestamp = int(parts[2]) if len(parts) == 3 else None
+    return _unescape(series[0], _MEASUREMENT), tags, fields, timestamp
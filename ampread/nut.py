@@ -0,0 +1,170 @@
+# Reading UPS status from a NUT (Network UPS Tools) server.
+#
+# NUTClient keeps one connection to upsd open and reuses it every cycle. A
+# LIST VAR reply is read line by line until the END LIST VAR line, so it is
+# never cut short (or held up by a fixed sleep), and every variable ends up
+# in a dict keyed by its name (input.voltage, battery.charge, ups.load ...),
+# so it doesn't matter what order the server lists them in or whether an
+# extra status line turns up during a power outage.
+
+import re
+import socket
+import time
+
+NUT_PORT = 3493
+
+# VAR <ups> <name> "<value>", where the value may contain \" and \\ escapes
+_VAR = re.compile(r'^VAR\s+(\S+)\s+(\S+)\s+"((?:[^"\\]|\\.)*)"\s*$')
+_UNESCAPE = re.compile(r'\\(.)')
+
+
+class NUTError(Exception):
+    """upsd answered with an ERR line, or couldn't be reached."""
+
+
+def parse_vars(lines):
+    """Turn LIST VAR reply lines into a dict of variable name -> value.
+
+    ``lines`` can be the whole reply as one string or any iterable of lines.
+    Values are left as strings.
+    """
+    if isinstance(lines, bytes):
+        lines = lines.decode('utf-8', 'replace')
+    if isinstance(lines, str):
+        lines = lines.splitlines()
+    values = {}
+    match = _VAR.match
+    for line in lines:
+        m = match(line)
+        if m:
+            name, value = m.group(2, 3)
+            if '\\' in value:
+                value = _UNESCAPE.sub(r'\1', value)
+            values[name] = value
+    return values
+
+
+def _float(values, name, default):
+    try:
+        return float(values[name])
+    except (KeyError, ValueError):
+        return default
+
+
+def ups_status(values, server=''):
+    """Pick the fields ampread uploads out of a parse_vars() dict.
+
+    A number the UPS doesn't report is None, never a made up value: the
+    points leave it out, and without LINEV the process stage treats the
+    reading as stale (nominal voltage, flagged).
+    """
+    runtime = _float(values, 'battery.runtime', None)
+    return {
+        'BCHG': _float(values, 'battery.charge', None),
+        'TIMELEFT': round(runtime / 60, 2) if runtime is not None else None,
+        'UPSMODEL': values.get('device.model') or values.get('ups.model') or 'Unknown',
+        'LINEV': _float(values, 'input.voltage', None),
+        'LOAD': _float(values, 'ups.load', None),
+        'SERVER': server,
+        'STATUS': values.get('ups.status', 'Unknown'),
+    }
+
+
+class NUTClient(object):
+    """A persistent connection to a NUT upsd server.
+
+    If the connection drops it is reopened on the next call. While the server
+    is unreachable, reconnects are spaced out (doubling up to ``max_backoff``
+    seconds) and calls in between raise NUTError straight away instead of
+    waiting on a connect timeout every cycle.
+    """
+
+    def __init__(self, host, port=NUT_PORT, ups='ups', timeout=5.0, max_backoff=60.0):
+        self.host = host
+        self.port = port
+        self.ups = ups
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.reconnects = 0
+        self._sock = None
+        self._reader = None
+        self._backoff = 0.0
+        self._retry_at = 0.0
+
+    def _connect(self):
+        now = time.monotonic()
+        if now < self._retry_at:
+            raise NUTError('waiting %.0fs before reconnecting to %s:%d'
+                           % (self._retry_at - now, self.host, self.port))
+        try:
+            sock = socket.create_connection((self.host, self.port), self.timeout)
+        except OSError as e:
+            self._backoff = min(max(self._backoff * 2, 1.0), self.max_backoff)
+            self._retry_at = now + self._backoff
+            raise NUTError('cannot connect to %s:%d: %s' % (self.host, self.port, e))
+        self._sock = sock
+        self._reader = sock.makefile('rb')
+        self._backoff = 0.0
+        self._retry_at = 0.0
+        self.reconnects += 1
+
+    def _readline(self):
+        line = self._reader.readline()
+        if not line:
+            raise NUTError('connection closed by %s:%d' % (self.host, self.port))
+        return line.decode('utf-8', 'replace').rstrip('\r\n')
+
+    def _exchange(self, command, end):
+        self._sock.sendall(command.encode('utf-8') + b'\n')
+        lines = [self._readline()]
+        if end is not None and not lines[0].startswith('ERR '):
+            while True:
+                line = self._readline()
+                if line == end:
+                    break
+                lines.append(line)
+        return lines
+
+    def command(self, command, end=None):
+        """Send one command and return its reply lines.
+
+        With ``end`` the reply is read up to (not including) that line,
+        otherwise it's a single line. An ERR reply raises NUTError.
+        """
+        for attempt in (1, 2):
+            if self._sock is None:
+                self._connect()
+            try:
+                lines = self._exchange(command, end)
+            except (OSError, NUTError) as e:
+                self.close()
+                # a kept-alive connection the server has dropped gets one
+                # retry on a fresh connection
+                if attempt == 2:
+                    raise NUTError('%s failed: %s' % (command, e))
+                continue
+            if lines[0].startswith('ERR '):
+                raise NUTError('%s: %s' % (command, lines[0][4:]))
+            return lines
+
+    def list_vars(self):
+        # all variables of our UPS as a dict of name -> string value
+        return parse_vars(self.command('LIST VAR %s' % self.ups, end='END LIST VAR %s' % self.ups))
+
+    def status(self):
+        # the fields ampread uploads, see ups_status()
+        return ups_status(self.list_vars(), self.host)
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.sendall(b'LOGOUT\n')
+            except OSError:
+                pass
+            try:
+                self._reader.close()
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = None
+        self._reader = None
@@ -0,0 +1,262 @@
+# Run the main loop as separate processes joined by bounded queues.
+#
+# In one loop, sampling waits for everything else: a slow NUT server, a GC
+# pause or influxdb timing out all push the next set of readings back, or
+# make the scheduler skip it. Here each stage gets its own process (the Pi
+# has four cores) and hands its results to the next one through a bounded
+# queue:
+#
+#   acquire --frames--> process --points--> sink
+#
+# A queue that fills up does what its policy says:
+#   'block'       - the producer waits for room (nothing is lost)
+#   'drop-newest' - the new item is thrown away
+#   'drop-oldest' - the oldest waiting item is thrown away to make room
+#
+# so acquisition can keep its schedule (its output queue drops) while a
+# lagging sink just gets further behind (its input queue blocks the
+# processing stage, never the ADCs). Every queue counts what went through
+# it, how deep it got and what it dropped; Pipeline.stats() collects them.
+#
+# A stage's worker is an object with:
+#   setup(stop)   - called once in the stage's own process. Open hardware,
+#                   sockets and threads here, not in __init__, because the
+#                   worker is built in the parent and copied to the child.
+#   __call__(item) - handle one item and return a list of items for the
+#                   next stage (or None). A source stage (no input queue)
+#                   is called with None and should pace itself.
+#   flush()       - optional, called on the way out. Returns a list of last
+#                   items for the next stage, e.g. half-finished work.
+#   close()       - called on the way out.
+
+import multiprocessing
+import queue
+import signal
+import time
+
+POLICIES = ('block', 'drop-newest', 'drop-oldest')
+
+
+class Stopped(Exception):
+    """Raised inside a stage to say the pipeline is shutting down."""
+
+
+def interruptible_sleep(stop):
+    # A time.sleep() replacement (for CycleScheduler) that raises Stopped
+    # as soon as the stage is told to stop instead of finishing the sleep.
+    def sleep(seconds):
+        if stop.wait(seconds):
+            raise Stopped()
+    return sleep
+
+
+class BoundedQueue(object):
+    """A multiprocessing queue of at most ``maxsize`` items with a full-queue policy."""
+
+    def __init__(self, name, maxsize=8, policy='block', context=multiprocessing):
+        if policy not in POLICIES:
+            raise ValueError('policy must be one of: %s' % ', '.join(POLICIES))
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        self._queue = context.Queue(maxsize)
+        # counters live in shared memory so every process sees the same numbers
+        self._put = context.Value('L', 0)
+        self._got = context.Value('L', 0)
+        self._dropped = context.Value('L', 0)
+        self._max_depth = context.Value('L', 0)
+        self._blocked = context.Value('d', 0.0)
+
+    def _count(self, counter, n=1):
+        with counter.get_lock():
+            counter.value += n
+
+    def put(self, item, stop=None):
+        """Queue an item, returns False if it (or an older one) was dropped."""
+        kept = True
+        if self.policy == 'block':
+            started = time.monotonic()
+            while True:
+                try:
+                    self._queue.put(item, timeout=0.5)
+                    break
+                except queue.Full:
+                    # don't wait forever on a consumer that is shutting down
+                    if stop is not None and stop.is_set():
+                        self._count(self._dropped)
+                        return False
+            self._count(self._blocked, time.monotonic() - started)
+        elif self.policy == 'drop-newest':
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self._count(self._dropped)
+                return False
+        else:
+            while True:
+                try:
+                    self._queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        self._queue.get_nowait()
+                        self._count(self._dropped)
+                        kept = False
+                    except queue.Empty:
+                        pass
+        self._count(self._put)
+        depth = self.depth()
+        if depth > self._max_depth.value:
+            with self._max_depth.get_lock():
+                self._max_depth.value = max(self._max_depth.value, depth)
+        return kept
+
+    def get(self, timeout=None):
+        item = self._queue.get(timeout=timeout)
+        self._count(self._got)
+        return item
+
+    def depth(self):
+        try:
+            return self._queue.qsize()
+        except NotImplementedError:
+            # macOS has no sem_getvalue(), work it out from the counters
+            return max(self._put.value - self._got.value - self._dropped.value, 0)
+
+    def stats(self):
+        return {'depth': self.depth(), 'max_depth': self._max_depth.value,
+                'maxsize': self.maxsize, 'policy': self.policy,
+                'put': self._put.value, 'got': self._got.value,
+                'dropped': self._dropped.value, 'blocked_seconds': round(self._blocked.value, 3)}
+
+    def close(self):
+        self._queue.close()
+        self._queue.join_thread()
+
+
+class Stage(object):
+    """One worker running in its own process between two queues."""
+
+    def __init__(self, name, worker, inbox=None, outbox=None, context=multiprocessing):
+        self.name = name
+        self.worker = worker
+        self.inbox = inbox
+        self.outbox = outbox
+        self.stop = context.Event()
+        self._errors = context.Value('L', 0)
+        self._items = context.Value('L', 0)
+        self._busy = context.Value('d', 0.0)
+        self.process = context.Process(target=self._run, name='ampread-%s' % name)
+        self.process.daemon = True
+
+    def __getstate__(self):
+        # everything but the Process object goes to the child
+        state = self.__dict__.copy()
+        del state['process']
+        return state
+
+    def _run(self):
+        # Ctrl-C goes to every process in the group. Leave it to the parent,
+        # which stops the stages in order so the queues are drained.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        worker = self.worker
+        try:
+            worker.setup(self.stop)
+            while True:
+                if self.inbox is None:
+                    if self.stop.is_set():
+                        break
+                    item = None
+                else:
+                    try:
+                        item = self.inbox.get(timeout=0.5)
+                    except queue.Empty:
+                        # only finish once everything upstream sent us is done
+                        if self.stop.is_set():
+                            break
+                        continue
+                started = time.monotonic()
+                try:
+                    results = worker(item)
+                except Stopped:
+                    break
+                except Exception as e:
+                    # one bad item shouldn't take the stage down
+                    with self._errors.get_lock():
+                        self._errors.value += 1
+                    print('ampread %s: %s: %s' % (self.name, type(e).__name__, e))
+                    if self.inbox is None:
+                        # don't spin on a source that keeps failing
+                        self.stop.wait(1.0)
+                    continue
+                finally:
+                    with self._busy.get_lock():
+                        self._busy.value += time.monotonic() - started
+                    with self._items.get_lock():
+                        self._items.value += 1
+                if results and self.outbox is not None:
+                    for result in results:
+                        self.outbox.put(result, self.stop)
+            if self.outbox is not None and hasattr(worker, 'flush'):
+                for result in worker.flush() or ():
+                    self.outbox.put(result, self.stop)
+        except Stopped:
+            pass
+        finally:
+            worker.close()
+            if self.outbox is not None:
+                # let the queue's feeder thread finish handing over what we put
+                self.outbox.close()
+
+    def start(self):
+        self.process.start()
+
+    def stats(self):
+        return {'alive': self.process.is_alive(), 'items': self._items.value,
+                'errors': self._errors.value, 'busy_seconds': round(self._busy.value, 3)}
+
+
+class Pipeline(object):
+    """Stages connected in a line by bounded queues.
+
+    ``stages`` is a list of (name, worker) and ``queues`` a list of
+    (maxsize, policy), one for each gap between two stages.
+    """
+
+    def __init__(self, stages, queues, context=None):
+        if len(queues) != len(stages) - 1:
+            raise ValueError('need one queue between each pair of stages')
+        context = context or multiprocessing.get_context()
+        self.queues = [BoundedQueue('%s->%s' % (stages[i][0], stages[i + 1][0]), maxsize, policy, context)
+                       for i, (maxsize, policy) in enumerate(queues)]
+        self.stages = []
+        for i, (name, worker) in enumerate(stages):
+            inbox = self.queues[i - 1] if i > 0 else None
+            outbox = self.queues[i] if i < len(self.queues) else None
+            self.stages.append(Stage(name, worker, inbox, outbox, context))
+
+    def start(self):
+        # start from the sink end so nothing produces into a stage that isn't running
+        for stage in reversed(self.stages):
+            stage.start()
+        return self
+
+    def alive(self):
+        return all(stage.process.is_alive() for stage in self.stages)
+
+    def stats(self):
+        stats = dict((stage.name, stage.stats()) for stage in self.stages)
+        for q in self.queues:
+            stats[q.name] = q.stats()
+        return stats
+
+    def stop(self, timeout=30.0):
+        # Stop the source first and each stage after the one before it has
+        # finished, so whatever is already in the queues still gets written.
+        deadline = time.monotonic() + timeout
+        for stage in self.stages:
+            stage.stop.set()
+            stage.process.join(max(deadline - time.monotonic(), 0.1))
+            if stage.process.is_alive():
+                stage.process.terminate()
+                stage.process.join()
@@ -0,0 +1,115 @@
+# Build the InfluxDB points ampread uploads every cycle.
+#
+# These are the dicts influxdb-python's write_points() takes. The per-cycle
+# current and voltage points also go straight to a LineEncoder (see
+# ampread/lineprotocol.py) with write_current() and write_voltage(), without
+# building the dicts at all.
+
+import base64
+import math
+
+
+def current_point(iso, schedule, tou, amps):
+    # all ampere readings, amps is a dict of field name -> amps
+    return {
+        "measurement": "current",
+        "tags": {
+            "tou_schedule": schedule,
+            "tou": tou
+        },
+        "time": iso,
+        "fields": dict(amps),
+    }
+
+
+def voltage_fields(voltage, rate, cph, kwh, kilowatts, voltage_stale=False, interval=None, lateness=None,
+                   schedule=None):
+    # voltage, rate, kW, kWh, cost/hr and the cost of the kWh as (name, value)
+    # pairs. voltage_stale is True when the UPS reading was too old and
+    # voltage is the nominal stand-in. interval is the seconds kwh covers and
+    # lateness how late the cycle started.
+    fields = (("voltage", voltage), ("rate", rate), ("cph", cph), ("kwh", kwh), ("cost", kwh * rate),
+              ("schedule", schedule), ("kilowatts", kilowatts), ("voltage_stale", bool(voltage_stale)))
+    if interval is not None:
+        fields += (("interval", float(interval)),)
+    if lateness is not None:
+        fields += (("lateness", float(lateness)),)
+    return fields
+
+
+def voltage_point(iso, schedule, tou, voltage, rate, cph, kwh, kilowatts, voltage_stale=False,
+                  interval=None, lateness=None):
+    return {
+        "measurement": "voltage",
+        "tags": {
+            "tou_schedule": schedule,
+            "tou": tou
+        },
+        "time": iso,
+        "fields": dict(voltage_fields(voltage, rate, cph, kwh, kilowatts, voltage_stale, interval,
+                                      lateness, schedule)),
+    }
+
+
+def write_current(encoder, seconds, schedule, tou, amps):
+    # current_point() straight into a LineEncoder, seconds is the epoch time
+    encoder.add("current", (("tou_schedule", schedule), ("tou", tou)), amps, seconds)
+
+
+def write_voltage(encoder, seconds, schedule, tou, voltage, rate, cph, kwh, kilowatts, voltage_stale=False,
+                  interval=None, lateness=None):
+    # voltage_point() straight into a LineEncoder
+    encoder.add("voltage", (("tou_schedule", schedule), ("tou", tou)),
+                voltage_fields(voltage, rate, cph, kwh, kilowatts, voltage_stale, interval, lateness,
+                               schedule), seconds)
+
+
+def ups_point(ups, iso=None):
+    # UPS status from the dict ampread.nut.ups_status() returns. Numbers the
+    # UPS didn't report are None and left out of the point.
+    # Without "iso" influxdb stamps the point when it arrives, which is late
+    # if it sat in a write buffer for a while.
+    point = {
+        "measurement": "apcaccess",
+        "tags": {
+            "status": ups['STATUS'],
+            "upsmodel": ups['UPSMODEL'],
+            "server": ups['SERVER']
+        },
+        "fields": {
+            "LINEV": ups['LINEV'],
+            "LOAD": ups['LOAD'],
+            "BCHG": ups['BCHG'],
+            "TIMELEFT": ups['TIMELEFT'],
+        }
+    }
+    if iso is not None:
+        point["time"] = iso
+    return point
+
+
+def waveform_point(iso, circuit, adc, frequency, fundamental, rms, peak, crest, thd,
+                   harmonics, waveform=None):
+    # One circuit's burst analysis (see ampread/burst.py). harmonics are the
+    # RMS amps of harmonics 1, 2, 3... and go in as h2, h3...; anything the
+    # burst couldn't measure (NaN) is left out. waveform is the
+    # encode_waveform() bytes, stored base64 encoded.
+    fields = {}
+    for name, value in (("frequency", frequency), ("fundamental", fundamental), ("rms", rms),
+                        ("peak", peak), ("crest", crest), ("thd", thd)):
+        if not math.isnan(value):
+            fields[name] = float(value)
+    for order, value in enumerate(harmonics[1:], 2):
+        if not math.isnan(value):
+            fields["h%d" % order] = float(value)
+    if waveform is not None:
+        fields["waveform"] = base64.b64encode(waveform).decode('ascii')
+    return {
+        "measurement": "waveform",
+        "tags": {
+            "circuit": circuit,
+            "adc": adc
+        },
+        "time": iso,
+        "fields": fields,
+    }
@@ -0,0 +1,21 @@
+# The power, energy and cost arithmetic, shared by the live loop and the
+# backfill tool so both always agree.
+#
+# Every function works on plain floats or on NumPy arrays.
+
+import numpy as np
+
+
+def kilowatts(amps, volts, places=2):
+    # total amps at the line voltage, in kW
+    return np.round(np.multiply(amps, volts) / 1000.0, places)
+
+
+def kwh(kw, seconds, places=8):
+    # energy used at kw for that many seconds
+    return np.round(np.multiply(kw, seconds) / 3600.0, places)
+
+
+def cost_per_hour(kw, rate, places=2):
+    # estimated cost / hour assuming current usage is maintained for an hour
+    return np.round(np.multiply(kw, rate), places)
@@ -0,0 +1,225 @@
+# Retention policies and continuous queries for pre-computed kWh and cost.
+#
+# The kWh dashboards used to add up every raw "voltage" point in range on
+# each refresh (sum("kilowatts") * 10 / 3600, which also assumed the cycle
+# was 10 seconds), so a year-long panel read over a million points. Now
+# InfluxDB keeps running totals itself with continuous queries:
+#
+#   kwh_1h - kWh and cost per hour, per tou / tou_schedule, from "voltage"
+#   kwh_1d - the same per day, from kwh_1h
+#
+# in an "energy" retention policy that never expires. A year of kwh_1d is a
+# few hundred points. InfluxQL can't group by calendar month (months aren't
+# all the same length), so monthly and yearly panels sum kwh_1d.
+#
+# Days start at local midnight (standard time) so they line up with the
+# tariff's days. During daylight saving time that is 1am on the clock.
+#
+# The script makes sure all this exists when it starts. To change it, or to
+# fill the totals in for readings that were stored before it existed:
+#
+#   python3 -m ampread.retention --host 192.168.10.13 --backfill-from 2019-01-01
+#
+# Readings stored before the "cost" field was added have no cost; run
+# ampread.backfill over them first to add it.
+
+import argparse
+import datetime
+import re
+import sys
+import time
+from collections import namedtuple
+
+from influxdb import InfluxDBClient
+
+# name, duration (InfluxQL, INF for forever), replication, shard group
+# duration ('0s' lets InfluxDB pick) and whether to make it the database's
+# default policy when it is created
+RetentionPolicy = namedtuple('RetentionPolicy', ['name', 'duration', 'replication', 'shard_duration',
+                                                 'default'])
+
+# name, the SELECT ... INTO it runs, its RESAMPLE EVERY / FOR, and the length
+# and offset (seconds) of the time buckets it groups by
+ContinuousQuery = namedtuple('ContinuousQuery', ['name', 'select', 'every', 'for_', 'period', 'offset'])
+
+RAW_POLICY = '160w'         # where the script's points go
+ENERGY_POLICY = 'energy'    # the kWh totals
+
+
+def policies(raw=RAW_POLICY, raw_duration='160w', energy=ENERGY_POLICY):
+    return [RetentionPolicy(raw, raw_duration, 1, '0s', True),
+            RetentionPolicy(energy, 'INF', 1, '0s', False)]
+
+
+def day_offset(utc_offset=None):
+    # the offset for GROUP BY time(1d, offset) that starts days at local
+    # midnight, standard time
+    if utc_offset is None:
+        utc_offset = -time.timezone
+    return -utc_offset % 86400
+
+
+def energy_queries(database='ampread', raw=RAW_POLICY, energy=ENERGY_POLICY, offset=None):
+    """The continuous queries that keep kwh_1h and kwh_1d up to date.
+
+    ``offset`` is where days start, in seconds after midnight UTC.
+    """
+    if offset is None:
+        offset = day_offset()
+    target = '"%s"."%s"' % (database, energy)
+    hourly = ('SELECT sum("kwh") AS "kwh", sum("cost") AS "cost", count("kwh") AS "readings" '
+              'INTO %s."kwh_1h" FROM "%s"."%s"."voltage" GROUP BY time(1h), "tou", "tou_schedule"'
+              % (target, database, raw))
+    daily = ('SELECT sum("kwh") AS "kwh", sum("cost") AS "cost", sum("readings") AS "readings" '
+             'INTO %s."kwh_1d" FROM %s."kwh_1h" GROUP BY time(1d, %ds), "tou", "tou_schedule"'
+             % (target, target, offset))
+    # Readings held in the spool during an outage turn up late, so each query
+    # goes back over the last few periods every time it runs. Anything later
+    # than that is redone by the writer once it has caught up (see
+    # late_after() and materialize()).
+    return [ContinuousQuery('cq_kwh_1h', hourly, '10m', '2h', 3600, 0),
+            ContinuousQuery('cq_kwh_1d', daily, '1h', '2d', 86400, offset)]
+
+
+def create_statement(database, cq):
+    return ('CREATE CONTINUOUS QUERY "%s" ON "%s" RESAMPLE EVERY %s FOR %s BEGIN %s END'
+            % (cq.name, database, cq.every, cq.for_, cq.select))
+
+
+_UNITS = {'ns': 1e-9, 'u': 1e-6, 'ms': 1e-3, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def duration_seconds(text):
+    # '160w', '26880h0m0s' or 'INF' (0, like InfluxDB reports it) in seconds
+    if text.upper() == 'INF':
+        return 0
+    parts = re.findall(r'(\d+)(ns|u|ms|s|m|h|d|w)', text)
+    if not parts or ''.join(n + u for n, u in parts) != text:
+        raise ValueError('bad duration %r' % text)
+    return int(sum(int(n) * _UNITS[u] for n, u in parts))
+
+
+def late_after(queries):
+    # Seconds after which a reading is too late for the continuous queries to
+    # pick it up by themselves: the shortest FOR, less one EVERY.
+    return min(duration_seconds(cq.for_) - duration_seconds(cq.every) for cq in queries)
+
+
+def ensure_schema(client, database='ampread', retention=None, queries=None, replace=False, log=print):
+    """Create the retention policies and continuous queries that are missing.
+
+    Existing ones are left alone unless ``replace`` is set, in which case
+    policies that differ are altered and the continuous queries are dropped
+    and created again (InfluxDB can't alter them). Shortening a policy's
+    duration deletes data, so that only ever happens with ``replace``.
+
+    A policy only becomes the database's default when it is created, and
+    only if nobody has picked one (the default is still InfluxDB's own
+    "autogen"). The script writes into its policy by name either way.
+    """
+    if retention is None:
+        retention = policies()
+    if queries is None:
+        queries = energy_queries(database)
+    client.create_database(database)    # does nothing if it's there already
+
+    existing = dict((rp['name'], rp) for rp in client.get_list_retention_policies(database))
+    chosen = [name for name, rp in existing.items() if rp['default'] and name != 'autogen']
+    for rp in retention:
+        have = existing.get(rp.name)
+        if have is None:
+            default = rp.default and not chosen
+            log('creating retention policy %s (%s)%s' % (rp.name, rp.duration, ', the default' if default else ''))
+            if rp.default and chosen:
+                log('leaving %s as the default retention policy' % chosen[0])
+            client.create_retention_policy(rp.name, rp.duration, rp.replication, database,
+                                           default=default, shard_duration=rp.shard_duration)
+            if default:
+                chosen = [rp.name]
+        elif replace and (duration_seconds(have['duration']) != duration_seconds(rp.duration)
+                          or have['replicaN'] != rp.replication):
+            log('altering retention policy %s (%s)' % (rp.name, rp.duration))
+            client.alter_retention_policy(rp.name, database, duration=rp.duration,
+                                          replication=rp.replication)
+
+    names = set()
+    for db in client.get_list_continuous_queries():
+        for cq in db.get(database, []):
+            names.add(cq['name'])
+    for cq in queries:
+        if cq.name in names:
+            if not replace:
+                continue
+            log('replacing continuous query %s' % cq.name)
+            client.query('DROP CONTINUOUS QUERY "%s" ON "%s"' % (cq.name, database))
+        else:
+            log('creating continuous query %s' % cq.name)
+        client.query(create_statement(database, cq))
+
+
+def materialize(client, queries, start, end, chunk=30 * 86400, log=print):
+    """Run the continuous queries' SELECT ... INTO over [start, end) now,
+    widened to whole buckets.
+
+    Continuous queries only ever look at the last few periods, so this is
+    how totals for older readings get filled in. Queries run in order (the
+    daily totals are made from the hourly ones) a chunk of time at a time.
+    ``chunk`` should be a whole number of days.
+    """
+    for cq in queries:
+        # start and end on the query's buckets, or the bucket either side of
+        # a chunk boundary would be written twice, half full each time, and
+        # the last one would be overwritten with a part of its total
+        chunk_start = start - (start - cq.offset) % cq.period
+        last = end + (cq.offset - end) % cq.period
+        while chunk_start < last:
+            chunk_end = min(chunk_start + chunk, last)
+            # GROUP BY goes after the time range
+            select, group = cq.select.split(' GROUP BY ', 1)
+            client.query('%s WHERE time >= %ds AND time < %ds GROUP BY %s'
+                         % (select, chunk_start, chunk_end, group))
+            log('%s  %s' % (cq.name, datetime.datetime.fromtimestamp(chunk_start).date()))
+            chunk_start = chunk_end
+
+
+def _day(text):
+    return int(time.mktime(datetime.datetime.strptime(text, '%Y-%m-%d').timetuple()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Set up the InfluxDB retention policies and kWh continuous queries for ampread')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8086)
+    parser.add_argument('--username', default='')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--database', default='ampread')
+    parser.add_argument('--raw-policy', default=RAW_POLICY,
+                        help='retention policy the readings are in (default %(default)s)')
+    parser.add_argument('--raw-duration', default='160w',
+                        help='how long to keep the readings (default %(default)s)')
+    parser.add_argument('--replace', action='store_true',
+                        help='alter policies and recreate continuous queries that already exist')
+    parser.add_argument('--backfill-from', metavar='YYYY-MM-DD',
+                        help='also work out the totals for readings stored since this day')
+    parser.add_argument('--print', action='store_true', dest='print_only',
+                        help="print the continuous queries and don't change anything")
+    args = parser.parse_args(argv)
+
+    queries = energy_queries(args.database, args.raw_policy)
+    if args.print_only:
+        for cq in queries:
+            print(create_statement(args.database, cq))
+        return 0
+
+    client = InfluxDBClient(args.host, args.port, args.username, args.password, args.database,
+                            timeout=300, retries=3)
+    ensure_schema(client, args.database, policies(args.raw_policy, args.raw_duration), queries,
+                  replace=args.replace)
+    if args.backfill_from:
+        materialize(client, queries, _day(args.backfill_from), int(time.time()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
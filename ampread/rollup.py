@@ -0,0 +1,210 @@
+# Roll the per-cycle readings up into 1 minute, 15 minute and 1 hour windows.
+#
+# Every cycle writes one raw point per measurement, 180 an hour, and the
+# Grafana panels then group and sum those over whatever range is on screen.
+# Over a month that's 130,000 points per panel. Rollup keeps running stats
+# for each window as the readings come in and writes one point per window
+# when it closes: min, max, mean and a high percentile (p95 by default) of
+# every value, plus the total of anything that adds up (kWh, cost).
+#
+# The percentile comes from the P-squared algorithm (Jain and Chlamtac,
+# 1985), which tracks a quantile with five markers instead of keeping every
+# reading, so each window costs the same small, fixed amount of memory no
+# matter how long it is.
+#
+# Windows line up with the clock (a 15 minute window starts at :00, :15...)
+# and each point is stamped with the start of its window. A window also
+# closes early when the tags change (a TOU band can start at 07:30, and
+# hours aren't whole in every time zone), so its kWh and cost never end up
+# booked to the wrong band. The rest of that window is a second point with
+# the same time and the new tags, which makes it a separate series.
+
+import datetime
+import math
+
+# window length in seconds -> name used in the measurement, e.g. current_15m
+WINDOWS = ((60, '1m'), (900, '15m'), (3600, '1h'))
+
+
+def window_name(seconds):
+    for length, name in WINDOWS:
+        if length == seconds:
+            return name
+    if seconds % 3600 == 0:
+        return '%dh' % (seconds // 3600)
+    if seconds % 60 == 0:
+        return '%dm' % (seconds // 60)
+    return '%ds' % seconds
+
+
+def _iso(seconds):
+    # epoch seconds -> '2019-03-01T12:00:00Z'
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).replace(tzinfo=None).isoformat() + 'Z'
+
+
+class P2Quantile(object):
+    """Running estimate of the ``p`` quantile in constant memory (P-squared)."""
+
+    __slots__ = ('p', 'count', '_q', '_n', '_np', '_dn')
+
+    def __init__(self, p=0.95):
+        self.p = p
+        self.count = 0
+        self._q = []                                        # marker heights
+        self._n = [0, 1, 2, 3, 4]                           # marker positions
+        self._np = [0.0, 2 * p, 4 * p, 2 + 2 * p, 4.0]      # desired positions
+        self._dn = [0.0, p / 2, p, (1 + p) / 2, 1.0]        # desired position steps
+
+    def add(self, x):
+        self.count += 1
+        q = self._q
+        if self.count <= 5:
+            # the first five readings just fill the markers
+            q.append(x)
+            q.sort()
+            return
+        n = self._n
+
+        # find the cell x falls in, stretching the end markers if needed
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self._np[i] += self._dn[i]
+
+        # nudge the three middle markers towards where they should be
+        for i in (1, 2, 3):
+            d = self._np[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                # piecewise parabolic prediction, linear if that would
+                # put the marker out of order
+                h = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if not q[i - 1] < h < q[i + 1]:
+                    h = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = h
+                n[i] += d
+
+    def value(self):
+        if self.count == 0:
+            return float('nan')
+        if self.count <= 5:
+            # exact (nearest rank) while we still have every reading
+            return self._q[min(int(math.ceil(self.p * self.count)) - 1, self.count - 1)]
+        return self._q[2]
+
+
+class WindowStats(object):
+    """min, max, mean and one quantile of a stream of numbers."""
+
+    __slots__ = ('count', 'min', 'max', 'total', 'quantile')
+
+    def __init__(self, p=0.95):
+        self.count = 0
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.total = 0.0
+        self.quantile = P2Quantile(p)
+
+    def add(self, x):
+        self.count += 1
+        if x < self.min:
+            self.min = x
+        if x > self.max:
+            self.max = x
+        self.total += x
+        self.quantile.add(x)
+
+    def mean(self):
+        return self.total / self.count if self.count else float('nan')
+
+
+class _Window(object):
+    # the stats for one window that is still open
+
+    __slots__ = ('start', 'tags', 'stats', 'sums', 'count')
+
+    def __init__(self, start, tags):
+        self.start = start
+        self.tags = dict(tags or {})
+        self.stats = {}
+        self.sums = {}
+        self.count = 0
+
+
+class Rollup(object):
+    """Windowed stats of one measurement's readings.
+
+    Points go to "<measurement>_<window>", e.g. current_15m, with
+    <field>_min, _max, _mean and _p95 for every value given to add() and
+    the plain total for every sum. ``quantile`` picks the percentile.
+    """
+
+    def __init__(self, measurement, windows=(60, 900, 3600), quantile=0.95):
+        self.measurement = measurement
+        self.windows = [(int(w), '%s_%s' % (measurement, window_name(int(w)))) for w in windows]
+        self.quantile = quantile
+        self.suffix = '_p%g' % (quantile * 100)
+        self._open = [None] * len(self.windows)
+
+    def add(self, timestamp, values, sums=None, tags=None):
+        """Add one cycle's readings, returning points for any windows that closed.
+
+        ``timestamp`` is the wall clock time of the readings, ``values`` a dict
+        of field -> number, ``sums`` a dict of field -> amount to total
+        over the window. A change of ``tags`` closes the open windows.
+        """
+        points = []
+        tags = dict(tags or {})
+        for i, (length, measurement) in enumerate(self.windows):
+            start = int(timestamp // length) * length
+            window = self._open[i]
+            if window is not None and (window.start != start or window.tags != tags):
+                points.append(self._point(measurement, window))
+                window = None
+            if window is None:
+                window = self._open[i] = _Window(start, tags)
+            window.count += 1
+            for name, value in values.items():
+                stats = window.stats.get(name)
+                if stats is None:
+                    stats = window.stats[name] = WindowStats(self.quantile)
+                stats.add(value)
+            if sums:
+                for name, value in sums.items():
+                    window.sums[name] = window.sums.get(name, 0.0) + value
+        return points
+
+    def flush(self):
+        # Points for the windows still open (they'll be short), e.g. on the way out.
+        points = [self._point(measurement, window)
+                  for (length, measurement), window in zip(self.windows, self._open)
+                  if window is not None]
+        self._open = [None] * len(self.windows)
+        return points
+
+    def _point(self, measurement, window):
+        fields = {"count": window.count}
+        for name, stats in window.stats.items():
+            fields[name + "_min"] = stats.min
+            fields[name + "_max"] = stats.max
+            fields[name + "_mean"] = stats.mean()
+            fields[name + self.suffix] = stats.quantile.value()
+        fields.update(window.sums)
+        return {
+            "measurement": measurement,
+            "tags": window.tags,
+            "time": _iso(window.start),
+            "fields": fields,
+        }
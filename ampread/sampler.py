@@ -0,0 +1,114 @@
+# Continuous conversion sampling for the ADS1015 / ADS1115.
+#
+# read_adc() does a single-shot conversion: it rewrites the config register,
+# sleeps for a whole conversion and then reads the result back. Doing that
+# 200 x 4 times per ADC is what made the old sampling loop so slow.
+#
+# In continuous mode the ADC keeps converting on its own at the data rate we
+# pick, so all we have to do is read the conversion register once per
+# conversion period. We only pay the config write (and one conversion of
+# settling time) when we switch to a new channel.
+
+import time
+
+
+class ContinuousSampler(object):
+    """Sample ADS1x15 channels in continuous mode at a fixed data rate.
+
+    ``adc`` is an ampread.adc.ADC (real or simulated), or anything else
+    with the Adafruit_ADS1x15 continuous-mode methods (start_adc,
+    get_last_result, stop_adc). After every call to sample(),
+    ``rates`` holds the samples/sec actually achieved on each channel.
+    Set ``latency`` to an ampread.telemetry.Histogram to time every read.
+
+    ``gains`` (input -> PGA gain, ``gain`` for all of them to start with)
+    and ``counts`` (input -> readings, None to use sample()'s count) can
+    differ per channel, see autorange.py.
+    """
+
+    def __init__(self, adc, data_rate, gain=1, channels=(0, 1, 2, 3)):
+        self.adc = adc
+        self.data_rate = data_rate
+        self.gain = gain
+        self.channels = tuple(channels)
+        self.period = 1.0 / data_rate
+        self.rates = dict((ch, 0.0) for ch in self.channels)
+        # time.perf_counter() of the first reading of each channel, so
+        # readings from different ADCs can be lined up against each other.
+        self.started = dict((ch, 0.0) for ch in self.channels)
+        self.latency = None
+        self.gains = dict((ch, gain) for ch in self.channels)
+        self.counts = None
+
+    def sample_channel(self, channel, out, count=None, times=None):
+        # Fill out[0:count] with readings from one channel and return the
+        # achieved sample rate. "out" can be a list or a NumPy array. Pass
+        # "times" (same length) to get the time.perf_counter() of each read.
+        if count is None:
+            count = len(out)
+        if count <= 0:
+            return 0.0
+
+        # start_adc() switches the mux, starts continuous conversions and
+        # waits out the first conversion, so the first result is valid.
+        gain = self.gains.get(channel, self.gain)
+        out[0] = self.adc.start_adc(channel, gain=gain, data_rate=self.data_rate)
+        clock = time.perf_counter
+        period = self.period
+        latency = self.latency
+        first = clock()
+        deadline = first
+        self.started[channel] = first
+        if times is not None:
+            times[0] = first
+
+        for k in range(1, count):
+            # Wait for the next conversion to be ready. If the I2C bus is the
+            # bottleneck we will already be late and just read straight away.
+            deadline += period
+            wait = deadline - clock()
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                # Don't let a long stall make us read the same result twice
+                # in a row trying to catch up.
+                deadline = clock()
+            if latency is not None:
+                before = clock()
+                out[k] = self.adc.get_last_result()
+                latency.observe(clock() - before)
+            else:
+                out[k] = self.adc.get_last_result()
+            if times is not None:
+                times[k] = clock()
+
+        elapsed = clock() - first
+        # count samples cover count - 1 periods after the first one.
+        if count > 1 and elapsed > 0:
+            rate = (count - 1) / elapsed
+        else:
+            rate = float(self.data_rate)
+        self.rates[channel] = rate
+        return rate
+
+    def sample(self, count, buffers=None, times=None):
+        # Sample every channel in turn, count readings each (or self.counts[ch]
+        # if set). Returns a dict of channel -> readings. Pass in "buffers"
+        # (same shape) to reuse them, and "times" to get the read times too.
+        counts = self.counts
+        if buffers is None:
+            buffers = dict((ch, [0] * (counts[ch] if counts else count)) for ch in self.channels)
+        try:
+            for ch in self.channels:
+                self.sample_channel(ch, buffers[ch], counts[ch] if counts else count,
+                                    times[ch] if times else None)
+        finally:
+            # Put the ADC back into power-down so it isn't converting between cycles.
+            self.adc.stop_adc()
+        return buffers
+
+    def samples_per_second(self):
+        # Average achieved rate per channel over the last sample() call.
+        if not self.rates:
+            return 0.0
+        return sum(self.rates.values()) / len(self.rates)
@@ -0,0 +1,105 @@
+# Run the main loop on a fixed cadence off the monotonic clock.
+#
+# The old loop did its work and then slept 20 seconds, so the real period was
+# 20 seconds plus however long the I2C reads and network took, and it drifted
+# every cycle. It also timed cycles with time.time(), which jumps whenever NTP
+# corrects the clock, and used the previous cycle's elapsed time for this
+# cycle's kWh.
+#
+# CycleScheduler wakes the loop on deadlines spaced exactly one period apart
+# on time.monotonic(), measures the real interval between wake-ups (which is
+# what the energy should be integrated over) and keeps track of how late each
+# wake-up was.
+#
+# If a cycle overruns its deadline:
+#   'catch-up' - run the missed cycles back to back until we're on schedule
+#                again (at most max_catch_up of them, then give up and skip)
+#   'skip'     - drop the missed cycles and wait for the next deadline
+
+import math
+import time
+from collections import namedtuple
+
+POLICIES = ('catch-up', 'skip')
+
+# What wait() returns.
+#   index    - cycle number, counting from 0
+#   deadline - time.monotonic() the cycle was due
+#   started  - time.monotonic() it actually started
+#   time     - wall clock (time.time()) when it started, for timestamps
+#   interval - seconds since the previous cycle started (0 for the first),
+#              the time to integrate energy over
+#   lateness - started - deadline
+#   skipped  - deadlines dropped just before this cycle
+Tick = namedtuple('Tick', ['index', 'deadline', 'started', 'time', 'interval', 'lateness', 'skipped'])
+
+
+class CycleScheduler(object):
+    """Fire cycles every ``period`` seconds on the monotonic clock."""
+
+    def __init__(self, period, policy='skip', max_catch_up=3,
+                 clock=time.monotonic, sleep=time.sleep, wall=time.time):
+        if policy not in POLICIES:
+            raise ValueError('policy must be one of: %s' % ', '.join(POLICIES))
+        self.period = float(period)
+        self.policy = policy
+        self.max_catch_up = max_catch_up
+        self.clock = clock
+        self.sleep = sleep
+        self.wall = wall
+
+        self.cycles = 0
+        self.skipped = 0
+        self.max_lateness = 0.0
+        self._deadline = None
+        self._previous = None
+        self._behind = 0
+        # running mean and variance of lateness (Welford's method)
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    def wait(self):
+        """Sleep until the next cycle is due and return its Tick."""
+        now = self.clock()
+        if self._deadline is None:
+            # first cycle starts straight away
+            self._deadline = now
+        skipped = 0
+        if now - self._deadline >= self.period:
+            # we've missed at least one whole deadline
+            missed = int((now - self._deadline) // self.period)
+            if self.policy == 'skip' or self._behind >= self.max_catch_up:
+                self._deadline += missed * self.period
+                skipped = missed
+                self._behind = 0
+            else:
+                self._behind += 1
+        else:
+            self._behind = 0
+        while now < self._deadline:
+            self.sleep(self._deadline - now)
+            now = self.clock()
+
+        interval = now - self._previous if self._previous is not None else 0.0
+        lateness = now - self._deadline
+        tick = Tick(self.cycles, self._deadline, now, self.wall(), interval, lateness, skipped)
+
+        self.cycles += 1
+        self.skipped += skipped
+        self.max_lateness = max(self.max_lateness, lateness)
+        delta = lateness - self._mean
+        self._mean += delta / self.cycles
+        self._m2 += delta * (lateness - self._mean)
+
+        self._previous = now
+        self._deadline += self.period
+        return tick
+
+    def mean_lateness(self):
+        return self._mean
+
+    def jitter(self):
+        # standard deviation of lateness, in seconds
+        if self.cycles < 2:
+            return 0.0
+        return math.sqrt(self._m2 / (self.cycles - 1))
@@ -0,0 +1,266 @@
+# A write-ahead spool on local storage (the SD card on a Pi).
+#
+# Every point is appended here before anything tries to send it to InfluxDB,
+# so if the server is down for a few hours (or ampread gets restarted) the
+# readings are still on disk and get replayed once it's back.
+#
+# The spool is a directory of append-only segment files. Each record is one
+# line of text:
+#
+#     <database> <influxdb line protocol>\n
+#
+# A small "cursor" file remembers how far the replayer has got. Segments are
+# deleted once everything in them has been sent. To keep the card from
+# filling up, the total size is capped at max_bytes; past that the oldest
+# segment is thrown away (and counted in dropped_records).
+#
+# Records InfluxDB refuses outright (a line it can't parse, a field type
+# conflict) would block everything behind them if they were retried, so
+# they are moved to a "rejected" file in the same format instead, to look
+# at by hand. It keeps about segment_bytes, the one before goes to
+# "rejected.1".
+#
+# fsync policy:
+#   'always'   - fsync after every append, safest but the hardest on an SD card
+#   'interval' - fsync at most every fsync_interval seconds (default)
+#   'never'    - leave it to the OS
+
+import os
+import threading
+import time
+
+SEGMENT_SUFFIX = '.log'
+CURSOR_FILE = 'cursor'
+REJECTED_FILE = 'rejected'
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+
+def _segment_name(number):
+    return '%010d%s' % (number, SEGMENT_SUFFIX)
+
+
+class Spool(object):
+    """Append-only, size-bounded spool of line protocol records.
+
+    append() adds records, read() returns the oldest unsent ones along with a
+    position, and commit(position) marks everything before it as sent.
+    """
+
+    persistent = True
+
+    def __init__(self, directory, segment_bytes=1024 * 1024, max_bytes=64 * 1024 * 1024,
+                 fsync='interval', fsync_interval=5.0):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('fsync must be one of: %s' % ', '.join(FSYNC_POLICIES))
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.dropped_records = 0
+
+        self._lock = threading.Lock()
+        self._last_sync = time.monotonic()
+        self._dirty = False
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._segments = self._scan()
+        self._cursor = self._load_cursor()
+        # Always start a fresh segment so we never append after a line that
+        # was cut short by a crash or power cut.
+        number = self._segments[-1] + 1 if self._segments else 1
+        self._open(number)
+
+    # -- files ---------------------------------------------------------------
+
+    def _path(self, number):
+        return os.path.join(self.directory, _segment_name(number))
+
+    def _scan(self):
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SEGMENT_SUFFIX):
+                try:
+                    numbers.append(int(name[:-len(SEGMENT_SUFFIX)]))
+                except ValueError:
+                    pass
+        return sorted(numbers)
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE)) as f:
+                number, offset = f.read().split()
+            cursor = (int(number), int(offset))
+        except (IOError, OSError, ValueError):
+            cursor = (self._segments[0], 0) if self._segments else (1, 0)
+        # the segment the cursor points at may have been dropped or finished
+        if self._segments and cursor[0] < self._segments[0]:
+            cursor = (self._segments[0], 0)
+        return cursor
+
+    def _save_cursor(self):
+        # write then rename so a crash leaves either the old or new cursor
+        path = os.path.join(self.directory, CURSOR_FILE)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('%d %d\n' % self._cursor)
+            if self.fsync != 'never':
+                f.flush()
+                os.fsync(f.fileno())
+        os.rename(tmp, path)
+
+    def _open(self, number):
+        self._active = number
+        self._file = open(self._path(number), 'ab')
+        self._active_size = self._file.tell()
+        if number not in self._segments:
+            self._segments.append(number)
+
+    def _size(self):
+        total = 0
+        for number in self._segments:
+            if number == self._active:
+                total += self._active_size
+            else:
+                try:
+                    total += os.path.getsize(self._path(number))
+                except OSError:
+                    pass
+        return total
+
+    def _sync(self, force=False):
+        if not self._dirty:
+            return
+        now = time.monotonic()
+        if force or self.fsync == 'always' or (
+                self.fsync == 'interval' and now - self._last_sync >= self.fsync_interval):
+            os.fsync(self._file.fileno())
+            self._last_sync = now
+            self._dirty = False
+
+    def _drop_oldest(self):
+        # Throw away the oldest closed segment to stay under max_bytes.
+        number = self._segments[0]
+        if number == self._active:
+            return False
+        path = self._path(number)
+        with open(path, 'rb') as f:
+            if number == self._cursor[0]:
+                f.seek(self._cursor[1])
+            self.dropped_records += f.read().count(b'\n')
+        os.remove(path)
+        self._segments.pop(0)
+        if self._cursor[0] <= number:
+            self._cursor = (self._segments[0], 0)
+            self._save_cursor()
+        return True
+
+    # -- writing -------------------------------------------------------------
+
+    def append(self, database, lines):
+        """Add line protocol ``lines`` (strings, no newlines) for ``database``."""
+        if not lines:
+            return
+        if ' ' in database:
+            raise ValueError('database name %r has a space in it' % database)
+        prefix = database + ' '
+        data = ''.join([prefix + line + '\n' for line in lines]).encode('utf-8')
+        with self._lock:
+            self._file.write(data)
+            self._file.flush()
+            self._active_size += len(data)
+            self._dirty = True
+            self._sync()
+            if self._active_size >= self.segment_bytes:
+                self._sync(force=True)
+                self._file.close()
+                self._open(self._active + 1)
+            while self._size() > self.max_bytes and self._drop_oldest():
+                pass
+
+    # -- reading -------------------------------------------------------------
+
+    def read(self, max_records):
+        """Return (batches, position) for up to ``max_records`` unsent records.
+
+        ``batches`` is a list of (database, [lines]), one entry per database
+        with its lines in the order they were written. Pass ``position`` to commit() once they've been sent.
+        """
+        with self._lock:
+            self._file.flush()
+            number, offset = self._cursor
+            segments = [n for n in self._segments if n >= number]
+            active = self._active
+        batches = {}
+        count = 0
+        position = (number, offset)
+        for n in segments:
+            if count >= max_records:
+                break
+            start = offset if n == number else 0
+            try:
+                f = open(self._path(n), 'rb')
+            except (IOError, OSError):
+                continue
+            with f:
+                f.seek(start)
+                pos = start
+                for raw in f:
+                    if not raw.endswith(b'\n'):
+                        # a half written line: still being written if this is
+                        # the active segment, otherwise cut off by a crash
+                        break
+                    pos += len(raw)
+                    database, _, line = raw.decode('utf-8', 'replace').rstrip('\n').partition(' ')
+                    lines = batches.get(database)
+                    if lines is None:
+                        lines = batches[database] = []
+                    lines.append(line)
+                    count += 1
+                    if count >= max_records:
+                        break
+            position = (n, pos)
+            if n == active or count >= max_records:
+                break
+            # finished this segment, carry on at the start of the next one
+            position = (n + 1, 0)
+        return list(batches.items()), position
+
+    def commit(self, position):
+        """Mark everything before ``position`` (from read()) as sent."""
+        with self._lock:
+            if position <= self._cursor:
+                return
+            self._cursor = position
+            # delete segments we've completely finished with
+            while self._segments and self._segments[0] < position[0] and self._segments[0] != self._active:
+                try:
+                    os.remove(self._path(self._segments[0]))
+                except OSError:
+                    pass
+                self._segments.pop(0)
+            self._save_cursor()
+
+    def quarantine(self, database, lines):
+        """Keep ``lines`` InfluxDB wouldn't take in the rejected file, see the top of the file."""
+        path = os.path.join(self.directory, REJECTED_FILE)
+        data = ''.join([database + ' ' + line + '\n' for line in lines]).encode('utf-8')
+        with self._lock:
+            try:
+                if os.path.getsize(path) + len(data) > self.segment_bytes:
+                    os.replace(path, path + '.1')
+            except OSError:
+                pass
+            with open(path, 'ab') as f:
+                f.write(data)
+
+    def pending_bytes(self):
+        # roughly how much is waiting to be sent
+        with self._lock:
+            return max(self._size() - self._cursor[1], 0)
+
+    def close(self):
+        with self._lock:
+            self._sync(force=True)
+            self._file.close()
@@ -0,0 +1,321 @@
+# Keep the readings in a local SQLite database, for installs with no InfluxDB.
+#
+# SQLiteStore takes the same write(points, database) calls as InfluxWriter
+# (point dicts or line protocol bytes), so the sink can write to either or
+# both. Every numeric field of every point becomes one row:
+#
+#   series                         one row per database, measurement, tags
+#     id, database, measurement,   and field, e.g. ampread / current /
+#     tags, field                  {"tou":"onpeak","tou_schedule":"Winter"} / ampsA0
+#
+#   samples_YYYYMM                 one table per (UTC) month
+#     time    INTEGER  milliseconds since 1970
+#     series  INTEGER  series.id
+#     value   REAL     (true/false are 1/0)
+#
+# String fields (the tariff schedule name, burst waveforms) aren't kept.
+#
+# Going easy on an SD card:
+#   - WAL journal with synchronous=NORMAL, so a commit is one append to the
+#     WAL file and no fsync of the database itself
+#   - rows are held in memory and inserted with executemany() in a single
+#     transaction every ``max_age`` seconds (or ``batch_size`` rows), new
+#     series rows included, so a crash never leaves a series with no samples
+#   - the samples tables are WITHOUT ROWID tables keyed on (time, series).
+#     Readings arrive in time order, so every insert lands on the last page
+#     and there is no separate index to update
+#   - old months are dropped a whole table at a time (``keep_months``)
+#     instead of deleting rows one by one
+#
+# A commit every minute loses at most that minute of readings if the power
+# goes. query() and downsample() read it back, or from the command line:
+#
+#   python3 -m ampread.sqlitestore ampread.db --series
+#   python3 -m ampread.sqlitestore ampread.db current ampsA0 --start 2019-03-01 --every 3600
+
+import argparse
+import calendar
+import datetime
+import json
+import sqlite3
+import sys
+import time
+
+from ampread.lineprotocol import PRECISIONS, iso_seconds, parse_line
+
+AGGREGATES = {'mean': 'avg', 'min': 'min', 'max': 'max', 'sum': 'sum', 'count': 'count'}
+
+
+def month_start(seconds):
+    # the UTC month a time is in, as (YYYYMM, start, start of next) in seconds
+    t = time.gmtime(seconds)
+    start = calendar.timegm((t.tm_year, t.tm_mon, 1, 0, 0, 0))
+    year, month = (t.tm_year + 1, 1) if t.tm_mon == 12 else (t.tm_year, t.tm_mon + 1)
+    return t.tm_year * 100 + t.tm_mon, start, calendar.timegm((year, month, 1, 0, 0, 0))
+
+
+def _tag_text(tags):
+    # tags as they are stored, JSON with the keys sorted
+    return json.dumps(tags, sort_keys=True, separators=(',', ':'))
+
+
+class SQLiteStore(object):
+    """Store points in the SQLite database at ``path``, see the top of the file.
+
+    ``precision`` is the precision of line protocol timestamps handed to
+    write(), like InfluxWriter's. ``keep_months`` drops months older than
+    that many (None keeps everything).
+    """
+
+    def __init__(self, path, database='ampread', precision='n', batch_size=5000, max_age=60.0,
+                 keep_months=None):
+        if precision not in PRECISIONS:
+            raise ValueError('precision must be one of: %s' % ', '.join(sorted(PRECISIONS)))
+        self.path = path
+        self.database = database
+        self.precision = precision
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.keep_months = keep_months
+
+        self.written = 0
+        self.skipped = 0            # string fields, which aren't stored
+        self.dropped = 0
+
+        self._per_second = PRECISIONS[precision]
+        self._rows = {}             # month -> [(time, series, value)] waiting to be inserted
+        self._waiting = 0
+        self._oldest = None
+        self._month = (None, 0, 0)  # the last month a row fell in, usually the next one's too
+        # isolation_level None: we start our own transactions
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        # keep the WAL file from sitting at its biggest size after a checkpoint
+        self.db.execute('PRAGMA journal_size_limit=%d' % (4 * 1024 * 1024))
+        self.db.execute('CREATE TABLE IF NOT EXISTS series ('
+                        'id INTEGER PRIMARY KEY, database TEXT NOT NULL, measurement TEXT NOT NULL, '
+                        'tags TEXT NOT NULL, field TEXT NOT NULL, '
+                        'UNIQUE (database, measurement, tags, field))')
+        self._series = {}
+        for row in self.db.execute('SELECT id, database, measurement, tags, field FROM series'):
+            self._series[row[1:]] = row[0]
+        # series first seen since the last flush, (id, database, measurement, tags, field)
+        self._new_series = []
+        self._next_id = max(self._series.values() or [0]) + 1
+        self._months = set(self._list_months())
+
+    # -- writing -------------------------------------------------------------
+
+    def write(self, points, database=None):
+        # Queue points (dicts, or line protocol bytes) and insert them if a
+        # flush is due.
+        database = database or self.database
+        if isinstance(points, bytes):
+            for line in points.decode('utf-8').splitlines():
+                measurement, tags, fields, stamp = parse_line(line)
+                seconds = time.time() if stamp is None else stamp / float(self._per_second)
+                self._add(database, measurement, tags, fields, seconds)
+        else:
+            for point in points:
+                stamp = point.get('time')
+                if stamp is None:
+                    stamp = time.time()
+                elif isinstance(stamp, str):
+                    stamp = iso_seconds(stamp)
+                self._add(database, point['measurement'], point.get('tags') or {}, point['fields'], stamp)
+        if self._waiting >= self.batch_size or (
+                self._oldest is not None and time.monotonic() - self._oldest >= self.max_age):
+            self.flush()
+
+    def _add(self, database, measurement, tags, fields, seconds):
+        month, start, end = self._month
+        if not start <= seconds < end:
+            month, start, end = self._month = month_start(seconds)
+        rows = self._rows.get(month)
+        if rows is None:
+            rows = self._rows[month] = []
+        ms = int(round(seconds * 1000))
+        tag_text = None
+        for field, value in fields.items():
+            if value is None or isinstance(value, str):
+                self.skipped += 1
+                continue
+            if tag_text is None:
+                tag_text = _tag_text(tags)
+            key = (database, measurement, tag_text, field)
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = self._next_id
+                self._next_id += 1
+                self._new_series.append((series,) + key)
+            rows.append((ms, series, float(value)))
+            self._waiting += 1
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+
+    def flush(self):
+        # Insert everything waiting, one transaction for the lot.
+        if not self._rows:
+            return True
+        rows, self._rows = self._rows, {}
+        new_series, self._new_series = self._new_series, []
+        count, self._waiting, self._oldest = self._waiting, 0, None
+        try:
+            self.db.execute('BEGIN')
+            if new_series:
+                self.db.executemany('INSERT INTO series (id, database, measurement, tags, field) '
+                                    'VALUES (?, ?, ?, ?, ?)', new_series)
+            for month, month_rows in sorted(rows.items()):
+                if month not in self._months:
+                    self._create_month(month)
+                # a repeated (time, series) replaces the value, like InfluxDB does
+                self.db.executemany('INSERT OR REPLACE INTO samples_%d VALUES (?, ?, ?)' % month,
+                                    month_rows)
+            self.db.execute('COMMIT')
+        except sqlite3.Error as e:
+            if self.db.in_transaction:
+                self.db.execute('ROLLBACK')
+            self._months = set(self._list_months())
+            # those series aren't in the database, add them again next time they turn up
+            for row in new_series:
+                del self._series[row[1:]]
+            self.dropped += count
+            print('ampread: could not store %d readings in %s: %s' % (count, self.path, e))
+            return False
+        self.written += count
+        return True
+
+    def _create_month(self, month):
+        self.db.execute('CREATE TABLE IF NOT EXISTS samples_%d ('
+                        'time INTEGER NOT NULL, series INTEGER NOT NULL, value REAL, '
+                        'PRIMARY KEY (time, series)) WITHOUT ROWID' % month)
+        self._months.add(month)
+        if self.keep_months:
+            for old in sorted(self._months)[:-self.keep_months]:
+                self.db.execute('DROP TABLE samples_%d' % old)
+                self._months.discard(old)
+
+    def _list_months(self):
+        return [int(name[len('samples_'):]) for (name,) in self.db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'samples_%'")]
+
+    def pending(self):
+        return self._waiting
+
+    def close(self, flush=True):
+        if flush:
+            self.flush()
+        self.db.close()
+
+    # -- reading -------------------------------------------------------------
+
+    def series(self, measurement=None, field=None, database=None, **tags):
+        """The stored series as (id, database, measurement, tags, field) tuples,
+        ``tags`` a dict. Every argument given has to match; tags only have to
+        be among a series' tags."""
+        found = []
+        for (db, m, tag_text, f), series_id in sorted(self._series.items(), key=lambda item: item[1]):
+            if measurement is not None and m != measurement:
+                continue
+            if field is not None and f != field:
+                continue
+            if database is not None and db != database:
+                continue
+            have = json.loads(tag_text)
+            if any(have.get(k) != str(v) for k, v in tags.items()):
+                continue
+            found.append((series_id, db, m, have, f))
+        return found
+
+    def _select(self, measurement, field, start, end, database, tags, columns):
+        # SELECT <columns> over every month table the range touches
+        ids = [s[0] for s in self.series(measurement, field, database or self.database, **tags)]
+        if not ids:
+            return None
+        start_ms, end_ms = int(start * 1000), int(end * 1000)
+        selects = []
+        for month in sorted(self._months):
+            first, last = month_start(calendar.timegm((month // 100, month % 100, 1, 0, 0, 0)))[1:]
+            if last * 1000 > start_ms and first * 1000 < end_ms:
+                selects.append('SELECT %s FROM samples_%d WHERE time >= %d AND time < %d AND series IN (%s)'
+                               % (columns, month, start_ms, end_ms, ','.join(str(i) for i in ids)))
+        if not selects:
+            return None
+        return ' UNION ALL '.join(selects)
+
+    def query(self, measurement, field, start, end=None, database=None, **tags):
+        """Every (time, value) of a field between ``start`` and ``end``
+        (epoch seconds, end defaults to now), oldest first. Tags narrow it
+        down to some of the series; readings from several come out mixed.
+        """
+        self.flush()
+        end = time.time() if end is None else end
+        sql = self._select(measurement, field, start, end, database, tags, 'time, value')
+        if sql is None:
+            return []
+        return [(t / 1000.0, value) for t, value in self.db.execute(sql + ' ORDER BY time')]
+
+    def downsample(self, measurement, field, start, end=None, every=3600, how='mean', database=None,
+                   **tags):
+        """(time, value) for each ``every`` seconds between ``start`` and ``end``,
+        ``how`` being mean, min, max, sum or count of the readings in it.
+        Buckets start on multiples of ``every`` since 1970 (UTC midnight for days).
+        """
+        if how not in AGGREGATES:
+            raise ValueError('how must be one of: %s' % ', '.join(sorted(AGGREGATES)))
+        self.flush()
+        end = time.time() if end is None else end
+        sql = self._select(measurement, field, start, end, database, tags, 'time, value')
+        if sql is None:
+            return []
+        bucket = int(every * 1000)
+        sql = ('SELECT time / %d * %d AS bucket, %s(value) FROM (%s) GROUP BY bucket ORDER BY bucket'
+               % (bucket, bucket, AGGREGATES[how], sql))
+        return [(t / 1000.0, value) for t, value in self.db.execute(sql)]
+
+
+def _day(text):
+    return calendar.timegm(datetime.datetime.strptime(text, '%Y-%m-%d').timetuple())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Read back the readings in an ampread SQLite database')
+    parser.add_argument('path', help='the database file')
+    parser.add_argument('measurement', nargs='?')
+    parser.add_argument('field', nargs='?')
+    parser.add_argument('--series', action='store_true', help='list the series stored')
+    parser.add_argument('--database', default='ampread')
+    parser.add_argument('--tag', action='append', default=[], metavar='KEY=VALUE',
+                        help='only series with this tag (repeat for more)')
+    parser.add_argument('--start', metavar='YYYY-MM-DD', help='UTC day to start at (default a day ago)')
+    parser.add_argument('--end', metavar='YYYY-MM-DD', help='UTC day to stop before (default now)')
+    parser.add_argument('--every', type=float, help='seconds per downsampled reading')
+    parser.add_argument('--how', default='mean', choices=sorted(AGGREGATES))
+    args = parser.parse_args(argv)
+
+    store = SQLiteStore(args.path, args.database)
+    try:
+        tags = dict(tag.split('=', 1) for tag in args.tag)
+        if args.series or not args.field:
+            for series_id, db, measurement, series_tags, field in store.series(args.measurement,
+                                                                               database=args.database, **tags):
+                print('%d\t%s\t%s\t%s\t%s' % (series_id, db, measurement, _tag_text(series_tags), field))
+            return 0
+        start = _day(args.start) if args.start else time.time() - 86400
+        end = _day(args.end) if args.end else None
+        if args.every:
+            rows = store.downsample(args.measurement, args.field, start, end, args.every, args.how,
+                                    args.database, **tags)
+        else:
+            rows = store.query(args.measurement, args.field, start, end, args.database, **tags)
+        for t, value in rows:
+            when = datetime.datetime.fromtimestamp(t, datetime.timezone.utc).replace(tzinfo=None)
+            print('%s\t%s' % (when.isoformat() + 'Z', value))
+    finally:
+        store.close(flush=False)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,431 @@
+# The three stages ampread_python3e.py runs in its pipeline (see pipeline.py).
+#
+#   AcquireWorker - owns the ADCs and the cycle scheduler. All it does is
+#                   sample on time and pass the raw readings on, plus a
+#                   burst capture every so often (see burst.py).
+#   ProcessWorker - true RMS amps, UPS voltage, TOU rate, kW/kWh/cost,
+#                   harmonics of the bursts, the 1m/15m/1h rollups (see
+#                   rollup.py) and the influxdb points, already in line
+#                   protocol (see lineprotocol.py), every cycle or only when
+#                   they move (see deadband.py). Optionally serves the
+#                   latest readings to Prometheus (see exporter.py).
+#   SinkWorker    - hands the points to the InfluxWriter (and its spool),
+#                   after setting up the retention policies and continuous
+#                   queries (see retention.py), and/or a local SQLiteStore
+#                   (see sqlitestore.py).
+#
+# Each one is built in the main process from plain settings and opens its
+# hardware, sockets and threads in setup(), inside its own process.
+#
+# Given a ``telemetry`` interval in seconds, each stage also times its own
+# work (see telemetry.py) and sends an ampread_internal report that often.
+# The acquire stage's reports go through the process stage like everything
+# else.
+
+import signal
+import time
+
+from ampread import power
+from ampread.autorange import AutoRanger
+from ampread.burst import Burst, BurstCapture, analyze_burst, encode_waveform
+from ampread.config import load_config
+from ampread.deadband import ReportByException
+from ampread.exporter import MetricsExporter, Snapshot
+from ampread.influx import WRITE_ERRORS, InfluxWriter
+from ampread.lineprotocol import LineEncoder
+from ampread.pipeline import interruptible_sleep
+from ampread.points import ups_point, waveform_point, write_current, write_voltage
+from ampread.retention import ensure_schema, late_after, materialize
+from ampread.rollup import Rollup
+from ampread.scheduler import CycleScheduler
+from ampread.spool import Spool
+from ampread.sqlitestore import SQLiteStore
+from ampread.tariff import load_tariff
+from ampread.telemetry import Report, Telemetry
+from ampread.ups import UPSPoller
+
+
+class Reading(object):
+    """One cycle's raw samples, from the acquire stage to the process stage.
+
+    ``tick`` is the scheduler's Tick, ``data`` a copy of each ADC's buffer
+    (in config order), ``rates`` the sample rates each ADC achieved and
+    ``duration`` how long sampling took in seconds. When autoranging,
+    ``gains`` and ``counts`` are what each channel was read with (see
+    AutoRanger.plan()), otherwise None.
+    """
+
+    __slots__ = ('tick', 'data', 'rates', 'duration', 'gains', 'counts')
+
+    def __init__(self, tick, data, rates, duration, gains=None, counts=None):
+        self.tick = tick
+        self.data = data
+        self.rates = rates
+        self.duration = duration
+        self.gains = gains
+        self.counts = counts
+
+
+class AcquireWorker(object):
+    """Sample every configured ADC once per cycle.
+
+    Every ``burst_every`` seconds (never if None), and whenever the process
+    gets SIGUSR1, a ``burst_seconds`` burst capture of every channel follows
+    that cycle's sampling.
+
+    With "autorange" in the config, an AutoRanger picks each channel's gain
+    and sample count from one cycle to the next.
+    """
+
+    def __init__(self, config_file, simulate=False, period=20.0, policy='skip',
+                 burst_every=None, burst_seconds=0.2, telemetry=None):
+        self.config_file = config_file
+        self.simulate = simulate
+        self.period = period
+        self.policy = policy
+        self.burst_every = burst_every
+        self.burst_seconds = burst_seconds
+        self.burst_requested = False
+        self.telemetry_interval = telemetry
+
+    def setup(self, stop):
+        self.registry = load_config(self.config_file)
+        self.acquisition = self.registry.build(simulate=self.simulate)
+        self.ranger = None
+        if self.registry.autorange is not None:
+            self.ranger = AutoRanger(self.registry, self.acquisition, **self.registry.autorange)
+        # the scheduler's sleep wakes up straight away when the pipeline stops
+        self.scheduler = CycleScheduler(self.period, self.policy, sleep=interruptible_sleep(stop))
+        self.burst = BurstCapture(self.registry, self.burst_seconds)
+        self.next_burst = time.monotonic() if self.burst_every else None
+        signal.signal(signal.SIGUSR1, self.request_burst)
+        self.telemetry = None
+        if self.telemetry_interval:
+            self.telemetry = Telemetry('acquire', self.telemetry_interval)
+            # every I2C read, per ADC
+            for adc, sampler in zip(self.registry.adcs, self.acquisition.samplers):
+                sampler.latency = self.telemetry.histogram('i2c_read_%s' % adc.name)
+
+    def request_burst(self, signum=None, frame=None):
+        # take a burst at the end of the next cycle
+        self.burst_requested = True
+
+    def __call__(self, item):
+        tick = self.scheduler.wait()
+        frame = self.acquisition.acquire(self.registry.samples)
+        gains = counts = None
+        if self.ranger is not None:
+            # what this frame was read with, then the plan for the next one
+            gains, counts = self.ranger.plan()
+            self.ranger.update(frame)
+        # the buffers are reused next cycle, so send a copy
+        results = [Reading(tick, [buffer.data.copy() for buffer in frame.buffers],
+                           frame.rates, frame.duration(), gains, counts)]
+        if self.burst_requested or (self.next_burst is not None and tick.started >= self.next_burst):
+            self.burst_requested = False
+            if self.next_burst is not None:
+                self.next_burst = tick.started + self.burst_every
+            started = time.monotonic()
+            # at the gains the ranger just picked, bursts clip like anything else
+            results.extend(self.burst.capture(self.ranger.plan()[0] if self.ranger is not None else None))
+            if self.telemetry is not None:
+                self.telemetry.observe('burst', time.monotonic() - started)
+        telemetry = self.telemetry
+        if telemetry is not None:
+            telemetry.observe('sampling', frame.duration())
+            telemetry.observe('lateness', tick.lateness)
+            if counts is not None:
+                telemetry.gauge('reads', sum(sum(n) for n in counts))
+            if tick.skipped:
+                telemetry.count('skipped_cycles', tick.skipped)
+            if telemetry.due():
+                results.append(Report(telemetry.points()))
+        return results
+
+    def close(self):
+        if hasattr(self, 'burst'):
+            self.burst.close()
+        if hasattr(self, 'acquisition'):
+            self.acquisition.close()
+
+
+class ProcessWorker(object):
+    """Turn a Reading or Burst into (database, line protocol) pairs for the sink.
+
+    ``ups`` is a NUTClient or ApcupsdClient; it is polled in the background
+    every ``ups_interval`` seconds and ``nominal_voltage`` is used once its
+    reading is more than ``ups_ttl`` seconds old. With ``store_waveforms``
+    each burst's encoded waveform is stored along with its harmonics.
+
+    The amps, voltage and kW are rolled up over each of ``rollup_windows``
+    (seconds, empty for none) into current_1m, voltage_15m... measurements.
+    ``write_raw`` False leaves out the per-cycle points and only writes those.
+
+    Timestamps are in ``precision``, which must be the sink's InfluxWriter's.
+    ``metrics`` are MetricsExporter arguments to serve the latest readings
+    over HTTP (None for no exporter). ``exception`` are ReportByException
+    arguments to only write the per-cycle points when they move (see
+    deadband.py), None to write them every cycle.
+    """
+
+    def __init__(self, config_file, tariff_file, ups, ups_interval=10.0, ups_ttl=60.0,
+                 nominal_voltage=120.0, places=2, store_waveforms=True,
+                 rollup_windows=(60, 900, 3600), write_raw=True, precision='n', metrics=None,
+                 telemetry=None, exception=None):
+        self.config_file = config_file
+        self.tariff_file = tariff_file
+        self.ups = ups
+        self.ups_interval = ups_interval
+        self.ups_ttl = ups_ttl
+        self.nominal_voltage = nominal_voltage
+        self.places = places
+        self.store_waveforms = store_waveforms
+        self.rollup_windows = tuple(rollup_windows or ())
+        self.write_raw = write_raw
+        self.precision = precision
+        self.metrics = metrics
+        self.telemetry_interval = telemetry
+        self.exception = exception
+        self.ups_written = None   # time of the last UPS reading sent to influxdb
+
+    def setup(self, stop):
+        self.registry = load_config(self.config_file)
+        self.buffers = self.registry.make_buffers()
+        self.tariff = load_tariff(self.tariff_file)
+        self.telemetry = None
+        ups_latency = None
+        if self.telemetry_interval:
+            self.telemetry = Telemetry('process', self.telemetry_interval)
+            ups_latency = self.telemetry.histogram('ups_poll')
+        self.ups_poller = UPSPoller(self.ups, self.ups_interval, self.ups_ttl, ups_latency).start()
+        self.encoder = LineEncoder(self.precision)
+        self.exporter = None
+        if self.metrics is not None:
+            self.exporter = MetricsExporter(**self.metrics).start()
+            self.kwh_totals = {}    # TOU band -> kWh since we started
+            self.cost_totals = {}
+        self.by_exception = None
+        if self.exception is not None:
+            self.by_exception = ReportByException(**self.exception)
+        self.rollups = None
+        if self.rollup_windows:
+            self.rollups = (Rollup('current', self.rollup_windows), Rollup('voltage', self.rollup_windows))
+
+    def __call__(self, item):
+        if isinstance(item, Burst):
+            return self.burst_points(item)
+        if isinstance(item, Report):
+            # an upstream stage's telemetry, on its way to the sink
+            for point in item.points:
+                self.encoder.add_point(point)
+            return [(None, self.encoder.take())]
+        return self.cycle_points(item)
+
+    def cycle_points(self, reading):
+        tick = reading.tick
+        places = self.places
+        telemetry = self.telemetry
+        if telemetry is not None:
+            started = time.perf_counter()
+        for buffer, data in zip(self.buffers, reading.data):
+            buffer.data[...] = data
+
+        # true RMS amps for every circuit, keyed by the name in ampread.json
+        amps = self.registry.amps(places=places, gains=reading.gains, counts=reading.counts)
+        if telemetry is not None:
+            telemetry.observe('rms', time.perf_counter() - started)
+
+        # Latest UPS reading from the background poller, never waits on the network.
+        # If it's stale, or the UPS didn't report a voltage, use the nominal voltage
+        # for kW and flag it.
+        ups_now = self.ups_poller.latest()
+        ups = ups_now.values
+        voltage_stale = ups_now.stale or ups.get('LINEV') is None
+        if voltage_stale:
+            LINEV = self.nominal_voltage
+        else:
+            LINEV = ups['LINEV']
+
+        # total amps to kilowatts, the TOU rate for when this cycle started, kWh
+        # over the time since the last cycle and the cost/hour at this usage
+        kilowatts = float(power.kilowatts(self.registry.total_amps(amps), LINEV, places))
+        if telemetry is not None:
+            started = time.perf_counter()
+        rate, tou, schedule = self.tariff.rate_at(tick.time)
+        if telemetry is not None:
+            telemetry.observe('tariff', time.perf_counter() - started)
+        kwh = float(power.kwh(kilowatts, tick.interval))
+        cph = float(power.cost_per_hour(kilowatts, rate, places))
+
+        if self.exporter is not None:
+            self.kwh_totals[tou] = self.kwh_totals.get(tou, 0.0) + kwh
+            self.cost_totals[tou] = self.cost_totals.get(tou, 0.0) + kwh * rate
+            self.exporter.publish(Snapshot(tick.time, amps, kilowatts, LINEV, voltage_stale, rate, tou, schedule,
+                                           dict(self.kwh_totals), dict(self.cost_totals),
+                                           {} if ups_now.stale else ups))
+
+        if telemetry is not None:
+            started = time.perf_counter()
+        encoder = self.encoder
+        if self.write_raw and self.by_exception is not None:
+            self.by_exception.write(encoder, tick.time, schedule, tou, amps, LINEV, rate, cph, kwh, kilowatts,
+                                    voltage_stale, tick.interval, tick.lateness)
+        elif self.write_raw:
+            write_current(encoder, tick.time, schedule, tou, amps)
+            write_voltage(encoder, tick.time, schedule, tou, LINEV, rate, cph, kwh, kilowatts, voltage_stale,
+                          tick.interval, tick.lateness)
+
+        # points for any rollup windows this cycle closed. kWh and cost are totalled.
+        # A TOU change closes the windows, so each one's kWh is all in one band.
+        if self.rollups is not None:
+            tags = {"tou_schedule": schedule, "tou": tou}
+            current, voltage = self.rollups
+            rolled = current.add(tick.time, amps, tags=tags)
+            rolled += voltage.add(tick.time, {"voltage": LINEV, "kilowatts": kilowatts},
+                                  {"kwh": kwh, "cost": kwh * rate}, tags)
+            for point in rolled:
+                encoder.add_point(point)
+
+        results = []
+        if encoder.buffer:
+            results.append((None, encoder.take()))
+        if telemetry is not None:
+            # rollups and line protocol
+            telemetry.observe('points', time.perf_counter() - started)
+            telemetry.gauge('ups_age', ups_now.age if ups_now.age is not None else -1.0)
+            if self.by_exception is not None:
+                telemetry.gauge('fields_written', self.by_exception.written)
+                telemetry.gauge('fields_skipped', self.by_exception.skipped)
+            if telemetry.due():
+                for point in telemetry.points():
+                    encoder.add_point(point)
+                results.append((None, encoder.take()))
+
+        # UPS values only when the poller has a fresh reading we haven't sent yet,
+        # stamped with the time it was read
+        if not ups_now.stale and ups_now.time != self.ups_written:
+            point = ups_point(ups)
+            encoder.add(point["measurement"], point["tags"], point["fields"], ups_now.time)
+            results.append(('ups_stats', encoder.take()))
+            self.ups_written = ups_now.time
+        return results
+
+    def burst_points(self, burst):
+        # harmonics, THD and the waveform itself, one point per circuit
+        started = time.perf_counter()
+        stats = analyze_burst(burst.data, burst.rates, burst.scale)
+        if self.telemetry is not None:
+            self.telemetry.observe('burst_analysis', time.perf_counter() - started)
+        for i, name in enumerate(burst.names):
+            waveform = None
+            if self.store_waveforms:
+                waveform = encode_waveform(burst.data[i], burst.rates[i], burst.scale[i])
+            point = waveform_point(None, name, burst.adc, stats.frequency[i], stats.fundamental[i],
+                                   stats.rms[i], stats.peak[i], stats.crest[i], stats.thd[i],
+                                   stats.harmonics[i], waveform)
+            self.encoder.add(point["measurement"], point["tags"], point["fields"], burst.time)
+        return [(None, self.encoder.take())]
+
+    def flush(self):
+        # the rollup windows still open and the kWh not written yet, so a
+        # restart doesn't lose them
+        if getattr(self, 'by_exception', None) is not None:
+            self.by_exception.flush(self.encoder)
+        if getattr(self, 'rollups', None):
+            for point in self.rollups[0].flush() + self.rollups[1].flush():
+                self.encoder.add_point(point)
+        return [(None, self.encoder.take())] if self.encoder.buffer else []
+
+    def close(self):
+        if getattr(self, 'exporter', None) is not None:
+            self.exporter.stop()
+        if hasattr(self, 'ups_poller'):
+            self.ups_poller.stop()
+
+
+class SinkWorker(object):
+    """Write (database, points) pairs to influxdb and/or SQLite, points being
+    line protocol bytes or point dicts.
+
+    ``influx`` are the InfluxWriter arguments (None for no influxdb). With
+    ``spool_dir`` every point goes through a Spool there first (``spool``
+    are its other arguments). ``schema`` are ensure_schema() arguments to
+    run at startup (None to skip), whose continuous queries are also run
+    again over any readings replayed too late for them. ``sqlite`` are
+    SQLiteStore arguments (None for no SQLite).
+    """
+
+    def __init__(self, influx, spool_dir=None, spool=None, schema=None, sqlite=None, telemetry=None):
+        if not influx and not sqlite:
+            raise ValueError('nowhere to write the points, give influx or sqlite settings')
+        self.influx_args = dict(influx) if influx else None
+        self.spool_dir = spool_dir
+        self.spool_args = dict(spool or {})
+        self.schema = schema
+        self.sqlite_args = dict(sqlite) if sqlite else None
+        self.telemetry_interval = telemetry
+
+    def setup(self, stop):
+        self.writers = []
+        self.influx = None
+        self.telemetry = None
+        if self.telemetry_interval:
+            self.telemetry = Telemetry('sink', self.telemetry_interval)
+        if self.sqlite_args is not None:
+            self.writers.append(SQLiteStore(**self.sqlite_args))
+        if self.influx_args is None:
+            return
+        queue = Spool(self.spool_dir, **self.spool_args) if self.spool_dir else None
+        latency = self.telemetry.histogram('influx_write') if self.telemetry is not None else None
+        influx_args = dict(self.influx_args)
+        queries = (self.schema or {}).get('queries')
+        if queries:
+            influx_args.update(replayed=self._replayed, late_after=late_after(queries))
+        self.influx = InfluxWriter(queue=queue, latency=latency, **influx_args)
+        self.writers.append(self.influx)
+        if self.schema is not None:
+            try:
+                ensure_schema(self.influx.client, self.influx.database, **self.schema)
+            except WRITE_ERRORS as e:
+                # influxdb being down mustn't stop the readings, they wait in the spool.
+                # python3 -m ampread.retention does the same thing by hand.
+                print('ampread: could not set up retention policies and continuous queries: %s' % e)
+
+    def _replayed(self, start, end):
+        # readings the continuous queries have already gone past, work their
+        # kWh totals out now (in the writer thread)
+        try:
+            materialize(self.influx.client, self.schema['queries'], int(start), int(end) + 1,
+                        log=lambda message: None)
+        except WRITE_ERRORS as e:
+            print('ampread: could not redo the kWh totals, run python3 -m ampread.retention '
+                  '--backfill-from %s: %s' % (time.strftime('%Y-%m-%d', time.localtime(start)), e))
+
+    def __call__(self, item):
+        database, points = item
+        telemetry = self.telemetry
+        if telemetry is None:
+            for writer in self.writers:
+                writer.write(points, database=database)
+            return
+        for writer in self.writers:
+            started = time.perf_counter()
+            writer.write(points, database=database)
+            # queueing (and spooling) for influxdb, the inserts themselves for sqlite
+            telemetry.observe('queue_influx' if writer is self.influx else 'store_sqlite',
+                              time.perf_counter() - started)
+        if telemetry.due():
+            if self.influx is not None:
+                # failures are requests that will be retried
+                telemetry.gauge('influx_pending', self.influx.pending())
+                telemetry.gauge('influx_failures', self.influx.failures)
+                telemetry.gauge('influx_dropped', self.influx.dropped)
+                telemetry.gauge('influx_rejected', self.influx.rejected)
+            report = telemetry.points()
+            for writer in self.writers:
+                writer.write(report)
+
+    def close(self):
+        # flush what we can before going
+        for writer in getattr(self, 'writers', ()):
+            writer.close()
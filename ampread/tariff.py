@@ -0,0 +1,242 @@
+# Time of use (TOU) electricity tariffs loaded from a definition file.
+#
+# The old code worked the season, the rate windows and the holiday check out
+# from scratch every cycle, with the Ontario Jan 2019 rates written into the
+# script. A Tariff reads a JSON definition (see tariffs/ontario_tou.json)
+# and turns each year into a sorted table of (start, end, rate, tou,
+# schedule) periods, holidays included. Looking up the rate for a timestamp
+# is then a bisect into that table, and rates_at() does a whole NumPy array
+# of timestamps at once.
+#
+# A definition looks like this:
+#
+#   {
+#     "name": "Ontario time of use",
+#     "holidays": {"country": "CA", "subdiv": "ON", "dates": ["2019-12-24"]},
+#     "default": "offpeak",
+#     "prices": [
+#       {"from": "2019-01-01", "rates": {"offpeak": 0.065, "midpeak": 0.094, "onpeak": 0.132}}
+#     ],
+#     "seasons": [
+#       {"name": "Winter", "months": [11, 12, 1, 2, 3, 4],
+#        "periods": [{"days": "weekdays", "start": "07:00", "end": "11:00", "tou": "onpeak"}, ...]},
+#       ...
+#     ]
+#   }
+#
+# Any time not covered by a period gets the "default" TOU. "days" is
+# "weekdays", "weekends" or "all"; holidays count as weekend days. The prices
+# entry in effect on a day is the last one whose "from" date is on or before
+# it (the first entry also covers anything earlier).
+
+import bisect
+import datetime
+import json
+import time
+from collections import namedtuple
+
+import numpy as np
+
+# One stretch of time with a single rate. start and end are Unix timestamps.
+Period = namedtuple('Period', ['start', 'end', 'rate', 'tou', 'schedule'])
+
+DAYS = ('weekdays', 'weekends', 'all')
+
+
+class TariffError(ValueError):
+    """The tariff definition doesn't make sense."""
+
+
+def _clock(text):
+    # "07:30" -> minutes after midnight, "24:00" allowed for the end of the day
+    try:
+        hours, minutes = text.split(':')
+        value = int(hours) * 60 + int(minutes)
+    except (AttributeError, ValueError):
+        raise TariffError('bad time %r, expected HH:MM' % (text,))
+    if not 0 <= value <= 24 * 60:
+        raise TariffError('time %r is outside the day' % (text,))
+    return value
+
+
+def _date(text):
+    try:
+        return datetime.datetime.strptime(text, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        raise TariffError('bad date %r, expected YYYY-MM-DD' % (text,))
+
+
+class Tariff(object):
+    """A TOU tariff built from a definition dict (see the top of this file)."""
+
+    def __init__(self, definition):
+        self.name = definition.get('name', 'tariff')
+        self.default = definition.get('default')
+        self._holiday_spec = definition.get('holidays') or {}
+        self._extra_holidays = set(_date(d) for d in self._holiday_spec.get('dates', []))
+
+        prices = definition.get('prices') or []
+        if not prices:
+            raise TariffError('%s: no prices' % self.name)
+        prices = sorted(((_date(p['from']), dict(p['rates'])) for p in prices),
+                        key=lambda p: p[0])
+        self._price_dates = [p[0] for p in prices]
+        self._prices = [p[1] for p in prices]
+
+        self._seasons = {}
+        for season in definition.get('seasons') or []:
+            periods = []
+            for p in season.get('periods', []):
+                days = p.get('days', 'all')
+                if days not in DAYS:
+                    raise TariffError('%s: days must be one of %s' % (self.name, ', '.join(DAYS)))
+                start, end = _clock(p['start']), _clock(p['end'])
+                if end <= start:
+                    raise TariffError('%s: period %s-%s ends before it starts'
+                                      % (self.name, p['start'], p['end']))
+                periods.append((start, end, days, p['tou']))
+            periods.sort()
+            for month in season['months']:
+                if month in self._seasons:
+                    raise TariffError('%s: month %d is in two seasons' % (self.name, month))
+                self._seasons[month] = (season['name'], periods)
+        missing = set(range(1, 13)) - set(self._seasons)
+        if missing:
+            raise TariffError('%s: no season covers months %s'
+                              % (self.name, ', '.join(str(m) for m in sorted(missing))))
+
+        labels = set([self.default]) | set(t for _, periods in self._seasons.values()
+                                          for _, _, _, t in periods)
+        for rates in self._prices:
+            unknown = labels - set(rates)
+            if unknown:
+                raise TariffError('%s: no price for %s' % (self.name, ', '.join(sorted(unknown))))
+
+        # the precomputed table, extended a year at a time as it's needed
+        self._years = set()
+        self._starts = []
+        self._periods = []
+        self._arrays = None
+        self._last = None
+
+    # -- building the table ----------------------------------------------------
+
+    def _holidays(self, year):
+        days = set(d for d in self._extra_holidays if d.year == year)
+        country = self._holiday_spec.get('country')
+        if country:
+            import holidays
+            days.update(holidays.country_holidays(country, subdiv=self._holiday_spec.get('subdiv'),
+                                                  years=year).keys())
+        return days
+
+    def _rates(self, day):
+        i = bisect.bisect_right(self._price_dates, day) - 1
+        return self._prices[max(i, 0)]
+
+    def _year(self, year):
+        # Every period of one year in order, with neighbours that have the
+        # same rate and label merged together.
+        holidays = self._holidays(year)
+        out = []
+        day = datetime.date(year, 1, 1)
+        one_day = datetime.timedelta(days=1)
+        while day.year == year:
+            schedule, periods = self._seasons[day.month]
+            rates = self._rates(day)
+            weekend = day.weekday() >= 5 or day in holidays
+            midnight = datetime.datetime(day.year, day.month, day.day)
+            # the day as (start minute, tou) change points
+            changes = [(0, self.default)]
+            for start, end, days, tou in periods:
+                if days == 'all' or (days == 'weekends') == weekend:
+                    changes.append((start, tou))
+                    changes.append((end, self.default))
+            changes.sort(key=lambda c: c[0])
+            # later entries at the same minute win, e.g. one period ending as
+            # the next begins
+            points = {}
+            for minute, tou in changes:
+                points[minute] = tou
+            for minute in sorted(points):
+                if minute >= 24 * 60:
+                    continue
+                tou = points[minute]
+                start = (midnight + datetime.timedelta(minutes=minute)).timestamp()
+                rate = rates[tou]
+                if out and tuple(out[-1][2:]) == (rate, tou, schedule):
+                    continue
+                if out:
+                    out[-1][1] = start
+                out.append([start, None, rate, tou, schedule])
+            day += one_day
+        out[-1][1] = datetime.datetime(year + 1, 1, 1).timestamp()
+        return [Period(*p) for p in out]
+
+    def _ensure(self, first, last=None):
+        # Make sure the years first..last are in the table.
+        for year in range(first, (last or first) + 1):
+            if year in self._years:
+                continue
+            periods = self._periods + self._year(year)
+            periods.sort(key=lambda p: p.start)
+            self._periods = periods
+            self._starts = [p.start for p in periods]
+            self._years.add(year)
+            self._arrays = None
+
+    # -- looking things up -------------------------------------------------
+
+    def period_at(self, timestamp):
+        """The Period covering a Unix timestamp."""
+        last = self._last
+        if last is not None and last.start <= timestamp < last.end:
+            return last
+        self._ensure(time.localtime(timestamp).tm_year)
+        i = bisect.bisect_right(self._starts, timestamp) - 1
+        period = self._periods[i]
+        self._last = period
+        return period
+
+    def rate_at(self, timestamp):
+        """(rate, tou, schedule) for a Unix timestamp."""
+        period = self.period_at(timestamp)
+        return period.rate, period.tou, period.schedule
+
+    def rates_at(self, timestamps):
+        """Rates for an array of Unix timestamps in one go.
+
+        Returns (rates, tous, schedules): a float array and two arrays of
+        labels, each the same length as ``timestamps``.
+        """
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        if not timestamps.size:
+            empty = np.empty(0, dtype=object)
+            return np.empty(0), empty, empty.copy()
+        self._ensure(time.localtime(float(timestamps.min())).tm_year,
+                     time.localtime(float(timestamps.max())).tm_year)
+        if self._arrays is None:
+            self._arrays = (np.array(self._starts),
+                            np.array([p.rate for p in self._periods]),
+                            np.array([p.tou for p in self._periods], dtype=object),
+                            np.array([p.schedule for p in self._periods], dtype=object))
+        starts, rates, tous, schedules = self._arrays
+        i = np.searchsorted(starts, timestamps, side='right') - 1
+        return rates[i], tous[i], schedules[i]
+
+    def periods(self, year):
+        """The whole precomputed table for one year, as a list of Periods."""
+        self._ensure(year)
+        start = datetime.datetime(year, 1, 1).timestamp()
+        end = datetime.datetime(year + 1, 1, 1).timestamp()
+        return [p for p in self._periods if start <= p.start < end]
+
+
+def load_tariff(path):
+    """Load a Tariff from a JSON definition file."""
+    with open(path) as f:
+        try:
+            definition = json.load(f)
+        except ValueError as e:
+            raise TariffError('%s: %s' % (path, e))
+    return Tariff(definition)
@@ -0,0 +1,150 @@
+# Timings from inside ampread itself, stored with the readings.
+#
+# To see where a cycle's time goes (I2C reads, the UPS round trip, the
+# tariff lookup, building the points, the influxdb writes) each stage can
+# keep a Telemetry: fixed-bucket latency histograms, counters and gauges
+# that are written every ``interval`` seconds as "ampread_internal" points,
+# one per stage and metric:
+#
+#   tags:   stage (acquire, process, sink), metric (e.g. i2c_read_A)
+#   fields: count, mean, max, p50, p90, p99 and le_<seconds>, the number of
+#           timings at or under each bucket's upper bound (like Prometheus)
+#           or, for counters and gauges, just value
+#
+# Recording a timing is a bisect and three additions. With telemetry off the
+# stages have None instead of a histogram and skip the clock calls too, so
+# the only cost is an "is not None" test.
+#
+# Histograms are written to from more than one thread (the ADC readers, the
+# influxdb writer) without a lock. At worst a timing that lands while a
+# report is being made is lost.
+
+import bisect
+import datetime
+import time
+
+MEASUREMENT = 'ampread_internal'
+
+# bucket upper bounds in seconds, 100us to 10s
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """Count of timings in fixed buckets, plus their total and maximum."""
+
+    __slots__ = ('bounds', 'counts', 'count', 'total', 'max')
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = tuple(bounds)
+        self.reset()
+
+    def reset(self):
+        # the last bucket is everything over the top bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        # Estimate from the buckets: linear within the bucket the quantile
+        # falls in, and never past the biggest timing actually seen.
+        if not self.count:
+            return float('nan')
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                low = self.bounds[i - 1] if i > 0 else 0.0
+                high = self.bounds[i] if i < len(self.bounds) else self.max
+                return min(low + (high - low) * (rank - seen) / n, self.max)
+            seen += n
+        return self.max
+
+    def fields(self):
+        fields = {'count': self.count}
+        if self.count:
+            fields.update(mean=self.total / self.count, max=self.max, p50=self.quantile(0.5),
+                          p90=self.quantile(0.9), p99=self.quantile(0.99))
+        running = 0
+        for bound, n in zip(self.bounds, self.counts):
+            running += n
+            fields['le_%g' % bound] = running
+        return fields
+
+
+class Report(object):
+    """Telemetry points on their way from a stage to the sink."""
+
+    __slots__ = ('points',)
+
+    def __init__(self, points):
+        self.points = points
+
+
+class Telemetry(object):
+    """One stage's histograms, counters and gauges, reported every ``interval`` seconds."""
+
+    def __init__(self, stage, interval=60.0):
+        self.stage = stage
+        self.interval = interval
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self._next = time.monotonic() + interval
+
+    def histogram(self, name):
+        # the named histogram, made on first use. Hold on to it and call its
+        # observe() on the hot path rather than looking it up every time.
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        return histogram
+
+    def observe(self, name, seconds):
+        self.histogram(name).observe(seconds)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def due(self):
+        return time.monotonic() >= self._next
+
+    def points(self):
+        """Points for everything recorded since the last call, then start again.
+        Histograms and counters are reset, gauges keep their last value."""
+        self._next = time.monotonic() + self.interval
+        iso = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None).isoformat() + 'Z'
+        points = []
+        for name, histogram in sorted(self.histograms.items()):
+            points.append(self._point(iso, name, histogram.fields()))
+            histogram.reset()
+        for name, value in sorted(self.counters.items()):
+            points.append(self._point(iso, name, {'value': float(value)}))
+        self.counters = dict.fromkeys(self.counters, 0)
+        # always floats, influxdb won't have "value" be an integer in one series
+        # and a float in another
+        for name, value in sorted(self.gauges.items()):
+            points.append(self._point(iso, name, {'value': float(value)}))
+        return points
+
+    def _point(self, iso, name, fields):
+        return {
+            "measurement": MEASUREMENT,
+            "tags": {
+                "stage": self.stage,
+                "metric": name
+            },
+            "time": iso,
+            "fields": fields,
+        }
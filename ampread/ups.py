@@ -0,0 +1,87 @@
+# Poll the UPS in the background and keep the latest reading in a cache.
+#
+# Asking the NUT (or apcupsd) server for the line voltage inside the main loop
+# means every cycle waits on the network, and the whole script used to die if
+# the server was down. UPSPoller asks on its own schedule in its own thread.
+# The main loop just calls latest(), which never blocks, and gets the last
+# good reading along with how old it is and whether it's stale.
+
+import threading
+import time
+from collections import namedtuple
+
+# What latest() returns.
+#   values - dict from the client's status(), {} if we've never had a reading
+#   time   - wall clock (time.time()) when values were read, None if never
+#   age    - seconds since then (None if never)
+#   stale  - True if there's no reading or it's older than the TTL
+#   error  - the last polling error as a string, None if the last poll worked
+UPSStatus = namedtuple('UPSStatus', ['values', 'time', 'age', 'stale', 'error'])
+
+
+class UPSPoller(object):
+    """Poll ``client.status()`` every ``interval`` seconds in a thread.
+
+    ``client`` is an ampread.nut.NUTClient or ampread.apcupsd.ApcupsdClient.
+    Readings older than ``ttl`` seconds are reported as stale. ``latency``
+    is an optional ampread.telemetry.Histogram of the round trip times.
+    """
+
+    def __init__(self, client, interval=10.0, ttl=60.0, latency=None):
+        self.client = client
+        self.interval = interval
+        self.ttl = ttl
+        self.polls = 0
+        self.failures = 0
+        self.last_latency = None
+        self.latency = latency
+        # (values, time.time(), time.monotonic()) swapped in as one object so
+        # readers never see half an update
+        self._reading = ({}, None, None)
+        self._error = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='ampread-ups')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def poll(self):
+        # Take one reading now. Called by the thread, but handy on its own too.
+        start = time.monotonic()
+        try:
+            values = self.client.status()
+        except Exception as e:
+            # whatever went wrong, keep the last good reading and try again later
+            self.failures += 1
+            self._error = str(e)
+            return False
+        finally:
+            self.polls += 1
+            self.last_latency = time.monotonic() - start
+            if self.latency is not None:
+                self.latency.observe(self.last_latency)
+        self._reading = (values, time.time(), time.monotonic())
+        self._error = None
+        return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            started = time.monotonic()
+            self.poll()
+            self._stop.wait(max(self.interval - (time.monotonic() - started), 0.0))
+
+    def latest(self):
+        """The last good reading as an UPSStatus. Never blocks."""
+        values, wall, mono = self._reading
+        if mono is None:
+            return UPSStatus({}, None, None, True, self._error)
+        age = time.monotonic() - mono
+        return UPSStatus(values, wall, age, age > self.ttl, self._error)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.client.close()
@@ -0,0 +1,104 @@
+# Vectorized current calculations over NumPy sample buffers.
+#
+# The old scripts only kept the single highest reading per channel and turned
+# it into amps with peak / sqrt(2). That is only right for a perfect sine wave;
+# anything with a switch-mode power supply or a motor drive reads wrong. Here
+# each channel's samples sit in one row of a preallocated array and we work
+# out the DC offset, true RMS, peak and crest factor for every channel at
+# once with NumPy, so the cost doesn't grow with Python-level loops.
+
+from collections import namedtuple
+
+import numpy as np
+
+# Results for one cycle. Every field is an array with one entry per channel.
+#   amps  - true RMS current (what an ammeter shows)
+#   peak  - highest current away from the DC offset
+#   crest - peak / rms, 1.414 for a clean sine wave
+#   mean  - DC offset of the raw readings, in ADC counts
+ChannelStats = namedtuple('ChannelStats', ['amps', 'peak', 'crest', 'mean'])
+
+
+class WaveformBuffer(object):
+    """Preallocated (channels x samples) buffer of raw ADC readings.
+
+    ``full_scale`` is the ADC count that equals ``ct_amps`` on the current
+    transformer, e.g. 2047 for the ADS1015 and a 30A/1V SCT-013. ``ct_amps``
+    and ``calibration`` (a multiplier) can be one value for every channel or
+    a list with one per channel. ``inputs`` are the ADC inputs the rows hold,
+    0 to channels - 1 unless you say otherwise. With ``timestamps`` the
+    sampler also records when each reading was taken, in ``times``.
+    """
+
+    def __init__(self, channels, samples, full_scale, ct_amps=30.0, calibration=1.0, inputs=None,
+                 timestamps=False):
+        self.channels = channels
+        self.samples = samples
+        self.inputs = list(inputs) if inputs is not None else list(range(channels))
+        # a single number or an array with one entry per channel, both work below
+        self.scale = np.asarray(ct_amps, dtype=np.float64) * calibration / float(full_scale)
+        self.data = np.zeros((channels, samples), dtype=np.float64)
+        self.times = np.zeros((channels, samples), dtype=np.float64) if timestamps else None
+        # scratch space so analyze() doesn't allocate a new array every cycle
+        self._work = np.empty_like(self.data)
+
+    def rows(self):
+        # Dict of ADC input -> row view, in the shape ContinuousSampler.sample()
+        # wants for its buffers argument.
+        return dict((ch, self.data[row]) for row, ch in enumerate(self.inputs))
+
+    def time_rows(self):
+        # Same again for the read times, None if we aren't keeping them.
+        if self.times is None:
+            return None
+        return dict((ch, self.times[row]) for row, ch in enumerate(self.inputs))
+
+    def analyze(self, count=None, counts=None, scale=None):
+        # Work out the stats over the first "count" samples of every channel,
+        # or the first counts[row] of each row if they differ (see
+        # autorange.py). "scale" replaces self.scale, say for a different gain.
+        if scale is None:
+            scale = self.scale
+        if counts is not None:
+            return self._analyze_rows(np.asarray(counts), scale)
+        if count is None:
+            count = self.samples
+        data = self.data[:, :count]
+        work = self._work[:, :count]
+
+        # remove the DC offset (the mean) from every channel in one go
+        mean = data.mean(axis=1)
+        np.subtract(data, mean[:, np.newaxis], out=work)
+
+        # peak is the furthest any reading gets from the offset
+        np.abs(work, out=work)
+        peak = work.max(axis=1) * scale
+
+        # true RMS: square root of the mean of the squares
+        np.square(work, out=work)
+        amps = np.sqrt(work.mean(axis=1)) * scale
+
+        # crest factor, leaving idle (zero current) channels at 0
+        crest = np.divide(peak, amps, out=np.zeros_like(peak), where=amps > 0)
+        return ChannelStats(amps, peak, crest, mean)
+
+    def _analyze_rows(self, counts, scale):
+        # same as analyze() with the readings past each row's count zeroed out
+        counts = np.maximum(counts, 1)
+        n = counts.max()
+        data = self.data[:, :n]
+        work = self._work[:, :n]
+        unused = np.arange(n) >= counts[:, np.newaxis]
+
+        np.copyto(work, data)
+        work[unused] = 0
+        mean = work.sum(axis=1) / counts
+        np.subtract(data, mean[:, np.newaxis], out=work)
+        work[unused] = 0
+
+        np.abs(work, out=work)
+        peak = work.max(axis=1) * scale
+        np.square(work, out=work)
+        amps = np.sqrt(work.sum(axis=1) / counts) * scale
+        crest = np.divide(peak, amps, out=np.zeros_like(peak), where=amps > 0)
+        return ChannelStats(amps, peak, crest, mean)
@@ -21,16 +21,14 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import re
 import sys
 import datetime
 import time
 import Adafruit_ADS1x15
-import math
 import holidays
-import socket
-from struct import pack
 from influxdb import InfluxDBClient
+from ampread.accumulator import ChannelAccumulator, Peak
+from ampread.apcupsd import ApcupsdClient, ApcupsdError
 
 # Load urllib.request to scrape AC Mains voltage reading from APCUPSD CGI webmon page.
 # There are other methods to get your utility voltage
@@ -52,6 +50,21 @@ GAIN_B = 4
 samples = 200  # change this value to increase or decrease the number of samples taken
 places = int(2)
 
+# One accumulator per input. Each one keeps the highest reading seen this cycle
+# and only turns it into amps once, after all the samples are in.
+# The first number is the reading that equals 30A on the sct-013 (2047 for the ads1015).
+# Swap Peak for Rms (from ampread.accumulator) to get true RMS instead of peak / sqrt(2).
+accA = [ChannelAccumulator(2047, reducer=Peak) for i in range(0, 4)]
+accB = [ChannelAccumulator(22000, reducer=Peak) for i in range(0, 4)]
+
+# apcupsd server ip, port number
+# Change host and port according to your situation
+apcupsd = ApcupsdClient('192.168.10.200', 3551)
+
+# Used for kilowatts when apcupsd can't be reached or doesn't report the line voltage.
+# The voltage point gets voltage_stale = True when it's used.
+NOMINAL_VOLTAGE = 120.0
+
 # Define holidays country as Canada
 ca_holidays = holidays.Canada()
 
@@ -61,10 +74,6 @@ while True:
     try:
         # reset variables
         count = int(0)
-        data = [0] * 4
-        maxValue = [0] * 4
-        IrmsA = [0] * 4
-        ampsA = [0] * 4
         voltage = float(0)
         kilowatts = float(0)
 
@@ -75,23 +84,13 @@ while True:
         # voltage from each port on the first ads1015.
         while count < samples:
             count += 1
-            # nested loop to find highest sensor values from samples
+            # read input A0 through A3 from adc1 into each input's accumulator
             for i in range(0, 4):
+                accA[i].add(adc1.read_adc(i, gain=GAIN_A))
 
-                # read input A0 through A3 from adc1 as absolute value
-                data[i] = abs(adc1.read_adc(i, gain=GAIN_A))
-
-                # see if you have a new maxValue
-                if data[i] > maxValue[i]:
-                    maxValue[i] = data[i]
-
-            # convert maxValue sensor outputs to amps
-            # I used a sct-013 that is calibrated for 1000mV output @ 30A. Usually has 30A/1V printed on it.
-            for i in range(0, 4):
-                IrmsA[i] = float(maxValue[i] / float(2047) * 30)
-                IrmsA[i] = round(IrmsA[i], places)
-                ampsA[i] = IrmsA[i] / math.sqrt(2)  # RMS formula to get current reading to match what an ammeter shows.
-                ampsA[i] = round(ampsA[i], places)
+        # convert the peak sensor outputs to amps, once, now that sampling is done.
+        # I used a sct-013 that is calibrated for 1000mV output @ 30A. Usually has 30A/1V printed on it.
+        ampsA = [acc.finalize(places) for acc in accA]
 
         # assign range values to variables used for io adafruit upload.
         ampsA0 = ampsA[0]
@@ -101,32 +100,17 @@ while True:
 
         # reset variables before reading adc2
         count = int(0)
-        data = [0] * 4
-        maxValue = [0] * 4
-        IrmsB = [0] * 4
-        ampsB = [0] * 4
 
         # this loop will take 200 samples from each input and give you the highest (peak)
         # voltage from each port on the second ads1015.
         while count < samples:
             count += 1
-            # nested loop to find highest sensor values from samples
+            # read input A0 through A3 from adc2 into each input's accumulator
             for i in range(0, 4):
+                accB[i].add(adc2.read_adc(i, gain=GAIN_B))
 
-                # read input A0 through A3 from adc2 as absolute value
-                data[i] = abs(adc2.read_adc(i, gain=GAIN_B))
-
-                # see if you have a new maxValue
-                if data[i] > maxValue[i]:
-                    maxValue[i] = data[i]
-
-            # convert maxValue sensor outputs to amps
-            # I used a sct-013 that is calibrated for 1000mV output @ 30A. Usually has 30A/1V printed on it.
-            for i in range(0, 4):
-                IrmsB[i] = float(maxValue[i] / float(22000) * 30)
-                IrmsB[i] = round(IrmsB[i], places)
-                ampsB[i] = IrmsB[i] / math.sqrt(2)  # RMS formula to get current reading to match what an ammeter shows.
-                ampsB[i] = round(ampsB[i], places)
+        # convert the peak sensor outputs to amps
+        ampsB = [acc.finalize(places) for acc in accB]
 
         # assign range values to variables used for io adafruit upload.
         ampsB0 = ampsB[0]
@@ -140,45 +124,21 @@ while True:
         print('You cancelled the operation.')
         sys.exit()
     
-    # This section makes a connection to APC UPS to grab Utility Voltage value
-    # Change host and port according to your situation
-    
-    # apcupsd server ip, port number
-    HOST = ('192.168.10.200') 
-    PORT = 3551
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect((HOST, PORT))
-
-    # Send command to get status: Packet is pad byte, size byte, and command
-    s.send(pack(b'xb6s', 6, b'status'))
-
-    # Ditch the header
-    s.recv(1024)
-    time.sleep(.25)
-    data = s.recv(4096)
-    s.close()
-    # print ('Received', repr(data)) uncomment to see result
-    
-    # Convert binary back to string and assign values to variables
-    bytes2STR = data.decode('utf-8')
-    
-    values = re.findall(r'(\d+\.\d+)',bytes2STR) # find number values using regex
-    
-    values = re.findall(r'(\d+\.\d+)',bytes2STR) # find values using regex, start search at 1500th chr to remove html
-    names = re.findall(r'[A-Za-z-]+\w\b',bytes2STR)
-    
-    #print(values) # uncomment to see regex numerical output
-    #print(names) # uncomment to see regex ascill output
-    
-    # split results we want from "values" in to individual variables
-    LINEV = float(values[1])
-    LOAD = float(values[2])
-    BCHG = float(values[3])
-    TIMELEFT = float(values[4])
-    BATTV = float(values[7])
-    SERVER = (names[3])
-    UPSNAME = (names[8])
-    STATUS = (names[24])   
+    # This section asks the apcupsd network information server for the UPS status
+    # to grab the Utility Voltage value. The connection stays open between cycles,
+    # see ampread/apcupsd.py
+    # If that fails there's no UPS point this cycle, and kilowatts uses the
+    # nominal voltage with voltage_stale set rather than a made up reading.
+    try:
+        ups = apcupsd.status()
+    except ApcupsdError as e:
+        print('apcupsd not responding: %s' % e)
+        ups = None
+    #print(apcupsd.status_values()) # uncomment to see every field apcupsd reports
+
+    # the line voltage, or the nominal one (flagged) if we didn't get it
+    voltage_stale = ups is None or ups['LINEV'] is None
+    LINEV = NOMINAL_VOLTAGE if voltage_stale else ups['LINEV']
 
     # Calculate total AMPS from all sensors and convert to kilowatts
     kilowatts = ((ampsA0 + ampsA1 + ampsA2 + ampsA3 + ampsB0 + ampsB1 + ampsB2 + ampsB3) * LINEV) / 1000
@@ -296,6 +256,7 @@ while True:
             "time": iso,
             "fields": {
                 "voltage": LINEV,
+                "voltage_stale": voltage_stale,
                 "rate": rate,
                 "cph": cph,
                 "kilowatts": kilowatts,
@@ -313,24 +274,27 @@ while True:
     # result = client.query('select value from voltage;')
     # print("Result: {0}".format(result))
     
-    # Prepare UPS values in JSON format for upload to Influxdb
-    json_ups = [
-        {
-            "measurement": "apcaccess",
-            "tags": {
-                "STATUS": "ONLINE",
-                "UPSNAME": "KVM_SERVER"
-            },
-            #"time": iso, # Commented out, causing influxdb to not write data points
-            "fields": {
-                "LINEV": LINEV,
-                "LOAD": LOAD,
-                "BCHG": BCHG,
-                "BATTV": BATTV,
-                "TIMELEFT": TIMELEFT,
+    # Prepare UPS values in JSON format for upload to Influxdb. Nothing if apcupsd
+    # didn't answer, and numbers it didn't report (None) are left out of the point.
+    json_ups = []
+    if ups is not None:
+        json_ups = [
+            {
+                "measurement": "apcaccess",
+                "tags": {
+                    "STATUS": ups['STATUS'],
+                    "UPSNAME": ups['UPSNAME']
+                },
+                #"time": iso, # Commented out, causing influxdb to not write data points
+                "fields": {
+                    "LINEV": ups['LINEV'],
+                    "LOAD": ups['LOAD'],
+                    "BCHG": ups['BCHG'],
+                    "BATTV": ups['BATTV'],
+                    "TIMELEFT": ups['TIMELEFT'],
+                }
             }
-        }
-    ]
+        ]
     
     
     #print(values)                       # uncomment for testing if values update
@@ -339,7 +303,8 @@ while True:
     client = InfluxDBClient('192.168.10.13', 8086, '', '', 'ups_stats', timeout=60,retries=0)
     try:
         client.create_database('ups_stats')
-        client.write_points(json_ups)
+        if json_ups:
+            client.write_points(json_ups)
     except ConnectionError:
         print('influxdb server not responding')
         #break
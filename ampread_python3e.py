@@ -21,350 +21,161 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import re
 import sys
-import datetime
+import os
+import signal
 import time
-import Adafruit_ADS1x15
-import math
-import holidays
-import socket
-from influxdb import InfluxDBClient
+from ampread.nut import NUTClient
+from ampread.pipeline import Pipeline
+from ampread.retention import energy_queries, policies
+from ampread.stages import AcquireWorker, ProcessWorker, SinkWorker
 
-# Create first ADS1015 ADC instance.
-adc1 = Adafruit_ADS1x15.ADS1015(address=0x48, busnum=1)
+HERE = os.path.dirname(os.path.abspath(__file__))
 
-# Create a second ADS1015 ADC instance if are using a second ADC.
-adc2 = Adafruit_ADS1x15.ADS1115(address=0x49, busnum=1)
+# Run with --simulate to use made up 60Hz loads instead of real ADCs, so the
+# script can be tried out (or profiled) on a computer that isn't a Pi.
+SIMULATE = '--simulate' in sys.argv
 
-GAIN_A = 4         # see ads1015/1115 documentation for potential values.
-GAIN_B = 4
-samples = 200      # increase or decrease # of samples taken from ads1015
-places = int(2)    # set rounding 
-time_elapsed = (0)
-
-# Define holidays country as Canada (Ontario is default Province)
-ca_holidays = holidays.Canada()
+# The ADCs and circuits are listed in ampread.json: each ADC's model, I2C address
+# and bus, data rate and gain, and for each input the circuit name used in influxdb,
+# the CT rating and a calibration multiplier. Add an ADC or a circuit there, not here.
+CONFIG_FILE = os.path.join(HERE, 'ampread.json')
 
-# start loop to find current and utility voltage and then upload to influxdb
-while True:
+places = int(2)    # set rounding 
+CYCLE_SECONDS = 20 # how often to take readings and upload them
+# Timestamps are stored to the second ('s'), which is plenty for 20 second cycles. The
+# spool holds points in this precision, so let it empty before changing it.
+PRECISION = 's'
+
+# Every reading is written to a spool on the SD card first, so nothing is lost
+# if the influxdb server is down or rebooting. It is sent on (and deleted from
+# the spool) once influxdb has it. The spool is capped at 64MB.
+SPOOL_DIR = os.path.join(HERE, 'spool')
+SPOOL = {'max_bytes': 64 * 1024 * 1024, 'fsync': 'interval'}
+
+# One InfluxDB connection for the whole run. Points are handed to it every
+# cycle and a background thread writes them in batches, so a slow or
+# missing influxdb server doesn't hold up the readings.
+# Change the client IP address and user/password to match your instance of influxdb
+# Note that I have no user or password, place them in the quotes '' after port number
+# gzip compresses every batch on the way to influxdb.
+# Set INFLUX to None if there is no influxdb server and use SQLITE below instead.
+# Readings go in the RAW_POLICY retention policy.
+RAW_POLICY = '160w'
+INFLUX = {'host': '192.168.10.13', 'port': 8086, 'username': '', 'password': '',
+          'database': 'ampread', 'timeout': 60, 'retries': 3, 'precision': PRECISION, 'gzip': True,
+          'retention_policy': RAW_POLICY}
+
+# When it starts the sink makes sure influxdb has the retention policies and continuous
+# queries that keep hourly and daily kWh and cost per TOU period (the kWh dashboard
+# reads those). RAW_POLICY only becomes the database's default if it is new and no
+# other default was set. Readings the spool replays too late for the continuous queries
+# get their totals worked out once it has caught up. Set INFLUX_SCHEMA to None to manage
+# influxdb yourself, see ampread/retention.py (and run it with --backfill-from after an
+# outage of more than a couple of hours).
+INFLUX_SCHEMA = {'retention': policies(RAW_POLICY, '160w'),
+                 'queries': energy_queries(INFLUX['database'], RAW_POLICY)} if INFLUX else None
+
+# Keep the readings in a SQLite database on the Pi as well as (or, with INFLUX = None,
+# instead of) influxdb. Rows are committed once a minute and months older than
+# keep_months are deleted. Read them back with python3 -m ampread.sqlitestore.
+SQLITE = None
+#SQLITE = {'path': os.path.join(HERE, 'ampread.db'), 'precision': PRECISION, 'keep_months': 24}
+
+# Serve the latest amps, kW, rate, running kWh/cost per TOU band and UPS readings to
+# Prometheus on http://<pi>:9712/metrics. None to turn it off.
+METRICS = {'port': 9712}
+
+# NUT server ip, port number and the name of the UPS on it
+NUT_HOST = ('xxx.xxx.xxx.xxxx')
+NUT_PORT = 3493
+NUT_UPS = '9180'
+
+# The UPS is polled every UPS_INTERVAL seconds in the background. A reading older
+# than UPS_TTL seconds is stale, and NOMINAL_VOLTAGE is used for kW until a fresh one arrives.
+UPS_INTERVAL = 10
+UPS_TTL = 60
+NOMINAL_VOLTAGE = 120.0
+
+# Time of use pricing comes from a tariff file. The rates, TOU windows, seasons and
+# holidays (Ontario is default Province) are all in there, so change that file
+# (or point TARIFF_FILE at another one) when the rates change.
+TARIFF_FILE = os.path.join(HERE, 'tariffs', 'ontario_tou.json')
+
+# Once every BURST_SECONDS the acquire stage also grabs BURST_LENGTH seconds of every
+# circuit at the ADC's fastest data rate, and the process stage stores its harmonics,
+# THD and crest factor (and with STORE_WAVEFORMS the waveform itself, compressed) in
+# the "waveform" measurement. Send the script SIGUSR1 (kill -USR1 <pid>) for one now.
+# Set BURST_SECONDS to None to only take them when asked.
+BURST_SECONDS = 60
+BURST_LENGTH = 0.2
+STORE_WAVEFORMS = True
+
+# Besides the raw readings every cycle, the amps, voltage and kW are rolled up into
+# min / max / mean / 95th percentile (and kWh and cost totals) over 1 minute, 15 minute
+# and 1 hour windows, in current_1m, voltage_1h and so on. Long-range dashboards read
+# those instead of every raw point. Set WRITE_RAW = False to only write the rollups.
+ROLLUP_WINDOWS = (60, 900, 3600)
+WRITE_RAW = True
+
+# Report by exception. Most circuits sit flat for hours, so with EXCEPTION set a circuit's
+# amps are only written when they move more than 'amps' (in amps, or '5%' of what was last
+# written), and the voltage point when the voltage, kW or rate moves past its deadband in
+# 'deadbands' (a circuit can have its own there too). Everything is written at least every
+# 'heartbeat' seconds. The kWh and cost of the cycles in between add up and go out with the
+# next voltage point, and always before the hour or TOU band changes, so the kWh totals stay
+# exact. The rollups still get every cycle, but ampread.backfill can't redo the kWh of stretches
+# written this way. Set to None to write every reading every cycle.
+EXCEPTION = None
+# e.g. EXCEPTION = {'heartbeat': 300, 'amps': 0.1, 'deadbands': {'voltage': 1.0, 'kilowatts': '2%'}}
+
+# The loop runs as three processes, so a slow NUT server or influxdb never holds up
+# sampling (see ampread/pipeline.py and ampread/stages.py):
+#   acquire - samples every ADC each cycle. Cycles start every CYCLE_SECONDS on the
+#             monotonic clock; if one runs long the missed ones are skipped.
+#   process - true RMS amps, UPS voltage, TOU rate, kW, kWh and cost, and the points
+#   sink    - queues the points for influxdb through the spool (and stores them in SQLITE)
+# Up to FRAME_QUEUE cycles of readings can wait for the process stage. If it falls
+# further behind than that the oldest are dropped, acquisition never waits. Up to
+# POINT_QUEUE cycles of points wait for the sink, and the process stage waits for it
+# when that is full (the spool means the sink is rarely behind for long).
+FRAME_QUEUE = 8
+POINT_QUEUE = 16
+STATS_SECONDS = 60  # how often to check on the stages
+
+# Set to a number of seconds to have each stage time its own work (I2C reads per ADC,
+# cycle lateness, UPS round trips, tariff lookup, building the points, influxdb writes,
+# spool backlog) and write it that often to the "ampread_internal" measurement.
+TELEMETRY_SECONDS = None
+
+
+if __name__ == '__main__':
+    pipeline = Pipeline([
+        ('acquire', AcquireWorker(CONFIG_FILE, SIMULATE, CYCLE_SECONDS, policy='skip',
+                                  burst_every=BURST_SECONDS, burst_seconds=BURST_LENGTH,
+                                  telemetry=TELEMETRY_SECONDS)),
+        ('process', ProcessWorker(CONFIG_FILE, TARIFF_FILE, NUTClient(NUT_HOST, NUT_PORT, ups=NUT_UPS),
+                                  UPS_INTERVAL, UPS_TTL, NOMINAL_VOLTAGE, places, STORE_WAVEFORMS,
+                                  ROLLUP_WINDOWS, WRITE_RAW, PRECISION, METRICS, TELEMETRY_SECONDS,
+                                  EXCEPTION)),
+        ('sink', SinkWorker(INFLUX, SPOOL_DIR, SPOOL, INFLUX_SCHEMA, SQLITE, TELEMETRY_SECONDS)),
+    ], [(FRAME_QUEUE, 'drop-oldest'), (POINT_QUEUE, 'block')]).start()
+
+    # pass a burst request on to the acquire stage
+    acquire_pid = pipeline.stages[0].process.pid
+    signal.signal(signal.SIGUSR1, lambda signum, frame: os.kill(acquire_pid, signal.SIGUSR1))
 
     try:
-        # reset variables
-        count = int(0)
-        data = [0] * 4
-        maxValue = [0] * 4
-        IrmsA = [0] * 4
-        ampsA = [0] * 4
-        voltage = float(0)
-        kilowatts = float(0)
-        
-        # start timer to use in kWh calculations
-        start_time = time.time()
-
-        # since we are measuring an AC circuit the output of SCT-013 will be a sinewave.
-        # in order to calculate amps from sinewave we will need to get the peak voltage
-        # from each input and use root mean square formula (RMS)
-        # this loop will take 200 samples from each input and give you the highest (peak)
-        # voltage from each port on the first ads1015.
-        while count < samples:
-            count += 1
-            # nested loop to find highest sensor values from samples
-            for i in range(0, 4):
-
-                # read input A0 through A3 from adc1 as absolute value
-                data[i] = abs(adc1.read_adc(i, gain=GAIN_A))
-
-                # see if you have a new maxValue
-                if data[i] > maxValue[i]:
-                    maxValue[i] = data[i]
-
-            # convert maxValue sensor outputs to amps
-            # I used a sct-013 that is calibrated for 1000mV output @ 30A. Usually has 30A/1V printed on it.
-            for i in range(0, 4):
-                IrmsA[i] = float(maxValue[i] / float(2047) * 30)
-                IrmsA[i] = round(IrmsA[i], places)
-                ampsA[i] = IrmsA[i] / math.sqrt(2)  # RMS formula to get current reading to match what an ammeter shows.
-                ampsA[i] = round(ampsA[i], places)
-
-        # assign range values to variables used for io adafruit upload.
-        ampsA0 = ampsA[0]
-        ampsA1 = ampsA[1]
-        ampsA2 = ampsA[2]
-        ampsA3 = ampsA[3]
-
-        # reset variables before reading adc2
-        count = int(0)
-        data = [0] * 4
-        maxValue = [0] * 4
-        IrmsB = [0] * 4
-        ampsB = [0] * 4
-
-        # this loop will take 200 samples from each input and give you the highest (peak)
-        # voltage from each port on the second ads1015.
-        while count < samples:
-            count += 1
-            # nested loop to find highest sensor values from samples
-            for i in range(0, 4):
-
-                # read input A0 through A3 from adc2 as absolute value
-                data[i] = abs(adc2.read_adc(i, gain=GAIN_B))
-
-                # see if you have a new maxValue
-                if data[i] > maxValue[i]:
-                    maxValue[i] = data[i]
-
-            # convert maxValue sensor outputs to amps
-            # I used a sct-013 that is calibrated for 1000mV output @ 30A. Usually has 30A/1V printed on it.
-            for i in range(0, 4):
-                IrmsB[i] = float(maxValue[i] / float(22000) * 30)
-                IrmsB[i] = round(IrmsB[i], places)
-                ampsB[i] = IrmsB[i] / math.sqrt(2)  # RMS formula to get current reading to match what an ammeter shows.
-                ampsB[i] = round(ampsB[i], places)
-
-        # assign range values to variables for upload to influxdb
-        ampsB0 = ampsB[0]
-        ampsB1 = ampsB[1]
-        ampsB2 = ampsB[2]
-        ampsB3 = ampsB[3]
-
-
-
+        # the stages do all the work, just keep an eye on them
+        while pipeline.alive():
+            time.sleep(STATS_SECONDS)
+            # uncomment to see how deep each queue is, what was dropped and how
+            # busy each stage is
+            #print(pipeline.stats())
+        print('A pipeline stage stopped, see the error above.')
     except KeyboardInterrupt:
         print('You cancelled the operation.')
-        sys.exit()
-        
-    # This section pulls status information from a UPS using a NUT Server
-    # The most important value is the Utility Voltage which is variable LINEV
-    # Other variables are captured to display UPS info in separate Grafana dashboard
-    
-    # NUT server ip, port number
-    HOST = ('xxx.xxx.xxx.xxxx') 
-    PORT = 3493
-    
-    # Open socket with remote host
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect((HOST, PORT))
-
-    # Send command
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect((HOST, PORT))
-    s.sendall(b'LIST VAR 9180\n')
-    time.sleep(.25)
-    data = s.recv(2048)
-    utf8 = data.decode('utf-8')
-    #print (utf8) # uncomment to see raw output from UPS
-    s.close()
-
-    values = re.findall(r'"(.*?)"', utf8) # find values using regex
-    
-    #print(values) # uncomment to see regex output
-    
-    # split results we want from "values" into individual variables for upload to influxdb
-    try:
-        BCHG = float(values[0])
-        TIMELEFT = round(float(values[2])/60,2)
-        UPSMODEL = (values[5])
-        LINEV = float(values[19])
-        LOAD = float(values[42])
-        SERVER = (values[50])
-        STATUS = (values[51])
-    
-    except:
-        try:
-            # shift values during power outage due to additional status line that is output
-            LINEV = float(values[20])
-            LOAD = float(values[43])
-            SERVER = (values[51])
-            STATUS = (values[52])
-        
-        except:
-            BCHG = float(100.0)
-            TIMELEFT = round(float(300.0)/60,2)
-            UPSMODEL = ('Script Error')
-            LINEV = float(120.0)
-            LOAD = float(50.0)
-            SERVER = ('Script Error')
-            STATUS = ('Script Error')
-
-
-    # Calculate total AMPS from all sensors and convert to kilowatts
-    kilowatts = round((ampsA0 + ampsA1 + ampsA2 + ampsA3 + ampsB0 + ampsB1 + ampsB2 + ampsB3) * LINEV/1000,places)
-
-    # Get current month, day, hour for rate schedule calculations
-    date = datetime.date.today()
-    month = datetime.date.today().month
-    day = datetime.date.today().day
-    weekday = datetime.datetime.today().weekday()
-    hour = datetime.datetime.now().time()
-
-    # Assign pricing to TOU time range by summer and winter
-    # Determine if summer or winter time of use schedule is in effect.
-    # Time of Use kwh electricity pricing for Ontario as of Jan 2019.
-    rate_01 = 0.065
-    rate_02 = 0.094
-    rate_03 = 0.132
-
-    # These are the time ranges for time of use in Ontario as of Jan 2019.
-    # Winter Time of Use tou_01 Schedule 7am to 11am
-    # Winter Time of Use tou_02 Schedule 11am to 5pm
-    # Winter Time of Use tou_03 Schedule 5pm to 7pm
-    # Winter Time of Use tou_04 Schedule 7pm to 7am
-    # Weekends and Holidays are always tou_04
-    if 5 <= month < 11:
-        tou_01 = rate_02 
-        tou_02 = rate_03
-        tou_03 = rate_02
-        tou_04 = rate_01
-        schedule = 'Summer'
-    else:
-        tou_01 = rate_03
-        tou_02 = rate_02
-        tou_03 = rate_03
-        tou_04 = rate_01
-        schedule = 'Winter'
-
-    # Default rate is tou_04
-    rate = tou_04
-
-    # Check for tou_01 time range
-    start = datetime.time(7, 00)
-    end = datetime.time(11, 00)
-    if start <= hour <= end:
-        rate = tou_01
-
-    # Check for tou_02 time range
-    start = datetime.time(11, 00)
-    end = datetime.time(17, 00)
-    if start <= hour <= end:
-        rate = tou_02
-
-    # Check for tou_03 time range
-    start = datetime.time(17, 00)
-    end = datetime.time(19, 00)
-    if start <= hour <= end:
-        rate = tou_03
-
-    # In Ontario, weekends and holidays are always offpeak.
-    # Check to see if it is a weekend
-    if date.today().weekday() in (5,6):
-        rate = tou_04
-
-    # Check to see if it is a holiday.
-    if date in ca_holidays:
-        rate = tou_04
-        
-    # determine time of use string "tag" for influxdb
-    tou = str('null')
-    if rate == rate_01:
-        tou = 'offpeak'
-    elif rate == rate_02:
-        tou = 'midpeak'
-    else:
-        tou = 'onpeak'
-        
-    # convert kilowatts to kilowatts / hour (kWh)
-    kwh = round((kilowatts * time_elapsed)/3600,8)
-    
-    # Calculate estimated cost / hour assuming current usage is maintained for an hour
-    cph = round((kilowatts * rate),places)
-
-    # iso = datetime.datetime.now()
-    iso = datetime.datetime.utcnow().isoformat() + 'Z'
-
-    # write all ampere readings to database
-    json_amps = [
-        {
-            "measurement": "current",
-            "tags": {
-                "tou_schedule": schedule,
-                "tou": tou
-            },
-            "time": iso,
-            "fields": {
-                "ampsA0": ampsA[0],
-                "ampsA1": ampsA[1],
-                "ampsA2": ampsA[2],
-                "ampsA3": ampsA[3],
-                "ampsB0": ampsB[0],
-                "ampsB1": ampsB[1],
-                "ampsB2": ampsB[2],
-                "ampsB3": ampsB[3],
-            }
-        }
-    ]
-    # Change the client IP address and user/password to match your instance of influxdb
-    # Note that I have no user or password, place them in the quotes '' after port number
-    # retries=0 means infinate attempts.
-    client = InfluxDBClient('192.168.10.13', 8086, '', '', 'ampread', timeout=60,retries=3)
-    try:
-        client.create_database('ampread')
-        client.write_points(json_amps)
-    except ConnectionError:
-        print('influxdb server not responding')
-        continue
-
-    # write voltage, rate, kW, kWh, and cost/hr to influx
-    json_misc = [
-        {
-            "measurement": "voltage",
-            "tags": {
-                "tou_schedule": schedule,
-                "tou": tou
-            },
-            "time": iso,
-            "fields": {
-                "voltage": LINEV,
-                "rate": rate,
-                "cph": cph,
-                "kwh": kwh,
-                "schedule": schedule,
-                "kilowatts": kilowatts,
-            }
-        }
-    ]
-
-    client = InfluxDBClient('192.168.10.13', 8086, '', '', 'ampread', timeout=60,retries=3)
-    try:
-        client.create_database('ampread')
-        client.write_points(json_misc)
-    except ConnectionError:
-        print('influxdb server not responding')
-        continue
-    
-    # Prepare UPS values in JSON format for upload to Influxdb
-    json_ups = [
-        {
-            "measurement": "apcaccess",
-            "tags": {
-                "status": STATUS,
-                "upsmodel": UPSMODEL,
-                "server": SERVER
-            },
-            #"time": iso, # Commented out, causing influxdb to not write data points
-            "fields": {
-                "LINEV": LINEV,
-                "LOAD": LOAD,
-                "BCHG": BCHG,
-                "TIMELEFT": TIMELEFT,
-            }
-        }
-    ]
-    
-    
-    #print(values)    # uncomment for testing if values update
-    
-    # write values to influxdb
-    client = InfluxDBClient('192.168.10.13', 8086, '', '', 'ups_stats', timeout=60,retries=3)
-    try:
-        client.create_database('ups_stats')
-        client.write_points(json_ups)
-    except ConnectionError:
-        print('influxdb server not responding')
-        continue
 
-    # Wait before repeating loop
-    time.sleep(20)
-    time_elapsed = time.time() - start_time
-    
-    
+    # stop acquiring, then let the other stages finish what is queued
+    pipeline.stop()
+    sys.exit()
@@ -0,0 +1 @@
+# Benchmarks for the ampread acquisition loop. See benchmarks/README.md
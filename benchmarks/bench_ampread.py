@@ -0,0 +1,344 @@
+# Benchmark every stage of the ampread_python3e.py main loop.
+#
+# Runs the same code the script does, but against simulated ADCs and a fake
+# local InfluxDB, and reports:
+#   - samples/sec achieved per channel and in total
+#   - cycle latency percentiles
+#   - wall and CPU time per stage (sampling, NUT parse, rate calculation,
+#     building the points, write_points)
+#   - memory allocated per stage and per cycle
+#
+# Every run is saved as JSON in benchmarks/results/ so it can be compared
+# with an earlier one:
+#
+#   python3 -m benchmarks.bench_ampread --cycles 50
+#   python3 -m benchmarks.bench_ampread --compare benchmarks/results/<earlier>.json
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy
+
+from ampread.autorange import AutoRanger
+from ampread.config import load_config
+from ampread.influx import InfluxWriter
+from ampread.lineprotocol import LineEncoder
+from ampread.nut import parse_vars, ups_status
+from ampread.points import current_point, ups_point, voltage_point, write_current, write_voltage
+from ampread.spool import Spool
+from ampread.tariff import load_tariff
+from benchmarks.fake_influx import FakeInfluxServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RESULTS = os.path.join(HERE, 'results')
+NUT_RESPONSE = os.path.join(HERE, 'data', 'nut_list_var.txt')
+TARIFF = os.path.join(os.path.dirname(HERE), 'tariffs', 'ontario_tou.json')
+CONFIG = os.path.join(os.path.dirname(HERE), 'ampread.json')
+
+STAGES = ('sampling', 'nut_parse', 'rate', 'json_build', 'write_points')
+
+class StageTimer(object):
+    # Collects wall time, CPU time and (when tracemalloc is on) memory per stage.
+
+    def __init__(self, trace=False):
+        self.trace = trace
+        self.wall = dict((s, []) for s in STAGES)
+        self.cpu = dict((s, []) for s in STAGES)
+        self.alloc = dict((s, []) for s in STAGES)
+        self.blocks = dict((s, []) for s in STAGES)
+
+    def run(self, stage, func, *args):
+        if self.trace:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            blocks = sys.getallocatedblocks()
+        cpu = time.process_time()
+        wall = time.perf_counter()
+        result = func(*args)
+        self.wall[stage].append(time.perf_counter() - wall)
+        self.cpu[stage].append(time.process_time() - cpu)
+        if self.trace:
+            self.alloc[stage].append(tracemalloc.get_traced_memory()[1] - before)
+            self.blocks[stage].append(sys.getallocatedblocks() - blocks)
+        return result
+
+
+class Loop(object):
+    # The stages of one ampread_python3e.py cycle, without the 20 second sleep.
+
+    def __init__(self, args, influx):
+        latency = 0.0 if args.no_latency else args.i2c_latency
+        # the ADCs and circuits from the config, simulated with its "simulate" loads
+        self.registry = load_config(args.config)
+        self.samples = args.samples or self.registry.samples
+        # per-channel gains and counts if the config autoranges, unless --fixed-gain
+        autorange = None if args.fixed_gain else self.registry.autorange
+        if autorange is not None:
+            autorange = dict(autorange, samples=self.samples)
+            autorange.setdefault('max_samples', 2 * self.samples)
+        self.acquisition = self.registry.build(simulate=True, i2c_latency=latency,
+                                               samples=autorange['max_samples'] if autorange else self.samples)
+        self.ranger = AutoRanger(self.registry, self.acquisition, **autorange) if autorange else None
+        queue = Spool(args.spool, fsync=args.fsync) if args.spool else None
+        self.influx = InfluxWriter(influx.host, influx.port, '', '', 'ampread',
+                                   timeout=60, retries=3, precision=args.precision,
+                                   gzip=args.gzip, queue=queue)
+        # --dicts builds the point dicts like the script used to
+        self.encoder = None if args.dicts else LineEncoder(args.precision)
+        self.nut_response = open(NUT_RESPONSE).read()
+        self.tariff = load_tariff(TARIFF)
+        self.rates = []
+        self.reads = 0
+
+    def sampling(self):
+        frame = self.acquisition.acquire(self.samples)
+        if self.ranger is None:
+            amps = self.registry.amps(frame, 2)
+            self.reads += len(self.registry.channels) * self.samples
+        else:
+            gains, counts = self.ranger.plan()
+            self.ranger.update(frame)
+            amps = self.registry.amps(frame, 2, gains, counts)
+            self.reads += sum(sum(n) for n in counts)
+        for rates in frame.rates:
+            self.rates.extend(rates.values())
+        return amps
+
+    def nut_parse(self):
+        return ups_status(parse_vars(self.nut_response), 'bench')
+
+    def rate(self):
+        return self.tariff.rate_at(time.time())
+
+    def json_build(self, amps, ups, tou):
+        rate, tou, schedule = tou
+        kilowatts = round(self.registry.total_amps(amps) * ups['LINEV'] / 1000, 2)
+        kwh = round((kilowatts * 20.0) / 3600, 8)
+        cph = round(kilowatts * rate, 2)
+        if self.encoder is not None:
+            now = time.time()
+            write_current(self.encoder, now, schedule, tou, amps)
+            write_voltage(self.encoder, now, schedule, tou, ups['LINEV'], rate, cph, kwh, kilowatts)
+            lines = self.encoder.take()
+            point = ups_point(ups)
+            self.encoder.add(point['measurement'], point['tags'], point['fields'], now)
+            return lines, self.encoder.take()
+        iso = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None).isoformat() + 'Z'
+        return ([current_point(iso, schedule, tou, amps)],
+                [voltage_point(iso, schedule, tou, ups['LINEV'], rate, cph, kwh, kilowatts)],
+                [ups_point(ups, iso)])
+
+    def write_points(self, points):
+        # what the loop pays: queueing the points on the writer. The HTTP
+        # requests happen in the writer's thread and show up in "influx".
+        if self.encoder is not None:
+            lines, ups_lines = points
+            self.influx.write(lines)
+            self.influx.write(ups_lines, database='ups_stats')
+            return
+        json_amps, json_misc, json_ups = points
+        self.influx.write(json_amps + json_misc)
+        self.influx.write(json_ups, database='ups_stats')
+
+    def cycle(self, timer):
+        amps = timer.run('sampling', self.sampling)
+        ups = timer.run('nut_parse', self.nut_parse)
+        tou = timer.run('rate', self.rate)
+        points = timer.run('json_build', self.json_build, amps, ups, tou)
+        timer.run('write_points', self.write_points, points)
+
+    def close(self):
+        self.acquisition.close()
+        self.influx.close()
+
+
+def _ms(values):
+    return [v * 1000.0 for v in values]
+
+
+def _summary(values):
+    values = numpy.asarray(values, dtype=float)
+    if not len(values):
+        return {}
+    p50, p90, p99 = numpy.percentile(values, [50, 90, 99])
+    return {'mean': float(values.mean()), 'p50': float(p50), 'p90': float(p90),
+            'p99': float(p99), 'max': float(values.max())}
+
+
+def _git_commit():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                      cwd=HERE, stderr=subprocess.DEVNULL)
+        return out.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    with FakeInfluxServer(delay=args.influx_delay) as influx:
+        loop = Loop(args, influx)
+        try:
+            # warm up so imports, thread start and first connections aren't counted,
+            # and long enough for an autoranger to settle
+            for n in range(1 if loop.ranger is None else 2 * loop.ranger.hold):
+                loop.cycle(StageTimer())
+            loop.rates = []
+            loop.reads = 0
+
+            timer = StageTimer()
+            cycles = []
+            cpu = time.process_time()
+            for n in range(args.cycles):
+                start = time.perf_counter()
+                loop.cycle(timer)
+                cycles.append(time.perf_counter() - start)
+            cpu = time.process_time() - cpu
+            reads = loop.reads
+
+            # a shorter second pass with tracemalloc on, since it slows things down
+            tracer = StageTimer(trace=True)
+            tracemalloc.start()
+            try:
+                for n in range(args.alloc_cycles):
+                    loop.cycle(tracer)
+            finally:
+                tracemalloc.stop()
+        finally:
+            loop.close()
+        # close() flushed the writer, count its requests too
+        influx_stats = {'requests': influx.requests, 'writes': influx.writes,
+                        'points': influx.points, 'bytes': influx.bytes,
+                        'written': loop.influx.written, 'dropped': loop.influx.dropped}
+
+    channels = len(loop.registry.channels)
+    sampling = sum(timer.wall['sampling'])
+    result = {
+        'time': datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None).isoformat() + 'Z',
+        'label': args.label,
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'node': platform.node(),
+        'settings': {'cycles': args.cycles, 'samples': loop.samples, 'channels': channels,
+                     'config': os.path.basename(args.config), 'i2c_latency': 0.0 if args.no_latency else args.i2c_latency,
+                     'influx_delay': args.influx_delay, 'spool': bool(args.spool),
+                     'fsync': args.fsync, 'dicts': args.dicts, 'precision': args.precision,
+                     'gzip': args.gzip, 'autorange': loop.ranger is not None},
+        'samples_per_sec': {
+            'per_channel': _summary(loop.rates),
+            'total': reads / sampling if sampling else 0.0,
+        },
+        'cycle_ms': _summary(_ms(cycles)),
+        'cpu_ms_per_cycle': cpu * 1000.0 / args.cycles,
+        'stages': {},
+        'influx': influx_stats,
+    }
+    for stage in STAGES:
+        result['stages'][stage] = {
+            'wall_ms': _summary(_ms(timer.wall[stage])),
+            'cpu_ms': _summary(_ms(timer.cpu[stage])),
+            'alloc_kib': _summary([b / 1024.0 for b in tracer.alloc[stage]]),
+            'blocks': _summary(tracer.blocks[stage]),
+        }
+    result['alloc_kib_per_cycle'] = sum(result['stages'][s]['alloc_kib'].get('mean', 0.0)
+                                        for s in STAGES)
+    return result
+
+
+def report(result, previous=None):
+    # Print a result, with the change from "previous" where there is one.
+
+    def delta(path):
+        if previous is None:
+            return ''
+        old, new = previous, result
+        for key in path:
+            old = old.get(key, {}) if isinstance(old, dict) else {}
+            new = new.get(key, {}) if isinstance(new, dict) else {}
+        if not isinstance(old, (int, float)) or not old:
+            return ''
+        return '  (%+.1f%%)' % ((new - old) * 100.0 / old)
+
+    print('ampread benchmark %s  commit %s  python %s' % (result['time'], result['commit'], result['python']))
+    sps = result['samples_per_sec']
+    print('samples/sec   total %10.1f%s' % (sps['total'], delta(['samples_per_sec', 'total'])))
+    print('              per channel p50 %.1f  max %.1f'
+          % (sps['per_channel'].get('p50', 0), sps['per_channel'].get('max', 0)))
+    c = result['cycle_ms']
+    print('cycle ms      p50 %.2f  p90 %.2f  p99 %.2f  max %.2f%s'
+          % (c['p50'], c['p90'], c['p99'], c['max'], delta(['cycle_ms', 'p50'])))
+    print('cpu ms/cycle  %.2f%s' % (result['cpu_ms_per_cycle'], delta(['cpu_ms_per_cycle'])))
+    print('alloc KiB/cycle %.1f%s' % (result['alloc_kib_per_cycle'], delta(['alloc_kib_per_cycle'])))
+    print('%-14s %10s %10s %10s %10s' % ('stage', 'wall p50', 'wall p99', 'cpu mean', 'alloc KiB'))
+    for stage in STAGES:
+        s = result['stages'][stage]
+        print('%-14s %10.3f %10.3f %10.3f %10.1f%s' % (
+            stage, s['wall_ms']['p50'], s['wall_ms']['p99'], s['cpu_ms']['mean'],
+            s['alloc_kib'].get('mean', 0.0), delta(['stages', stage, 'cpu_ms', 'mean'])))
+    i = result['influx']
+    print('influx        %d requests, %d writes, %d points, %d bytes, %d dropped'
+          % (i['requests'], i['writes'], i['points'], i['bytes'], i.get('dropped', 0)))
+
+
+def save(result, directory=RESULTS):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    name = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%d-%H%M%S')
+    if result.get('label'):
+        name += '-' + result['label']
+    path = os.path.join(directory, name + '.json')
+    with open(path, 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the ampread main loop')
+    parser.add_argument('--cycles', type=int, default=20, help='cycles to time (default 20)')
+    parser.add_argument('--alloc-cycles', type=int, default=5,
+                        help='cycles to run under tracemalloc (default 5)')
+    parser.add_argument('--config', default=CONFIG,
+                        help='ADC and channel config to simulate (default ampread.json)')
+    parser.add_argument('--samples', type=int, help='samples per channel (default from the config)')
+    parser.add_argument('--i2c-latency', type=float, default=0.00025,
+                        help='seconds per simulated I2C transaction (default 0.00025)')
+    parser.add_argument('--no-latency', action='store_true',
+                        help='no simulated I2C or conversion delays, to measure CPU cost only')
+    parser.add_argument('--influx-delay', type=float, default=0.0,
+                        help='seconds the fake InfluxDB takes to answer each request')
+    parser.add_argument('--spool', metavar='DIR',
+                        help='write through an on-disk spool in DIR, like the script does')
+    parser.add_argument('--fsync', default='interval', choices=('always', 'interval', 'never'),
+                        help='spool fsync policy (default interval)')
+    parser.add_argument('--dicts', action='store_true',
+                        help='build point dicts for write_points instead of line protocol')
+    parser.add_argument('--precision', default='s', choices=('n', 'u', 'ms', 's'),
+                        help='timestamp precision sent to InfluxDB (default s)')
+    parser.add_argument('--gzip', action='store_true', help='gzip the writes to InfluxDB')
+    parser.add_argument('--fixed-gain', action='store_true',
+                        help="ignore the config's autorange, every channel at its gain and samples")
+    parser.add_argument('--label', default='', help='added to the saved result name')
+    parser.add_argument('--compare', metavar='FILE', help='earlier result to compare against')
+    parser.add_argument('--no-save', action='store_true', help="don't save the result")
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    report(result, previous)
+    if not args.no_save:
+        print('saved %s' % save(result))
+    return result
+
+
+if __name__ == '__main__':
+    main()
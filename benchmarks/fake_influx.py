@@ -0,0 +1,117 @@
+# A tiny local stand-in for the InfluxDB 1.x HTTP API.
+#
+# It answers /ping, /query and /write the way InfluxDB does, counts what it
+# was sent, and can be told to answer slowly so we can see what a sluggish
+# server does to the sampling loop.
+
+import gzip
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so clients can keep the connection alive between requests
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, code, body=b'', content_type='application/json'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def _body(self):
+        # the request body, and how many bytes of it came over the wire
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body, length
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _handle(self):
+        server = self.server.owner
+        url = urlparse(self.path)
+        body, length = self._body()
+        if server.delay:
+            time.sleep(server.delay)
+        with server.lock:
+            server.requests += 1
+            server.connections.add(self.client_address)
+        if url.path == '/ping':
+            self._reply(204)
+        elif url.path == '/write':
+            lines = [l for l in body.split(b'\n') if l.strip()]
+            with server.lock:
+                server.writes += 1
+                server.points += len(lines)
+                server.bytes += length
+                if server.keep:
+                    server.lines.extend(lines)
+            self._reply(204)
+        elif url.path == '/query':
+            params = parse_qs(url.query)
+            if not params.get('q') and body:
+                params = parse_qs(body.decode('utf-8'))
+            with server.lock:
+                server.queries.extend(params.get('q', []))
+            reply = {'results': [{'statement_id': 0}]}
+            self._reply(200, json.dumps(reply).encode('utf-8'))
+        else:
+            self._reply(404)
+
+
+class FakeInfluxServer(object):
+    """Run a fake InfluxDB on 127.0.0.1 in a background thread.
+
+    Use as a context manager; ``port`` is picked by the OS. ``delay`` adds
+    that many seconds to every response. Set ``keep`` to hold on to every
+    line written (in ``lines``).
+    """
+
+    def __init__(self, delay=0.0, keep=False):
+        self.delay = delay
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.reset()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.owner = self
+        self.host, self.port = self.httpd.server_address
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='fake-influx')
+        self.thread.daemon = True
+
+    def reset(self):
+        self.requests = 0
+        self.writes = 0
+        self.points = 0
+        self.bytes = 0
+        self.queries = []
+        self.lines = []
+        self.connections = set()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,124 @@
+import datetime
+import unittest
+
+import numpy as np
+
+from ampread.backfill import backfill, encode_points, moved_series
+from ampread.lineprotocol import LineEncoder, parse_line
+from ampread.retention import energy_queries
+from ampread.tariff import Tariff
+
+TARIFF = {
+    "default": "offpeak",
+    "prices": [{"from": "2019-01-01", "rates": {"offpeak": 0.1, "onpeak": 0.2}}],
+    "seasons": [{"name": "Winter", "months": list(range(1, 13)),
+                 "periods": [{"start": "07:00", "end": "11:00", "tou": "onpeak"}]}],
+}
+
+
+class Result(object):
+
+    def __init__(self, raw):
+        self.raw = raw
+
+
+class FakeClient(object):
+    # just enough of InfluxDBClient: fetch() queries answered from ``stored``,
+    # everything else recorded in order
+
+    def __init__(self, stored):
+        self.stored = stored
+        self.calls = []
+
+    def query(self, query, epoch=None):
+        if query.startswith('SELECT * FROM'):
+            measurement = query.split('"')[1]
+            columns, rows = self.stored.get(measurement, ([], []))
+            return Result({'series': [{'columns': columns, 'values': rows}]} if rows else {})
+        self.calls.append(('query', query))
+        return Result({})
+
+    def write_points(self, points, **kwargs):
+        self.calls.append(('write', points, kwargs))
+
+
+class BackfillTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tariff = Tariff(TARIFF)
+        # 06:58 to 07:02 local, every 20 seconds, all stored as offpeak
+        start = datetime.datetime(2019, 3, 5, 6, 58).timestamp()
+        self.times = [start + 20 * i for i in range(13)]
+        self.start = start
+        self.stored = {
+            'current': (['time', 'ampsA0', 'ampsA1'], [[t, 10.0, 5.0] for t in self.times]),
+            'voltage': (['time', 'kilowatts', 'tou', 'tou_schedule', 'voltage', 'voltage_stale', 'interval'],
+                        [[t, 0.0, 'offpeak', 'Winter', 120.0, False, 20.0] for t in self.times]),
+        }
+
+    def test_write_before_delete(self):
+        client = FakeClient(self.stored)
+        totals = backfill(client, self.tariff, self.start, self.start + 3600, log=lambda *a: None,
+                          rollups=energy_queries('ampread'))
+        self.assertEqual(totals['points'], 13)
+        kinds = [call[0] for call in client.calls]
+        self.assertEqual(kinds[0], 'write')
+        write = client.calls[0]
+        self.assertEqual(write[2]['protocol'], 'line')
+        points = [parse_line(line) for line in write[1]]
+        self.assertEqual([p[1]['tou'] for p in points], ['offpeak'] * 6 + ['onpeak'] * 7)
+        self.assertAlmostEqual(points[0][2]['kilowatts'], 1.8)
+        self.assertEqual(points[0][2]['interval'], 20.0)
+        self.assertNotIn('lateness', points[0][2])
+
+        # only the points that moved to onpeak are deleted from the old series
+        deletes = [call[1] for call in client.calls if call[0] == 'query' and call[1].startswith('DELETE')]
+        self.assertEqual(deletes[0], 'DELETE FROM "voltage" WHERE "tou" = \'offpeak\' AND '
+                         '"tou_schedule" = \'Winter\' AND time >= %ds AND time <= %ds'
+                         % (self.times[6], self.times[-1]))
+        # and the kWh totals are redone from whole buckets
+        self.assertTrue(any('DELETE FROM "kwh_1h"' in d for d in deletes))
+        self.assertTrue(any('INTO "ampread"."energy"."kwh_1d"' in call[1] for call in client.calls
+                            if call[0] == 'query'))
+
+    def test_write_fails(self):
+        client = FakeClient(self.stored)
+
+        def fail(points, **kwargs):
+            raise IOError('timed out')
+        client.write_points = fail
+        self.assertRaises(IOError, backfill, client, self.tariff, self.start, self.start + 3600,
+                          log=lambda *a: None)
+        self.assertEqual(client.calls, [])
+
+    def test_dry_run(self):
+        client = FakeClient(self.stored)
+        backfill(client, self.tariff, self.start, self.start + 3600, dry_run=True, log=lambda *a: None)
+        self.assertEqual(client.calls, [])
+
+
+class MovedSeriesTest(unittest.TestCase):
+
+    def test_runs(self):
+        times = np.arange(6.0)
+        old_tou = np.array(['a', 'a', 'a', 'b', 'a', 'a'], dtype=object)
+        old_schedule = np.array(['W'] * 6, dtype=object)
+        result = {'tou': np.array(['a', 'c', 'c', 'c', 'a', 'c'], dtype=object),
+                  'schedule': np.array(['W'] * 6, dtype=object)}
+        self.assertEqual(moved_series(times, old_tou, old_schedule, result),
+                         [('a', 'W', 1.0, 2.0), ('b', 'W', 3.0, 3.0), ('a', 'W', 5.0, 5.0)])
+
+    def test_encode_points(self):
+        encoder = LineEncoder('s')
+        result = {'kilowatts': np.array([1.0]), 'kwh': np.array([0.5]), 'rate': np.array([0.1]),
+                  'tou': np.array(['onpeak'], dtype=object), 'schedule': np.array(['Winter'], dtype=object),
+                  'cph': np.array([0.1])}
+        self.assertEqual(encode_points(encoder, 'voltage', np.array([100.0]), np.array([120.0]),
+                                       np.array([None], dtype=object), result), 1)
+        self.assertEqual(encoder.take(),
+                         b'voltage,tou=onpeak,tou_schedule=Winter voltage=120.0,rate=0.1,cph=0.1,kwh=0.5,'
+                         b'cost=0.05,schedule="Winter",kilowatts=1.0 100\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+
+import numpy as np
+
+from ampread.burst import analyze_burst, decode_waveform, encode_waveform
+
+
+def sine(rate, seconds, amps, harmonics=(), frequency=60.0):
+    # a mains current waveform in amps: ``amps`` peak at the fundamental
+    # plus (order, fraction of the fundamental) harmonics
+    t = np.arange(int(rate * seconds)) / float(rate)
+    wave = amps * np.sin(2 * np.pi * frequency * t)
+    for order, fraction in harmonics:
+        wave += fraction * amps * np.sin(2 * np.pi * order * frequency * t)
+    return wave
+
+
+class WaveformTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        scale = 0.01
+        amps = sine(3300, 0.2, 20.0, [(3, 0.2)])
+        samples = np.rint(amps / scale).astype(np.int16)
+        blob = encode_waveform(samples, 3300.0, scale)
+        self.assertLess(len(blob), samples.nbytes)
+        decoded, rate, decoded_scale = decode_waveform(blob)
+        np.testing.assert_array_equal(decoded, samples)
+        self.assertEqual(rate, 3300.0)
+        self.assertAlmostEqual(decoded_scale, scale, places=6)
+        # back to amps within half a count
+        self.assertLessEqual(np.abs(decoded * decoded_scale - amps).max(), scale / 2 + 1e-6)
+
+    def test_not_a_waveform(self):
+        self.assertRaises(ValueError, decode_waveform, b'XXXX' + b'\0' * 40)
+
+
+class AnalyzeTest(unittest.TestCase):
+
+    def test_harmonics(self):
+        scale = 0.01
+        rate = 3300.0
+        wave = sine(rate, 0.2, 10.0, [(3, 0.2), (5, 0.1)])
+        data = np.rint(wave / scale + 2048)[np.newaxis, :]
+        stats = analyze_burst(data, [rate], [scale])
+
+        self.assertAlmostEqual(stats.frequency[0], 60.0, delta=0.5)
+        self.assertAlmostEqual(stats.fundamental[0], 10.0 / np.sqrt(2), delta=0.05)
+        self.assertAlmostEqual(stats.harmonics[0, 2], 2.0 / np.sqrt(2), delta=0.02)
+        self.assertAlmostEqual(stats.harmonics[0, 4], 1.0 / np.sqrt(2), delta=0.02)
+        self.assertAlmostEqual(stats.thd[0], np.sqrt(0.2 ** 2 + 0.1 ** 2), delta=0.01)
+        rms = 10.0 / np.sqrt(2) * np.sqrt(1 + 0.2 ** 2 + 0.1 ** 2)
+        self.assertAlmostEqual(stats.rms[0], rms, delta=0.02)
+        self.assertAlmostEqual(stats.crest[0], np.abs(wave).max() / rms, delta=0.01)
+
+    def test_above_nyquist(self):
+        # at 860 samples/sec only up to 430 Hz can be seen, the 7th harmonic
+        rate = 860.0
+        data = np.rint(sine(rate, 0.2, 10.0) / 0.01 + 2048)[np.newaxis, :]
+        stats = analyze_burst(data, [rate], [0.01], orders=10)
+        self.assertFalse(np.isnan(stats.harmonics[0, :7]).any())
+        self.assertTrue(np.isnan(stats.harmonics[0, 7:]).all())
+
+    def test_idle_channel(self):
+        data = np.full((1, 660), 2048.0)
+        stats = analyze_burst(data, [3300.0], [0.01])
+        self.assertTrue(np.isnan(stats.thd[0]))
+        self.assertTrue(np.isnan(stats.frequency[0]))
+        self.assertEqual(stats.crest[0], 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
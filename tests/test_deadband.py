@@ -0,0 +1,138 @@
+import unittest
+
+from ampread.deadband import Deadband, ReportByException, parse_deadband
+from ampread.lineprotocol import LineEncoder, parse_line
+
+
+class DeadbandTest(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse_deadband(0.1), (0.1, 0.0))
+        self.assertEqual(parse_deadband(' 5% '), (0.0, 0.05))
+
+    def test_absolute(self):
+        band = Deadband(0.5, heartbeat=1000)
+        self.assertEqual(band.moved(0, {'a': 10.0}), [('a', 10.0)])
+        self.assertEqual(band.moved(1, {'a': 10.4}), [])
+        # measured from the value last written, not the last one seen
+        self.assertEqual(band.moved(2, {'a': 10.6}), [('a', 10.6)])
+        self.assertEqual(band.moved(3, {'a': 10.2}), [])
+
+    def test_relative_and_per_field(self):
+        band = Deadband('10%', {'b': 1.0}, heartbeat=1000)
+        band.moved(0, {'a': 100.0, 'b': 100.0})
+        self.assertEqual(band.moved(1, {'a': 109.0, 'b': 100.5}), [])
+        self.assertEqual(band.moved(2, {'a': 111.0, 'b': 101.5}), [('a', 111.0), ('b', 101.5)])
+
+    def test_no_deadband_writes_any_change(self):
+        band = Deadband(heartbeat=1000)
+        band.moved(0, {'a': 1.0, 's': False})
+        self.assertEqual(band.moved(1, {'a': 1.0, 's': False}), [])
+        self.assertEqual(band.moved(2, {'a': 1.0001, 's': True}), [('a', 1.0001), ('s', True)])
+
+    def test_nan(self):
+        band = Deadband(0.5, heartbeat=1000)
+        band.moved(0, {'a': float('nan')})
+        self.assertEqual(band.moved(1, {'a': float('nan')}), [])
+        self.assertEqual(band.moved(2, {'a': 1.0}), [('a', 1.0)])
+
+    def test_heartbeat(self):
+        band = Deadband(0.5, heartbeat=60)
+        band.moved(0, {'a': 1.0})
+        self.assertEqual(band.moved(59, {'a': 1.0}), [])
+        self.assertEqual(band.moved(60, {'a': 1.0}), [('a', 1.0)])
+        self.assertEqual(band.moved(61, {'a': 1.0}), [])
+
+    def test_reset(self):
+        band = Deadband(0.5, heartbeat=60)
+        band.moved(0, {'a': 1.0})
+        band.reset()
+        self.assertEqual(band.moved(1, {'a': 1.0}), [('a', 1.0)])
+
+
+def points(encoder):
+    return [parse_line(line) for line in encoder.take().decode('utf-8').splitlines()]
+
+
+class ReportByExceptionTest(unittest.TestCase):
+
+    def cycle(self, report, encoder, seconds, tou, amps, kwh, voltage=120.0, kilowatts=1.0):
+        report.write(encoder, seconds, 'Winter', tou, amps, voltage, 0.1, 0.1, kwh, kilowatts,
+                     interval=20.0, lateness=0.0)
+
+    def test_only_moved_amps_written(self):
+        report = ReportByException(heartbeat=1000, amps=0.5)
+        encoder = LineEncoder('s')
+        self.cycle(report, encoder, 0, 'onpeak', {'a': 1.0, 'b': 2.0}, 0.01)
+        self.cycle(report, encoder, 20, 'onpeak', {'a': 1.1, 'b': 3.0}, 0.01)
+        current = [p[2] for p in points(encoder) if p[0] == 'current']
+        self.assertEqual(current, [{'a': 1.0, 'b': 2.0}, {'b': 3.0}])
+        # 3 amps and the first voltage point written, 1 amp and the second voltage point not
+        self.assertEqual((report.written, report.skipped), (4, 2))
+
+    def test_kwh_carried_to_next_voltage_point(self):
+        report = ReportByException(heartbeat=1000, amps=0.5)
+        encoder = LineEncoder('s')
+        for i in range(5):
+            self.cycle(report, encoder, i * 20, 'onpeak', {'a': 1.0}, 0.25)
+        self.cycle(report, encoder, 100, 'onpeak', {'a': 1.0}, 0.25, voltage=125.0)
+        voltage = [p for p in points(encoder) if p[0] == 'voltage']
+        self.assertEqual([(p[3], p[2]['kwh'], p[2]['interval']) for p in voltage],
+                         [(0, 0.25, 20.0), (100, 1.25, 100.0)])
+
+    def test_exact_across_hour_and_tou_changes(self):
+        report = ReportByException(heartbeat=100000, amps=0.5)
+        encoder = LineEncoder('s')
+        total = 0.0
+        for i in range(700):
+            seconds = i * 20
+            # TOU changes half way through the third hour
+            tou = 'onpeak' if seconds < 2.5 * 3600 else 'midpeak'
+            kwh = 0.001 * (i % 7 + 1)
+            total += kwh
+            self.cycle(report, encoder, seconds, tou, {'a': 1.0}, kwh)
+        report.flush(encoder)
+        voltage = [p for p in points(encoder) if p[0] == 'voltage']
+        self.assertAlmostEqual(sum(p[2]['kwh'] for p in voltage), total, places=9)
+
+        # every point's kWh stays in its own hour and band
+        by_band = {}
+        for i in range(700):
+            seconds = i * 20
+            tou = 'onpeak' if seconds < 2.5 * 3600 else 'midpeak'
+            key = (seconds // 3600, tou)
+            by_band[key] = by_band.get(key, 0.0) + 0.001 * (i % 7 + 1)
+        written = {}
+        for measurement, tags, fields, seconds in voltage:
+            key = (seconds // 3600, tags['tou'])
+            written[key] = written.get(key, 0.0) + fields['kwh']
+        self.assertEqual(sorted(written), sorted(by_band))
+        for key in by_band:
+            self.assertAlmostEqual(written[key], by_band[key], places=9)
+
+    def test_new_band_writes_everything(self):
+        report = ReportByException(heartbeat=100000, amps=0.5)
+        encoder = LineEncoder('s')
+        self.cycle(report, encoder, 0, 'onpeak', {'a': 1.0}, 0.1)
+        self.cycle(report, encoder, 20, 'onpeak', {'a': 1.0}, 0.1)
+        points(encoder)
+        self.cycle(report, encoder, 40, 'midpeak', {'a': 1.0}, 0.1)
+        written = points(encoder)
+        # the onpeak kWh, then the midpeak current and voltage
+        self.assertEqual([(p[0], p[1]['tou'], p[3]) for p in written],
+                         [('voltage', 'onpeak', 20), ('current', 'midpeak', 40), ('voltage', 'midpeak', 40)])
+        self.assertEqual(written[0][2]['kwh'], 0.1)
+
+    def test_flush_only_once(self):
+        report = ReportByException(heartbeat=100000)
+        encoder = LineEncoder('s')
+        self.cycle(report, encoder, 0, 'onpeak', {'a': 1.0}, 0.1)
+        self.cycle(report, encoder, 20, 'onpeak', {'a': 1.0}, 0.1)
+        points(encoder)
+        report.flush(encoder)
+        report.flush(encoder)
+        self.assertEqual([p[2]['kwh'] for p in points(encoder)], [0.1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import shutil
+import tempfile
+import time
+import unittest
+
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+
+from ampread.influx import InfluxWriter, rejected
+from ampread.spool import Spool
+
+
+class FakeClient(object):
+    # takes at most ``max_points`` a request (413 past that), refuses any
+    # batch with a line starting "bad" (400), and can be made to be down
+
+    def __init__(self, max_points=None):
+        self.max_points = max_points
+        self.down = False
+        self.points = []
+        self.requests = 0
+
+    def create_database(self, database):
+        pass
+
+    def write_points(self, points, time_precision=None, database=None, protocol=None, retention_policy=None):
+        self.requests += 1
+        if self.down:
+            raise IOError('connection refused')
+        if self.max_points is not None and len(points) > self.max_points:
+            raise InfluxDBClientError('request entity too large', 413)
+        if any(p.startswith('bad') for p in points):
+            raise InfluxDBClientError('unable to parse', 400)
+        self.points.extend(points)
+
+    def close(self):
+        pass
+
+
+def lines(n, start=0):
+    return ''.join('m v=%di %d\n' % (i, i) for i in range(start, start + n)).encode('utf-8')
+
+
+class WriterTest(unittest.TestCase):
+
+    def writer(self, client, **kwargs):
+        # the background thread never finds anything due, flush() by hand
+        writer = InfluxWriter(client=client, precision='s', max_age=3600, batch_size=10 ** 6, **kwargs)
+        self.addCleanup(writer.close, False)
+        return writer
+
+    def test_rejected(self):
+        self.assertTrue(rejected(InfluxDBClientError('bad', 400)))
+        self.assertTrue(rejected(InfluxDBClientError('too big', 413)))
+        self.assertFalse(rejected(InfluxDBClientError('who are you', 401)))
+        self.assertFalse(rejected(InfluxDBServerError('oops')))
+        self.assertFalse(rejected(IOError('timed out')))
+
+    def test_too_large_is_split(self):
+        client = FakeClient(max_points=300)
+        writer = self.writer(client, replay_batch=1000)
+        writer.write(lines(1000))
+        self.assertTrue(writer.flush())
+        self.assertEqual(len(client.points), 1000)
+        self.assertEqual(writer.rejected, 0)
+        self.assertEqual(len(writer.queue), 0)
+
+    def test_bad_line_only_loses_itself(self):
+        client = FakeClient()
+        writer = self.writer(client)
+        writer.write(lines(500) + b'bad line\n' + lines(500, 500))
+        self.assertTrue(writer.flush())
+        self.assertEqual(len(client.points), 1000)
+        self.assertEqual(writer.rejected, 1)
+        # a handful of requests, not one per point
+        self.assertLess(client.requests, 40)
+
+    def test_outage_keeps_points(self):
+        client = FakeClient()
+        writer = self.writer(client)
+        writer.write(lines(10))
+        client.down = True
+        self.assertFalse(writer.flush())
+        self.assertEqual(len(writer.queue), 10)
+        client.down = False
+        self.assertTrue(writer.flush())
+        self.assertEqual(len(client.points), 10)
+
+    def test_late_points_replayed(self):
+        client = FakeClient()
+        spans = []
+        writer = self.writer(client, replayed=lambda start, end: spans.append((start, end)), late_after=3600)
+        now = int(time.time())
+        writer.write(b'm v=1i %d\nm v=2i %d\n' % (now - 7200, now - 5400))
+        writer.write(b'm v=3i %d\n' % now, database='other')
+        self.assertTrue(writer.flush())
+        self.assertEqual(spans, [(now - 7200, now - 5400)])
+        # on time points don't count
+        writer.write(b'm v=4i %d\n' % now)
+        self.assertTrue(writer.flush())
+        self.assertEqual(len(spans), 1)
+
+    def test_spool_quarantines_single_point(self):
+        directory = tempfile.mkdtemp()
+        try:
+            client = FakeClient()
+            writer = self.writer(client, queue=Spool(directory, fsync='never'))
+            writer.write(lines(3) + b'bad line\n')
+            self.assertTrue(writer.flush())
+            self.assertEqual(len(client.points), 3)
+            with open(directory + '/rejected') as f:
+                self.assertEqual(f.read(), 'ampread bad line\n')
+        finally:
+            writer.close(False)
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
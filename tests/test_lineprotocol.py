@@ -0,0 +1,91 @@
+import unittest
+
+from ampread.lineprotocol import LineEncoder, escape, escape_measurement, field_value, parse_line
+
+
+class EscapeTest(unittest.TestCase):
+
+    def test_measurement(self):
+        # equals signs are fine in a measurement
+        self.assertEqual(escape_measurement('a b,c=d'), 'a\\ b\\,c=d')
+
+    def test_keys_and_tag_values(self):
+        self.assertEqual(escape('a b,c=d'), 'a\\ b\\,c\\=d')
+        # backslashes and quotes are left alone outside string fields
+        self.assertEqual(escape('C:\\dir "x"'), 'C:\\dir\\ "x"')
+
+    def test_newlines(self):
+        self.assertEqual(escape('a\nb'), 'a\\ b')
+        self.assertEqual(escape_measurement('a\r\nb'), 'a\\ b')
+        self.assertEqual(field_value('a\nb'), '"a b"')
+
+    def test_field_values(self):
+        self.assertEqual(field_value(True), 't')
+        self.assertEqual(field_value(3), '3i')
+        self.assertEqual(field_value(1.5), '1.5')
+        self.assertEqual(field_value('say "hi" C:\\x'), '"say \\"hi\\" C:\\\\x"')
+        self.assertIsNone(field_value(None))
+        self.assertIsNone(field_value(float('nan')))
+        self.assertIsNone(field_value(float('inf')))
+
+
+class EncoderTest(unittest.TestCase):
+
+    def test_line(self):
+        encoder = LineEncoder('s')
+        encoder.add('current', (('tou_schedule', 'Winter'), ('tou', 'onpeak')),
+                    {'ampsA0': 1.5, 'count': 3}, 1551441600.4)
+        self.assertEqual(encoder.take(),
+                         b'current,tou=onpeak,tou_schedule=Winter ampsA0=1.5,count=3i 1551441600\n')
+        self.assertEqual(encoder.take(), b'')
+
+    def test_nanoseconds(self):
+        encoder = LineEncoder('n')
+        self.assertEqual(encoder.timestamp(1551441600.25), 1551441600250000000)
+
+    def test_empty_fields_and_tags_left_out(self):
+        encoder = LineEncoder('s')
+        self.assertFalse(encoder.add('current', (), {'a': None, 'b': float('nan')}, 1))
+        encoder.add('current', {'tou': '', 'x': None}, {'a': 1.0, 'b': None})
+        self.assertEqual(encoder.take(), b'current a=1.0\n')
+
+    def test_point_dict(self):
+        encoder = LineEncoder('ms')
+        lines = encoder.lines([{'measurement': 'voltage', 'tags': {'tou': 'midpeak'},
+                                'time': '2019-03-01T12:00:00.5Z', 'fields': {'voltage': 120.5}}])
+        self.assertEqual(lines, ['voltage,tou=midpeak voltage=120.5 1551441600500'])
+
+
+class ParseTest(unittest.TestCase):
+
+    def round_trip(self, measurement, tags, fields, seconds=1551441600):
+        encoder = LineEncoder('s')
+        encoder.add(measurement, tags, fields, seconds)
+        line = encoder.take().decode('utf-8')
+        self.assertEqual(line.count('\n'), 1)
+        return parse_line(line)
+
+    def test_plain(self):
+        self.assertEqual(self.round_trip('voltage', {'tou': 'onpeak'}, {'voltage': 120.5, 'stale': False,
+                                                                          'n': 4, 'name': 'main'}),
+                         ('voltage', {'tou': 'onpeak'}, {'voltage': 120.5, 'stale': False, 'n': 4,
+                                                         'name': 'main'}, 1551441600))
+
+    def test_escaped(self):
+        tags = {'t k': 'a=b,c', 'path': 'C:\\dir'}
+        fields = {'f=1,2': 'say "hi", x=y C:\\x\\', 'a b': 1.0}
+        self.assertEqual(self.round_trip('my meas=x,y', tags, fields),
+                         ('my meas=x,y', tags, fields, 1551441600))
+
+    def test_newline_in_string(self):
+        self.assertEqual(self.round_trip('m', {}, {'s': 'one\ntwo'})[2], {'s': 'one two'})
+
+    def test_no_timestamp(self):
+        self.assertEqual(parse_line('m a=1i'), ('m', {}, {'a': 1}, None))
+
+    def test_bad_line(self):
+        self.assertRaises(ValueError, parse_line, 'just-a-measurement')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+
+from ampread.retention import energy_queries, ensure_schema, late_after, materialize, policies
+
+
+class FakeClient(object):
+
+    def __init__(self, policies=()):
+        self.policies = list(policies)
+        self.calls = []
+
+    def create_database(self, database):
+        pass
+
+    def get_list_retention_policies(self, database):
+        return self.policies
+
+    def create_retention_policy(self, name, duration, replication, database, default=False, shard_duration=None):
+        self.calls.append(('create', name, default))
+
+    def alter_retention_policy(self, name, database, duration=None, replication=None, default=None):
+        self.calls.append(('alter', name, default))
+
+    def get_list_continuous_queries(self):
+        return []
+
+    def query(self, query):
+        self.calls.append(('query', query))
+
+
+def policy(name, default, duration='0s'):
+    return {'name': name, 'default': default, 'duration': duration, 'replicaN': 1}
+
+
+class SchemaTest(unittest.TestCase):
+
+    def test_new_database(self):
+        client = FakeClient([policy('autogen', True)])
+        ensure_schema(client, retention=policies(), queries=[], log=lambda m: None)
+        self.assertEqual(client.calls, [('create', '160w', True), ('create', 'energy', False)])
+
+    def test_default_left_alone(self):
+        client = FakeClient([policy('forever', True)])
+        ensure_schema(client, retention=policies(), queries=[], log=lambda m: None)
+        self.assertEqual(client.calls, [('create', '160w', False), ('create', 'energy', False)])
+
+    def test_replace_never_changes_default(self):
+        client = FakeClient([policy('forever', True), policy('160w', False, '100w'), policy('energy', False)])
+        ensure_schema(client, retention=policies(), queries=[], replace=True, log=lambda m: None)
+        self.assertEqual(client.calls, [('alter', '160w', None)])
+
+
+class MaterializeTest(unittest.TestCase):
+
+    def test_whole_buckets(self):
+        client = FakeClient()
+        queries = energy_queries('ampread', offset=18000)
+        materialize(client, queries, 3600 * 30 + 600, 3600 * 31 + 60, log=lambda m: None)
+        hourly, daily = [call[1] for call in client.calls]
+        self.assertIn('WHERE time >= 108000s AND time < 115200s GROUP BY', hourly)
+        self.assertIn('WHERE time >= 104400s AND time < 190800s GROUP BY', daily)
+
+    def test_late_after(self):
+        self.assertEqual(late_after(energy_queries('ampread')), 2 * 3600 - 600)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import math
+import random
+import unittest
+
+from ampread.rollup import P2Quantile, Rollup, WindowStats, window_name
+
+
+class P2QuantileTest(unittest.TestCase):
+
+    def test_exact_for_few_readings(self):
+        q = P2Quantile(0.5)
+        for x in (5.0, 1.0, 3.0):
+            q.add(x)
+        self.assertEqual(q.value(), 3.0)
+        self.assertTrue(math.isnan(P2Quantile().value()))
+
+    def test_accuracy(self):
+        rng = random.Random(1)
+        for p in (0.5, 0.95):
+            for draw in (rng.random, lambda: rng.gauss(10.0, 2.0), lambda: rng.expovariate(1.0)):
+                values = [draw() for _ in range(5000)]
+                q = P2Quantile(p)
+                for x in values:
+                    q.add(x)
+                values.sort()
+                exact = values[int(p * len(values))]
+                spread = values[-1] - values[0]
+                self.assertLess(abs(q.value() - exact), 0.02 * spread, (p, q.value(), exact))
+
+    def test_sorted_input(self):
+        q = P2Quantile(0.95)
+        for x in range(1000):
+            q.add(float(x))
+        self.assertAlmostEqual(q.value(), 950.0, delta=10.0)
+
+
+class WindowStatsTest(unittest.TestCase):
+
+    def test_stats(self):
+        stats = WindowStats()
+        for x in (2.0, 4.0, 9.0):
+            stats.add(x)
+        self.assertEqual((stats.min, stats.max, stats.mean()), (2.0, 9.0, 5.0))
+
+
+class RollupTest(unittest.TestCase):
+
+    def test_names(self):
+        self.assertEqual([window_name(w) for w in (60, 900, 3600, 7200, 300, 45)],
+                         ['1m', '15m', '1h', '2h', '5m', '45s'])
+
+    def test_window_closes_on_the_clock(self):
+        rollup = Rollup('current', windows=(60,))
+        points = []
+        for t in range(0, 130, 20):
+            points += rollup.add(t, {'amps': float(t)}, {'kwh': 0.5})
+        self.assertEqual([p['time'] for p in points],
+                         ['1970-01-01T00:00:00Z', '1970-01-01T00:01:00Z'])
+        first = points[0]
+        self.assertEqual(first['measurement'], 'current_1m')
+        self.assertEqual(first['fields']['count'], 3)
+        self.assertEqual(first['fields']['amps_min'], 0.0)
+        self.assertEqual(first['fields']['amps_max'], 40.0)
+        self.assertEqual(first['fields']['amps_mean'], 20.0)
+        self.assertEqual(first['fields']['kwh'], 1.5)
+        self.assertIn('amps_p95', first['fields'])
+        # the last one is still open until flush
+        last = rollup.flush()
+        self.assertEqual([(p['time'], p['fields']['count']) for p in last], [('1970-01-01T00:02:00Z', 1)])
+        self.assertEqual(rollup.flush(), [])
+
+    def test_window_closes_on_tag_change(self):
+        rollup = Rollup('voltage', windows=(3600,))
+        points = []
+        for t in range(0, 1800, 60):
+            points += rollup.add(t, {'voltage': 120.0}, {'kwh': 1.0}, {'tou': 'midpeak'})
+        self.assertEqual(points, [])
+        for t in range(1800, 3600, 60):
+            points += rollup.add(t, {'voltage': 121.0}, {'kwh': 2.0}, {'tou': 'onpeak'})
+        points += rollup.flush()
+        # two points for the same hour, each with its own band's kWh
+        self.assertEqual([(p['time'], p['tags'], p['fields']['kwh']) for p in points],
+                         [('1970-01-01T00:00:00Z', {'tou': 'midpeak'}, 30.0),
+                          ('1970-01-01T00:00:00Z', {'tou': 'onpeak'}, 60.0)])
+        self.assertEqual(points[1]['fields']['voltage_min'], 121.0)
+
+    def test_quantile_suffix(self):
+        rollup = Rollup('current', windows=(60,), quantile=0.99)
+        rollup.add(0, {'amps': 1.0})
+        self.assertIn('amps_p99', rollup.flush()[0]['fields'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ampread.spool import REJECTED_FILE, Spool
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def spool(self, **kwargs):
+        kwargs.setdefault('fsync', 'never')
+        return Spool(self.directory, **kwargs)
+
+    def test_read_in_order_by_database(self):
+        spool = self.spool()
+        spool.append('ampread', ['a 1', 'a 2'])
+        spool.append('internal', ['b 1'])
+        spool.append('ampread', ['a 3'])
+        batches, position = spool.read(100)
+        self.assertEqual(dict(batches), {'ampread': ['a 1', 'a 2', 'a 3'], 'internal': ['b 1']})
+        spool.close()
+
+    def test_commit(self):
+        spool = self.spool()
+        spool.append('ampread', ['a %d' % i for i in range(5)])
+        batches, position = spool.read(3)
+        self.assertEqual(batches, [('ampread', ['a 0', 'a 1', 'a 2'])])
+        # nothing is gone until it's committed
+        self.assertEqual(spool.read(3)[0], batches)
+        spool.commit(position)
+        batches, position = spool.read(100)
+        self.assertEqual(batches, [('ampread', ['a 3', 'a 4'])])
+        spool.commit(position)
+        self.assertEqual(spool.read(100)[0], [])
+        spool.close()
+
+    def test_cursor_survives_restart(self):
+        spool = self.spool()
+        spool.append('ampread', ['a 1', 'a 2', 'a 3'])
+        batches, position = spool.read(2)
+        spool.commit(position)
+        spool.close()
+
+        spool = self.spool()
+        self.assertEqual(spool.read(100)[0], [('ampread', ['a 3'])])
+        spool.append('ampread', ['a 4'])
+        self.assertEqual(spool.read(100)[0], [('ampread', ['a 3', 'a 4'])])
+        spool.close()
+
+    def test_across_segments(self):
+        spool = self.spool(segment_bytes=64)
+        lines = ['line %02d' % i for i in range(40)]
+        for line in lines:
+            spool.append('ampread', [line])
+        read = []
+        while True:
+            batches, position = spool.read(7)
+            if not batches:
+                break
+            read.extend(batches[0][1])
+            spool.commit(position)
+        self.assertEqual(read, lines)
+        # only the active segment is left
+        segments = [n for n in os.listdir(self.directory) if n.endswith('.log')]
+        self.assertEqual(len(segments), 1)
+        spool.close()
+
+    def test_max_bytes_drops_oldest(self):
+        spool = self.spool(segment_bytes=100, max_bytes=300)
+        for i in range(100):
+            spool.append('ampread', ['line %02d' % i])
+        self.assertGreater(spool.dropped_records, 0)
+        lines = []
+        while True:
+            batches, position = spool.read(1000)
+            if not batches:
+                break
+            lines.extend(batches[0][1])
+            spool.commit(position)
+        # the newest ones are kept, the dropped ones are counted
+        self.assertEqual(lines[-1], 'line 99')
+        self.assertEqual(len(lines) + spool.dropped_records, 100)
+        spool.close()
+
+    def test_half_written_line_skipped(self):
+        spool = self.spool()
+        spool.append('ampread', ['a 1'])
+        spool.close()
+        with open(os.path.join(self.directory, os.listdir(self.directory)[0]), 'ab') as f:
+            f.write(b'ampread a 2')
+        spool = self.spool()
+        spool.append('ampread', ['a 3'])
+        self.assertEqual(spool.read(100)[0], [('ampread', ['a 1', 'a 3'])])
+        spool.close()
+
+    def test_quarantine(self):
+        spool = self.spool(segment_bytes=40)
+        spool.quarantine('ampread', ['bad 1', 'bad 2'])
+        path = os.path.join(self.directory, REJECTED_FILE)
+        with open(path) as f:
+            self.assertEqual(f.read(), 'ampread bad 1\nampread bad 2\n')
+        # quarantined lines aren't read back
+        self.assertEqual(spool.read(100)[0], [])
+        # past segment_bytes the old file moves aside
+        spool.quarantine('ampread', ['bad 3', 'bad 4'])
+        with open(path) as f:
+            self.assertEqual(f.read(), 'ampread bad 3\nampread bad 4\n')
+        with open(path + '.1') as f:
+            self.assertEqual(f.read(), 'ampread bad 1\nampread bad 2\n')
+        spool.close()
+
+    def test_database_with_space(self):
+        spool = self.spool()
+        self.assertRaises(ValueError, spool.append, 'amp read', ['a 1'])
+        spool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from ampread.sqlitestore import SQLiteStore
+
+
+class SQLiteStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'ampread.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def count_series(self):
+        db = sqlite3.connect(self.path)
+        try:
+            return db.execute('SELECT count(*) FROM series').fetchone()[0]
+        finally:
+            db.close()
+
+    def test_round_trip(self):
+        store = SQLiteStore(self.path, precision='s')
+        store.write(b'current,tou=onpeak ampsA0=1.5,ampsA1=2.5,schedule="Winter" 1551441600\n'
+                    b'current,tou=onpeak ampsA0=1.75 1551441620\n')
+        self.assertEqual(store.query('current', 'ampsA0', 1551441600, 1551441700),
+                         [(1551441600.0, 1.5), (1551441620.0, 1.75)])
+        self.assertEqual(store.skipped, 1)
+        store.close()
+
+    def test_new_series_written_with_the_samples(self):
+        store = SQLiteStore(self.path, precision='s')
+        store.write(b'current,tou=onpeak ampsA0=1.5,ampsA1=2.5 1551441600\n')
+        # nothing, not even the series, until the flush
+        self.assertEqual(self.count_series(), 0)
+        store.flush()
+        self.assertEqual(self.count_series(), 2)
+        store.close()
+
+        # ids carry on after a restart
+        store = SQLiteStore(self.path, precision='s')
+        store.write(b'current,tou=midpeak ampsA0=1.0 1551441620\n')
+        store.close()
+        self.assertEqual(self.count_series(), 3)
+        store = SQLiteStore(self.path, precision='s')
+        self.assertEqual(store.query('current', 'ampsA0', 1551441600, 1551441700, tou='midpeak'),
+                         [(1551441620.0, 1.0)])
+        store.close()
+
+    def test_failed_flush_leaves_no_series(self):
+        store = SQLiteStore(self.path, precision='s')
+        store.write(b'current ampsA0=1.5 1551441600\n')
+        # a samples table that can't take the rows
+        store.db.execute('CREATE TABLE samples_201903 (time INTEGER)')
+        store._months.add(201903)
+        self.assertFalse(store.flush())
+        self.assertEqual(self.count_series(), 0)
+        self.assertEqual(store.dropped, 1)
+        store.db.execute('DROP TABLE samples_201903')
+        store._months.discard(201903)
+        store.write(b'current ampsA0=2.5 1551441620\n')
+        self.assertTrue(store.flush())
+        self.assertEqual(store.query('current', 'ampsA0', 1551441600, 1551441700), [(1551441620.0, 2.5)])
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import datetime
+import os
+import unittest
+
+from ampread.tariff import Tariff, TariffError, load_tariff
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ONTARIO = os.path.join(HERE, '..', 'tariffs', 'ontario_tou.json')
+
+DEFINITION = {
+    "name": "test",
+    "holidays": {"dates": ["2019-07-01"]},
+    "default": "offpeak",
+    "prices": [
+        {"from": "2019-01-01", "rates": {"offpeak": 0.065, "midpeak": 0.094, "onpeak": 0.132}},
+        {"from": "2019-11-01", "rates": {"offpeak": 0.101, "midpeak": 0.144, "onpeak": 0.208}},
+    ],
+    "seasons": [
+        {"name": "Summer", "months": [5, 6, 7, 8, 9, 10],
+         "periods": [{"days": "weekdays", "start": "07:00", "end": "11:00", "tou": "midpeak"},
+                     {"days": "weekdays", "start": "11:00", "end": "17:00", "tou": "onpeak"},
+                     {"days": "weekdays", "start": "17:00", "end": "19:00", "tou": "midpeak"}]},
+        {"name": "Winter", "months": [11, 12, 1, 2, 3, 4],
+         "periods": [{"days": "weekdays", "start": "07:00", "end": "11:00", "tou": "onpeak"},
+                     {"days": "weekdays", "start": "11:00", "end": "17:00", "tou": "midpeak"},
+                     {"days": "weekdays", "start": "17:00", "end": "19:00", "tou": "onpeak"}]},
+    ],
+}
+
+
+def at(*args):
+    # local time, the way the tariff works it out
+    return datetime.datetime(*args).timestamp()
+
+
+class PeriodsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tariff = Tariff(DEFINITION)
+        self.periods = self.tariff.periods(2019)
+
+    def test_covers_the_year(self):
+        self.assertEqual(self.periods[0].start, at(2019, 1, 1))
+        self.assertEqual(self.periods[-1].end, at(2020, 1, 1))
+        for before, after in zip(self.periods, self.periods[1:]):
+            self.assertEqual(before.end, after.start)
+            self.assertLess(after.start, after.end)
+
+    def test_no_identical_neighbours(self):
+        for before, after in zip(self.periods, self.periods[1:]):
+            self.assertNotEqual(tuple(before[2:]), tuple(after[2:]))
+
+    def test_weekend_merged_into_one_period(self):
+        # Friday 19:00 to Monday 07:00 is all off peak
+        period = self.tariff.period_at(at(2019, 3, 9, 12))
+        self.assertEqual(period.start, at(2019, 3, 8, 19))
+        self.assertEqual(period.end, at(2019, 3, 11, 7))
+        self.assertEqual(period.tou, 'offpeak')
+
+    def test_rates(self):
+        self.assertEqual(self.tariff.rate_at(at(2019, 3, 5, 8)), (0.132, 'onpeak', 'Winter'))
+        self.assertEqual(self.tariff.rate_at(at(2019, 7, 2, 12)), (0.132, 'onpeak', 'Summer'))
+        self.assertEqual(self.tariff.rate_at(at(2019, 7, 2, 20)), (0.065, 'offpeak', 'Summer'))
+        # the new prices from November on
+        self.assertEqual(self.tariff.rate_at(at(2019, 11, 5, 8)), (0.208, 'onpeak', 'Winter'))
+
+    def test_holiday_is_off_peak(self):
+        self.assertEqual(self.tariff.rate_at(at(2019, 7, 1, 12))[1], 'offpeak')
+
+    def test_rates_at_matches_rate_at(self):
+        times = [at(2019, 1, 1) + 1800 * i for i in range(0, 17520, 7)]
+        rates, tous, schedules = self.tariff.rates_at(times)
+        for t, rate, tou, schedule in zip(times, rates, tous, schedules):
+            self.assertEqual((rate, tou, schedule), self.tariff.rate_at(t))
+
+    def test_next_year_built_on_demand(self):
+        self.assertEqual(self.tariff.rate_at(at(2020, 1, 2, 8))[1], 'onpeak')
+        self.assertEqual(self.tariff.periods(2020)[0].start, at(2020, 1, 1))
+
+
+class DefinitionTest(unittest.TestCase):
+
+    def test_missing_price(self):
+        definition = dict(DEFINITION, prices=[{"from": "2019-01-01", "rates": {"offpeak": 0.065}}])
+        self.assertRaises(TariffError, Tariff, definition)
+
+    def test_missing_month(self):
+        definition = dict(DEFINITION, seasons=DEFINITION['seasons'][:1])
+        self.assertRaises(TariffError, Tariff, definition)
+
+    def test_backwards_period(self):
+        seasons = [dict(DEFINITION['seasons'][0],
+                        periods=[{"start": "11:00", "end": "07:00", "tou": "onpeak"}]),
+                   DEFINITION['seasons'][1]]
+        self.assertRaises(TariffError, Tariff, dict(DEFINITION, seasons=seasons))
+
+    def test_shipped_tariff(self):
+        tariff = load_tariff(ONTARIO)
+        periods = tariff.periods(2019)
+        for before, after in zip(periods, periods[1:]):
+            self.assertEqual(before.end, after.start)
+            self.assertNotEqual(tuple(before[2:]), tuple(after[2:]))
+        # Canada Day
+        self.assertEqual(tariff.rate_at(at(2019, 7, 1, 12))[1], 'offpeak')
+
+
+if __name__ == '__main__':
+    unittest.main()